@@ -0,0 +1,65 @@
+####################################################################
+# FILENAME: bench_access.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for auth.access permission checks.
+#
+#           Compares the original per-request scan of the caller's
+#           permission list against the frozenset checks (with the
+#           caller's permission set already built, as it is for
+#           results served from the auth cache) for callers holding
+#           50, 300 and 1000 permissions and decorators listing 1, 5
+#           and 20, in any and all modes.
+#
+#           Usage: python benchmarks/bench_access.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit
+from shiji.auth import base_backend
+
+ITERATIONS = 20000
+
+def scan_check(possessed, args, all_required):
+    "Original cb_validate_perms check."
+    possessed_perms = 0
+    for permission in possessed:
+        if permission in args:
+            possessed_perms = possessed_perms + 1
+    if all_required and (possessed_perms < len(args)):
+        return False
+    elif not possessed_perms:
+        return False
+    return True
+
+def set_check(auth_return, auth_ns, required_perms, all_required):
+    "Frozenset check from access()."
+    possessed_perms = auth_return.permission_set(auth_ns)
+    if not required_perms or required_perms.isdisjoint(possessed_perms):
+        return False
+    elif all_required and not required_perms.issubset(possessed_perms):
+        return False
+    return True
+
+if __name__ == "__main__":
+    print "%-8s %-8s %-5s %12s %12s" % ("held", "required", "mode", "scan", "frozenset")
+    for held_count in (50, 300, 1000):
+        possessed = ["perm.%d" % i for i in range(held_count)]
+        auth_return = base_backend.AuthResult({"digitar.com" : possessed})
+        for required_count in (1, 5, 20):
+            # Required permissions spread through (and the last one past) the caller's list
+            args = tuple(["perm.%d" % (held_count * (i + 1) / required_count) for i in range(required_count)])
+            required_perms = frozenset(args)
+            for all_required in (False, True):
+                assert scan_check(possessed, args, all_required) == set_check(auth_return, "digitar.com",
+                                                                              required_perms, all_required)
+                scan_time = min(timeit.repeat(lambda: scan_check(possessed, args, all_required),
+                                              number=ITERATIONS, repeat=3))
+                set_time = min(timeit.repeat(lambda: set_check(auth_return, "digitar.com",
+                                                               required_perms, all_required),
+                                             number=ITERATIONS, repeat=3))
+                print "%-8d %-8d %-5s %7.3f usec %7.3f usec" % (held_count, required_count,
+                                                               all_required and "all" or "any",
+                                                               scan_time / ITERATIONS * 1e6,
+                                                               set_time / ITERATIONS * 1e6)
@@ -0,0 +1,46 @@
+####################################################################
+# FILENAME: bench_compression.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for response compression.
+#
+#           Compresses a representative JSON list response (records
+#           like a typical list endpoint returns) with gzip at every
+#           zlib level and reports CPU time per response against the
+#           compressed size, for ~3KB, ~55KB and ~450KB bodies.
+#
+#           Usage: python benchmarks/bench_compression.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit, zlib
+from shiji import webapi
+
+def make_body(record_count):
+    records = []
+    for i in range(record_count):
+        records.append({"id" : i,
+                        "name" : "user%d" % i,
+                        "email" : "user%d@example.com" % i,
+                        "created" : "2016-01-%02dT12:%02d:00Z" % (i % 28 + 1, i % 60),
+                        "active" : bool(i % 3),
+                        "tags" : ["tag%d" % (i % 7), "tag%d" % (i % 11)]})
+    return webapi.json_codec.encode(records)
+
+def gzip_body(body, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+if __name__ == "__main__":
+    print "%-8s %-6s %12s %10s %8s" % ("body", "level", "time", "bytes", "ratio")
+    for record_count in (25, 400, 3200):
+        body = make_body(record_count)
+        iterations = max(10, 2000000 / len(body))
+        print "%-8s %-6s %12s %10d %8s" % ("%dKB" % (len(body) / 1024), "none", "-", len(body), "1.00")
+        for level in range(1, 10):
+            compressed_len = len(gzip_body(body, level))
+            compress_time = min(timeit.repeat(lambda: gzip_body(body, level),
+                                              number=iterations, repeat=3))
+            print "%-8s %-6d %7.1f usec %10d %8.2f" % ("", level, compress_time / iterations * 1e6,
+                                                      compressed_len, float(len(body)) / compressed_len)
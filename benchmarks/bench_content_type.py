@@ -0,0 +1,41 @@
+####################################################################
+# FILENAME: bench_content_type.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for Content-Type header parsing.
+#
+#           Compares the original inline split/join parsing used by
+#           json_arguments & url_arguments against the shared
+#           webapi.parse_content_type, both cold (cache cleared every
+#           call) and memoized.
+#
+#           Usage: python benchmarks/bench_content_type.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit
+from shiji import webapi
+
+ITERATIONS = 100000
+
+HEADERS = ["application/json; charset=utf-8",
+           "Application/JSON; Charset=UTF-8",
+           "application/x-www-form-urlencoded; charset=utf-8"]
+
+def inline_parse(raw_content_type):
+    "Original json_arguments/url_arguments parsing."
+    return "".join(raw_content_type.lower().split(" ")).split(";")
+
+def cold_parse(raw_content_type):
+    webapi.content_type_cache.clear()
+    return webapi.parse_content_type(raw_content_type)
+
+if __name__ == "__main__":
+    print "%-50s %12s %12s %12s" % ("header", "inline", "cold", "memoized")
+    for header in HEADERS:
+        times = []
+        for parse_func in (inline_parse, cold_parse, webapi.parse_content_type):
+            times.append(min(timeit.repeat(lambda: parse_func(header),
+                                           number=ITERATIONS, repeat=5)))
+        print "%-50s %7.3f usec %7.3f usec %7.3f usec" % tuple([header] + [t / ITERATIONS * 1e6 for t in times])
@@ -0,0 +1,53 @@
+####################################################################
+# FILENAME: bench_get_version.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for API version header parsing.
+#
+#           Compares parsing the X-DigiTar-API-Version header
+#           three times per request (once per router in the
+#           API->version->call chain) with the memoized parse.
+#
+#           Usage: python benchmarks/bench_get_version.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit
+from shiji import urldispatch
+from shiji.testutil import DummyRequest
+
+ITERATIONS = 100000
+RAW_VERSION = "dummy_api-1.0+prod"
+
+def uncached_get_version(request):
+    "Original per-call parse."
+    raw_version = request.getHeader(urldispatch.API_VERSION_HEADER)
+    return {"api" : raw_version.split("-")[0].lower(),
+            "version" : raw_version.split("-")[1].split("+")[0],
+            "mode" : raw_version.split("-")[1].split("+")[1].lower()}
+
+def new_request():
+    request = DummyRequest(api_mode="", api_version="", api_name="")
+    request.setHeader(urldispatch.API_VERSION_HEADER, RAW_VERSION)
+    return request
+
+def route_uncached():
+    request = new_request()
+    for i in range(3):
+        uncached_get_version(request)
+
+def route_memoized():
+    request = new_request()
+    for i in range(3):
+        urldispatch.get_version(request)
+
+def baseline():
+    new_request()
+
+if __name__ == "__main__":
+    base = min(timeit.repeat(baseline, number=ITERATIONS, repeat=3))
+    for name, func in [("uncached x3", route_uncached),
+                       ("memoized x3", route_memoized)]:
+        elapsed = min(timeit.repeat(func, number=ITERATIONS, repeat=3)) - base
+        print "%-12s %8.3f usec/request" % (name, elapsed / ITERATIONS * 1e6)
@@ -0,0 +1,61 @@
+####################################################################
+# FILENAME: bench_json_arguments.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for json_arguments argument validation.
+#
+#           Compares the original per-request arg_list loop against
+#           the compiled ArgumentValidator for 5, 20 and 100 argument
+#           schemas (half required, half optional & present), for a
+#           valid body and a body missing its last required argument.
+#
+#           Usage: python benchmarks/bench_json_arguments.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit, exceptions
+from shiji import webapi
+
+ITERATIONS = 20000
+
+def loop_validate(arg_list, json_args):
+    "Original jsonWrappedFilet validation loop."
+    for arg_pair in arg_list:
+        try:
+            if len(arg_pair) < 3 or arg_pair[2] == False or json_args.has_key(arg_pair[0]):
+                if not isinstance(json_args[arg_pair[0]], arg_pair[1]):
+                    raise exceptions.ValueError()
+        except KeyError:
+            return (arg_pair[0], "Argument is missing.")
+        except exceptions.ValueError:
+            return (arg_pair[0], "Must be of type %s" % arg_pair[1]().__class__.__name__)
+    return None
+
+def make_schema(arg_count):
+    arg_list = []
+    json_args = {}
+    types = [(unicode, u"value"), (int, 1), (dict, {}), (list, []), (bool, True)]
+    for i in range(arg_count):
+        arg_type, value = types[i % len(types)]
+        arg_list.append(("arg%d" % i, arg_type, bool(i % 2)))
+        json_args[u"arg%d" % i] = value
+    return arg_list, json_args
+
+if __name__ == "__main__":
+    print "%-10s %-8s %12s %12s" % ("schema", "body", "loop", "compiled")
+    for arg_count in (5, 20, 100):
+        arg_list, valid_args = make_schema(arg_count)
+        missing_args = dict(valid_args)
+        del missing_args[u"arg%d" % max([i for i in range(arg_count) if not i % 2])]
+        validator = webapi.ArgumentValidator(arg_list)
+
+        for body_name, json_args in [("valid", valid_args), ("missing", missing_args)]:
+            assert loop_validate(arg_list, json_args) == validator.validate(json_args)
+            loop_time = min(timeit.repeat(lambda: loop_validate(arg_list, json_args),
+                                          number=ITERATIONS, repeat=5))
+            compiled_time = min(timeit.repeat(lambda: validator.validate(json_args),
+                                              number=ITERATIONS, repeat=5))
+            print "%-10s %-8s %8.3f usec %8.3f usec" % ("%d args" % arg_count, body_name,
+                                                       loop_time / ITERATIONS * 1e6,
+                                                       compiled_time / ITERATIONS * 1e6)
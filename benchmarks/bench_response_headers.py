@@ -0,0 +1,70 @@
+####################################################################
+# FILENAME: bench_response_headers.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for static response header setup.
+#
+#           Compares the original per-request sequence of hasattr
+#           checks plus setHeader calls against writing the
+#           APIRouter's precomputed header block with
+#           Headers.setRawHeaders. Both set the same headers
+#           (including the CORS Access-Control-Expose-Headers).
+#
+#           Usage: python benchmarks/bench_response_headers.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit
+from twisted.web.test.test_web import DummyChannel
+from shiji import urldispatch, foundation, dummy_api
+
+ITERATIONS = 100000
+
+api_router = urldispatch.APIRouter([(r"dummy_api", dummy_api)],
+                                   cross_origin_domains="*",
+                                   inhibit_http_caching=True)
+version_router = urldispatch.VersionRouter({"1.0" : (r"1.0", object())}, api_router)
+call_router = type('obj', (object,), {'version_router' : version_router})
+
+def hasattr_headers(request):
+    "Original URLMatchJSONResource.__init__ header logic."
+    request.setHeader("Content-Type", "application/json; charset=utf-8")
+    if call_router and \
+       hasattr(call_router, "version_router") and \
+       hasattr(call_router.version_router, "api_router"):
+            if hasattr(call_router.version_router.api_router, "cross_origin_domains") and \
+               call_router.version_router.api_router.cross_origin_domains:
+                request.setHeader("Access-Control-Allow-Origin",
+                                  call_router.version_router.api_router.cross_origin_domains)
+                request.setHeader("Access-Control-Allow-Credentials", "true")
+                request.setHeader("Access-Control-Expose-Headers", "ETag")
+            if hasattr(call_router.version_router.api_router, "inhibit_http_caching") and \
+               call_router.version_router.api_router.inhibit_http_caching:
+                request.setHeader("Cache-Control", "no-cache")
+                request.setHeader("Pragma", "no-cache")
+
+def new_request():
+    return foundation.ShijiRequest(DummyChannel(), None)
+
+def baseline():
+    new_request()
+
+def bench_hasattr():
+    hasattr_headers(new_request())
+
+def bench_header_block():
+    api_router.apply_response_headers(new_request())
+
+if __name__ == "__main__":
+    # Sanity check: both approaches produce the same response headers
+    hasattr_request, block_request = new_request(), new_request()
+    hasattr_headers(hasattr_request)
+    api_router.apply_response_headers(block_request)
+    assert hasattr_request.responseHeaders == block_request.responseHeaders
+    
+    base = min(timeit.repeat(baseline, number=ITERATIONS, repeat=5))
+    for name, func in [("hasattr + setHeader", bench_hasattr),
+                       ("header block", bench_header_block)]:
+        elapsed = min(timeit.repeat(func, number=ITERATIONS, repeat=5)) - base
+        print "%-20s %8.3f usec/request" % (name, elapsed / ITERATIONS * 1e6)
@@ -0,0 +1,51 @@
+####################################################################
+# FILENAME: bench_secure_cookie.py
+# PROJECT: Shiji API
+# DESCRIPTION: Micro-benchmark for secure cookie verification.
+#
+#           Compares the original verification (a new HMAC per
+#           secret, every signature computed before comparing)
+#           against the pre-derived HMAC copies tried primary first,
+#           with 1 and 4 secrets installed, for cookies signed with
+#           the primary secret, the last secret and no valid secret.
+#
+#           Usage: python benchmarks/bench_secure_cookie.py
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import timeit, hmac, hashlib, time, base64
+from shiji import auth, signing
+
+ITERATIONS = 20000
+
+def original_verify(secrets, value, timestamp, signature):
+    "Original get_secure_cookie signature check."
+    signatures = []
+    for secret in secrets:
+        hash = hmac.new(secret, digestmod=hashlib.sha1)
+        for part in (value, timestamp): hash.update(part)
+        signatures.append(hash.hexdigest())
+    for valid_sig in signatures:
+        if valid_sig == signature:
+            return True
+    return False
+
+if __name__ == "__main__":
+    value = base64.b64encode('{"user_id": 1234567, "session": "0123456789abcdef"}')
+    timestamp = str(int(time.time()))
+    print "%-8s %-8s %12s %12s" % ("secrets", "signer", "original", "precomputed")
+    for secrets in (["secret0"], ["secret0", "secret1", "secret2", "secret3"]):
+        auth.install_secure_cookies(secrets)
+        signatures = [hmac.new(secret, value + timestamp, hashlib.sha1).hexdigest() for secret in secrets]
+        for signer, signature in [("primary", signatures[0]), ("last", signatures[-1]), ("invalid", "0" * 40)]:
+            assert original_verify(secrets, value, timestamp, signature) == \
+                   signing.valid_signature(signature, value, timestamp)
+            original_time = min(timeit.repeat(lambda: original_verify(secrets, value, timestamp, signature),
+                                              number=ITERATIONS, repeat=5))
+            new_time = min(timeit.repeat(lambda: signing.valid_signature(signature, value, timestamp),
+                                         number=ITERATIONS, repeat=5))
+            print "%-8d %-8s %7.3f usec %7.3f usec" % (len(secrets), signer,
+                                                      original_time / ITERATIONS * 1e6,
+                                                      new_time / ITERATIONS * 1e6)
@@ -9,14 +9,23 @@
 # (C)2015 DigiTar Inc.
 # Licensed under the MIT License.
 ####################################################################
+from twisted.internet import defer
 from twisted.web.server import NOT_DONE_YET
 from shiji.webapi import AccessDeniedError, InvalidAuthenticationError, ExpiredSecureCookieError, InvalidSecureCookieError, UnexpectedServerError
-import base64, hashlib, time, hmac, datetime, locale
-import errors, base_backend
+import base64, time, datetime, locale
+from shiji import log, lru, signing
+import errors, base_backend, cache
 
 auth_backend = None
+auth_cache = None
+auth_single_flight = cache.SingleFlight("auth.coalesced")
 cookie_secrets = None
 
+# Raw secure cookie values whose signature has been verified -> (decoded value, timestamp),
+# least recently used first. Flushed whenever the cookie secrets change.
+VERIFIED_COOKIE_CACHE_SIZE = 1024
+verified_cookies = lru.LRUCache(VERIFIED_COOKIE_CACHE_SIZE)
+
 def install_secure_cookies(secrets):
     """Sets up the secure cookie secret.
     
@@ -35,10 +44,12 @@ def install_secure_cookies(secrets):
         raise Exception("Cookie secrets must be a list not %s." % str(type(secrets)))
         
     cookie_secrets = secrets
+    signing.install_secrets(secrets)
+    verified_cookies.clear()
     
     return True
 
-def install_auth(backend):
+def install_auth(backend, cache_size=1024):
     """Installs an authentication backend.
     
     Arguments:
@@ -46,13 +57,15 @@ def install_auth(backend):
         backend (base_backend.AuthBackend) - Authentication backend 
                     to use to authenticate clients. Must be 
                     subclassed from base_backend.AuthBackend.
+        cache_size (int) - Number of credentials to cache authentication results
+                    for (see AuthBackend.credentials). 0 disables the cache.
     
     Returns:
     
         Success: True
         Failure: Raises an exeption.
     """
-    global auth_backend
+    global auth_backend, auth_cache
     
     # Make sure supplied backend is derived from AuthBackend
     try:
@@ -61,6 +74,36 @@ def install_auth(backend):
     except TypeError:
         raise errors.AuthBadBackend("Supplied backend must be a subclass of AuthBackend.")
     auth_backend = backend
+    
+    if cache_size > 0:
+        auth_cache = cache.AuthCache(cache_size, single_flight=auth_single_flight)
+    else:
+        auth_cache = None
+
+def authenticate(request):
+    """Authenticates request with the installed backend. Results come from the auth
+    cache when possible, and concurrent authentications of identical credentials
+    share one backend call.
+    
+    Arguments:
+    
+        request (t.w.http.Request) - HTTP request object.
+    
+    Returns:
+    
+        Deferred firing with the backend's authentication result (or failure).
+    """
+    if auth_cache != None:
+        return auth_cache.authenticate(auth_backend, request)
+    
+    if not auth_backend.coalesce_authentication:
+        return auth_backend.authenticate(request)
+    
+    key = cache.credentials_key(auth_backend, request)
+    if key == None:
+        return auth_backend.authenticate(request)
+    
+    return auth_single_flight.call(key, auth_backend.authenticate, request)
 
 
 def access(auth_ns_var, all_required=False, *args):
@@ -86,6 +129,8 @@ def access(auth_ns_var, all_required=False, *args):
                                   first permission match wins and permission matching stops)
     """
     
+    required_perms = frozenset(args)
+    
     def accessWrap(render_func):
         
         def eb_auth_error(failure, request):
@@ -94,7 +139,7 @@ def access(auth_ns_var, all_required=False, *args):
             if failure.check(errors.NotAuthorized):
                 error_text = str(AccessDeniedError(request))
             else:
-                failure.printTraceback()
+                log.logger.failure("UnexpectedServerError", failure)
                 error_text = str(UnexpectedServerError(request,
                                                        failure.getErrorMessage()))
             request.write(error_text)
@@ -130,30 +175,42 @@ def access(auth_ns_var, all_required=False, *args):
                     raise errors.InvalidAuthentication("Request is missing required variable %s" % auth_ns_var)
             
             # Validate permissions
-            possessed_perms = 0
+            if not isinstance(auth_return, base_backend.AuthResult):
+                auth_return = base_backend.AuthResult(auth_return)
+            
             try:
-                for permission in auth_return[auth_ns]:
-                    if permission in args:
-                        possessed_perms = possessed_perms + 1
+                possessed_perms = auth_return.permission_set(auth_ns)
             except KeyError:
                 raise errors.NotAuthorized("Insufficient permissions")
             
-            if all_required and (possessed_perms < len(args)):
+            if not required_perms or required_perms.isdisjoint(possessed_perms):
                 raise errors.NotAuthorized("Insufficient permissions")
-            elif not possessed_perms:
+            elif all_required and not required_perms.issubset(possessed_perms):
                 raise errors.NotAuthorized("Insufficient permissions")
             
-            # Attach permissions and namespace to the request
-            request.permissions = auth_return[auth_ns]
+            # Attach permissions and namespace to the request. The result may be cached
+            # and shared with later requests, so each request gets its own list.
+            request.permissions = list(auth_return[auth_ns])
             request.auth_namespace = auth_ns
             
-            # Permissions validated call original render
+            # Permissions validated call original render. Deferred results (e.g. from
+            # webapi.conditional_get) are written once they fire; failures go to eb_auth_error.
             result = render_func(self, request)
-            if result != NOT_DONE_YET:
-                request.write(result)
-                request.finish()
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(finish_render, request)
             
-            return
+            finish_render(result, request)
+        
+        def finish_render(result, request):
+            """Writes the render function's result and finishes the request. Render functions
+               that wrote their own response (e.g. with write_json) return None, and ones that
+               finish the request themselves return NOT_DONE_YET."""
+            if result is NOT_DONE_YET:
+                return
+            
+            if result:
+                request.write(result)
+            request.finish()
         
         def newRenderFunc(self, request):
             
@@ -162,8 +219,8 @@ def access(auth_ns_var, all_required=False, *args):
                 raise errors.AuthNoBackend("No authentication backend has been setup.")
             
             # Authenticate request & process result
-            auth_backend.authenticate(request).addCallback(cb_validate_perms, self, request
-                                             ).addErrback(eb_auth_error, request)
+            authenticate(request).addCallback(cb_validate_perms, self, request
+                                ).addErrback(eb_auth_error, request)
             
             return NOT_DONE_YET
         
@@ -183,40 +240,38 @@ def set_secure_cookie(request, name, value, expires_days=30, path="/", **kwargs)
     """
     timestamp = str(int(time.time()))
     value = base64.b64encode(value)
-    signature = _cookie_signature(value, timestamp)[0]
+    signature = signing.sign(value, timestamp)
     value = "|".join([value, timestamp, signature])
     locale.setlocale(locale.LC_TIME, 'en_US.UTF-8')
     expiry = (datetime.datetime.utcnow() + datetime.timedelta(days=expires_days)).strftime('%a, %d %b %Y %H:%M:%S GMT')
     request.addCookie(name, value, expires=expiry, path=path, **kwargs)
 
 def get_secure_cookie(request, name, expiry_days=31):
-    """Returns the given signed cookie if it validates, or None."""
+    """Returns the given signed cookie if it validates, or None.
+    
+    Verified cookie values are cached, so a session's cookie is only HMAC checked
+    and decoded the first time it's seen."""
     value = request.getCookie(name)
     if not value: return None
-    parts = value.split("|")
-    if len(parts) != 3: return None
-    
-    # Iterate through possible cookie signatures for validation
-    for valid_sig in _cookie_signature(parts[0], parts[1]):
-        if valid_sig == parts[2]:
-            timestamp = int(parts[1])
-            if timestamp < time.time() - (expiry_days * 86400):
-                return ExpiredSecureCookieError(request, name)
-            else:
-                return base64.b64decode(parts[0])
     
-    # ...didn't match any valid signatures
-    return InvalidSecureCookieError(request, name, parts[2])
+    verified = verified_cookies.get(value)
+    if verified == None:
+        parts = value.split("|")
+        if len(parts) != 3: return None
+        
+        if not signing.valid_signature(parts[2], parts[0], parts[1]):
+            # ...didn't match any valid signatures
+            return InvalidSecureCookieError(request, name, parts[2])
+        
+        verified = (base64.b64decode(parts[0]), int(parts[1]))
     
-def _cookie_signature(*parts):
-    global cookie_secrets
+    # Expired cookies drop out of the cache
+    decoded_value, timestamp = verified
+    if timestamp < time.time() - (expiry_days * 86400):
+        verified_cookies.pop(value)
+        return ExpiredSecureCookieError(request, name)
     
-    # Calculate the signature for every
-    # cookie secret in play...
-    signatures = []
-    for secret in cookie_secrets:
-        hash = hmac.new(secret, digestmod=hashlib.sha1)
-        for part in parts: hash.update(part)
-        signatures.append(hash.hexdigest())
+    if value not in verified_cookies:
+        verified_cookies.set(value, verified)
     
-    return signatures
+    return decoded_value
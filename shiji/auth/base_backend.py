@@ -13,10 +13,39 @@ from twisted.internet.defer import Deferred
 from twisted.internet import reactor
 import errors
 
+class AuthResult(dict):
+    """Authentication result ({<auth_name_space> : [permission IDs]}) that converts each
+    namespace's permission list to a frozenset once, no matter how many requests check it.
+    Backends may return one directly; auth.access wraps plain dicts."""
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.permission_sets = {}
+    
+    def permission_set(self, auth_ns):
+        """Returns the permissions possessed in auth_ns as a frozenset.
+        Raises KeyError if there are none."""
+        try:
+            return self.permission_sets[auth_ns]
+        except KeyError:
+            permissions = self.permission_sets[auth_ns] = frozenset(self[auth_ns])
+            return permissions
+
 class AuthBackend(object):
     """Base class API authentication backends. All Shiji auth backends
     must implement the interface defined by this class."""
     
+    # Seconds auth.access may reuse a successful (auth_cache_ttl) or an
+    # InvalidAuthentication/NotAuthorized (auth_negative_cache_ttl) result for
+    # the same credentials. 0 disables caching that kind of result. Only used
+    # if credentials() returns the request's credential material.
+    auth_cache_ttl = 60
+    auth_negative_cache_ttl = 5
+    
+    # Whether concurrent authentications of identical credentials (see credentials())
+    # may share a single authenticate() call.
+    coalesce_authentication = True
+    
     def __init__(self):
         """Backend-specific setup and configuration."""
         raise errors.AuthNoBackend("No authentication backend configured.")
@@ -32,6 +61,24 @@ class AuthBackend(object):
         """
         raise errors.AuthNoBackend("No authentication backend configured.")
     
+    def credentials(self, request):
+        """Returns everything in the request authenticate() bases its result on.
+        
+        Arguments:
+        
+            request (t.w.http.Request) - HTTP request object.
+        
+        Returns:
+        
+            (string) - Credential material (e.g. the Authorization header). Requests
+                       with identical credential material share cached results and
+                       in-flight authenticate() calls.
+            
+            None - The request can't be cached or coalesced (the default). Backends
+                   opt in by overriding this method.
+        """
+        return None
+    
     def authenticate(self, request):
         """Authenticate the request. Returns the permissions and 
         authentication name space for the supplied credentials.
@@ -0,0 +1,186 @@
+# -*- coding: utf-8-*-
+####################################################################
+# FILENAME: auth/cache.py
+# PROJECT: Shiji API
+# DESCRIPTION: Shiji Auth - Authentication result cache.
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from shiji import stats, lru
+import hashlib, time
+import errors, base_backend
+
+# Backend failures that depend only on the credentials, and so may be negatively cached.
+# Anything else (e.g. BackendWarmingUp, network errors) is retried on the next request.
+CACHEABLE_FAILURES = (errors.InvalidAuthentication, errors.NotAuthorized)
+# Returned by LRUCache.get for credentials without a live cached result
+NOT_CACHED = object()
+
+def credentials_key(backend, request):
+    """Returns a SHA256 of request's credential material (AuthBackend.credentials), or
+       None if backend doesn't provide any for request."""
+    credentials = backend.credentials(request)
+    if credentials == None:
+        return None
+
+    if isinstance(credentials, unicode):
+        credentials = credentials.encode("utf-8")
+    return hashlib.sha256(credentials).digest()
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls that share a key into one. The first call for a key
+    runs; calls made before its Deferred fires wait on it, and every waiter gets the
+    same result or failure. The key is released as soon as the call fires (or errors),
+    so later calls run again.
+
+    Cancelling a waiter only detaches that waiter. The shared call itself is cancelled
+    once every waiter has gone.
+    """
+
+    def __init__(self, metric_name=None):
+        """Sets up an empty single-flight group.
+
+        Arguments:
+
+            metric_name (string) - Optional. statsd counter incremented for every
+                                   call that joins one already in flight.
+        """
+        self.metric_name = metric_name
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def call(self, key, func, *args, **kwargs):
+        """Returns a Deferred firing with func(*args, **kwargs)'s result, joining the
+           call already in flight for key if there is one."""
+        flight = self.in_flight.get(key)
+        if flight != None:
+            self.coalesced = self.coalesced + 1
+            if self.metric_name != None:
+                stats.metrics.increment(self.metric_name)
+            return self._wait(key, flight)
+
+        # [shared Deferred, waiting Deferreds]
+        flight = [None, []]
+        self.in_flight[key] = flight
+        d = self._wait(key, flight)
+        flight[0] = defer.maybeDeferred(func, *args, **kwargs)
+        flight[0].addBoth(self._finish, key, flight)
+        return d
+
+    def _wait(self, key, flight):
+        """Returns a new Deferred waiting on flight."""
+        def cancel_waiter(d):
+            flight[1].remove(d)
+            if not flight[1]:
+                self._release(key, flight)
+                if flight[0] != None:
+                    flight[0].cancel()
+
+        d = defer.Deferred(cancel_waiter)
+        flight[1].append(d)
+        return d
+
+    def _release(self, key, flight):
+        """Frees key unless a newer call has already taken it."""
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+
+    def _finish(self, result, key, flight):
+        """Fires every waiter with the shared call's result."""
+        self._release(key, flight)
+        waiters, flight[1] = flight[1], []
+
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def __len__(self):
+        return len(self.in_flight)
+
+class AuthCache(lru.LRUCache):
+    """
+    Bounded LRU cache of AuthBackend.authenticate results keyed on a SHA256 of
+    the request's credential material (AuthBackend.credentials).
+
+    Successful results are kept for the backend's auth_cache_ttl seconds, and
+    InvalidAuthentication/NotAuthorized failures for auth_negative_cache_ttl seconds.
+    Concurrent misses for the same credentials share one backend call (unless the
+    backend turns off coalesce_authentication). Hit, miss and eviction counts are kept
+    locally and reported to shiji.stats.metrics.
+    """
+
+    def __init__(self, max_size=1024, clock=time.time, single_flight=None):
+        """Sets up an empty cache.
+
+        Arguments:
+
+            max_size (int) - Maximum number of credentials to keep results for.
+            clock (function) - Returns the current time in seconds.
+            single_flight (SingleFlight) - Coalesces concurrent backend calls. A new
+                                           group is created if not specified.
+        """
+        lru.LRUCache.__init__(self, max_size, "auth_cache", clock)
+        if single_flight == None:
+            single_flight = SingleFlight("auth.coalesced")
+        self.single_flight = single_flight
+
+    def authenticate(self, backend, request):
+        """Authenticates request with backend, answering from the cache when possible.
+
+        Arguments:
+
+            backend (base_backend.AuthBackend) - Backend to authenticate uncached
+                                                 credentials with.
+            request (t.w.http.Request) - HTTP request object.
+
+        Returns:
+
+            Deferred firing with the backend's authentication result (or failure).
+        """
+        ttl = backend.auth_cache_ttl
+        negative_ttl = backend.auth_negative_cache_ttl
+        caching = ttl > 0 or negative_ttl > 0
+        if not caching and not backend.coalesce_authentication:
+            return backend.authenticate(request)
+
+        key = credentials_key(backend, request)
+        if key == None:
+            return backend.authenticate(request)
+
+        if caching:
+            result = self.get(key, NOT_CACHED)
+            if result is not NOT_CACHED:
+                if isinstance(result, Failure):
+                    return defer.fail(result)
+                return defer.succeed(result)
+
+        if backend.coalesce_authentication:
+            return self.single_flight.call(key, self._lookup, key, backend, request, ttl, negative_ttl)
+
+        return self._lookup(key, backend, request, ttl, negative_ttl)
+
+    def _lookup(self, key, backend, request, ttl, negative_ttl):
+        """Authenticates request with backend and caches the result (as an AuthResult, so
+           its permission sets are built once for every request it answers)."""
+        def cache_result(result):
+            if isinstance(result, dict) and not isinstance(result, base_backend.AuthResult):
+                result = base_backend.AuthResult(result)
+            
+            if isinstance(result, Failure):
+                if negative_ttl > 0 and result.check(*CACHEABLE_FAILURES):
+                    result.cleanFailure()
+                    self.set(key, result, self.clock() + negative_ttl)
+            elif ttl > 0:
+                self.set(key, result, self.clock() + ttl)
+            return result
+
+        return defer.maybeDeferred(backend.authenticate, request).addBoth(cache_result)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8-*-
+####################################################################
+# FILENAME: ./dummy_api/v1_0/calls_shared.py
+# PROJECT: Shiji API
+# DESCRIPTION: Dummy API Call Logic - Shared Instance
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+
+
+from shiji import urldispatch, webapi
+
+class EchoCall (urldispatch.URLMatchJSONResource):
+    """
+    Echoes the URL match back at caller.
+    """
+    routes = r"echo/(?P<word>[^/]+)"
+    shared_instance = True
+    
+    def render_GET(self, request):
+        webapi.write_json(request, request.url_matches["word"])
@@ -15,6 +15,7 @@ from twisted.web.server import Request, Site
 class ShijiRequest(Request):
     """Twisted Request w/ metrics plumbing"""
     metrics = None
+    parsed_version = None # (raw_version, parsed_version) memoized by urldispatch.get_version
     
     def __init__(self, channel, queued):
         return Request.__init__(self, channel, queued)
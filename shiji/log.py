@@ -0,0 +1,230 @@
+####################################################################
+# FILENAME: log.py
+# PROJECT: Shiji API
+# DESCRIPTION: Request path logging for the Shiji web API framework.
+#
+#           * Messages are formatted lazily (only if written).
+#           * Per-event-type rate limiting so floods of bad
+#             requests can't swamp the log.
+#           * Optional buffering with writes handed off to a
+#             single writer thread so the event loop never blocks
+#             on stdout/syslog and lines stay in order.
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+from twisted.python.threadpool import ThreadPool
+import sys, time, collections, threading, traceback
+
+class LogEvent(object):
+    """A single log event. Formatting is deferred until the event is written."""
+
+    __slots__ = ("event_type", "fmt", "args", "failure", "exc_info")
+
+    def __init__(self, event_type, fmt, args, failure=None, exc_info=None):
+        self.event_type = event_type
+        self.fmt = fmt
+        self.args = args
+        self.failure = failure
+        self.exc_info = exc_info
+
+    def format(self):
+        """Returns the event's text."""
+        if self.args:
+            text = self.fmt % self.args
+        else:
+            text = self.fmt
+
+        if self.failure != None:
+            text = text + "\n" + self.failure.getTraceback()
+        elif self.exc_info != None:
+            text = text + "\n" + "".join(traceback.format_exception(*self.exc_info))
+
+        return text
+
+def stdout_writer(lines):
+    """Default writer. Under shijid stdout is redirected into the Twisted log."""
+    for line in lines:
+        sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+class Logger(object):
+    """Writes log events synchronously, subject to per-event-type rate limiting.
+
+    This is the default logger until install_logger() is called."""
+
+    def __init__(self, rate_limit=100, rate_period=1.0, writer=stdout_writer):
+        """Sets up the logger.
+
+        Arguments:
+
+            rate_limit (int) - Maximum events of a single type written per rate_period.
+                               None disables rate limiting.
+            rate_period (float) - Length of the rate limiting window in seconds.
+            writer (function) - Function accepting a list of formatted lines to write.
+        """
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.writer = writer
+        self.rate_windows = {}
+        self.suppressed = {}
+        self.write_lock = threading.Lock()
+
+    def _allow(self, event_type):
+        """Returns True if another event of event_type may be logged in the current window."""
+        if self.rate_limit == None:
+            return True
+
+        now = time.time()
+        window_start, count = self.rate_windows.get(event_type, (0, 0))
+        if now - window_start >= self.rate_period:
+            self.rate_windows[event_type] = (now, 1)
+            return True
+
+        if count >= self.rate_limit:
+            self.suppressed[event_type] = self.suppressed.get(event_type, 0) + 1
+            return False
+
+        self.rate_windows[event_type] = (window_start, count + 1)
+        return True
+
+    def msg(self, event_type, fmt, *args):
+        """Logs a message. fmt is only %-formatted with args if the event is written.
+
+        Arguments:
+
+            event_type (string) - Category used for rate limiting (e.g. "UnknownAPI").
+            fmt (string) - Message or %-format string.
+            *args - Format arguments.
+        """
+        if self._allow(event_type):
+            self._emit(LogEvent(event_type, fmt, args))
+
+    def failure(self, event_type, failure, fmt="Unhandled error:", *args):
+        """Logs a message followed by the traceback of a Twisted Failure."""
+        if self._allow(event_type):
+            self._emit(LogEvent(event_type, fmt, args, failure=failure))
+
+    def exception(self, event_type, fmt="Unhandled exception:", *args):
+        """Logs a message followed by the traceback of the exception currently being handled."""
+        if self._allow(event_type):
+            self._emit(LogEvent(event_type, fmt, args, exc_info=sys.exc_info()))
+
+    def _takeSuppressed(self):
+        """Returns and resets the per-event-type suppressed counts."""
+        suppressed = self.suppressed
+        self.suppressed = {}
+        return suppressed
+
+    def _emit(self, event):
+        self._write([event], self._takeSuppressed(), 0)
+
+    def _write(self, events, suppressed, dropped):
+        """Formats events and hands them to the writer."""
+        lines = [event.format() for event in events]
+        for event_type in sorted(suppressed.keys()):
+            lines.append("Shiji log: suppressed %d '%s' events (rate limit %d per %ss)." % \
+                         (suppressed[event_type], event_type, self.rate_limit, self.rate_period))
+        if dropped:
+            lines.append("Shiji log: dropped %d events (buffer full)." % dropped)
+
+        with self.write_lock:
+            try:
+                self.writer(lines)
+            except Exception:
+                traceback.print_exc()
+
+class BufferedLogger(Logger):
+    """Buffers log events in memory and periodically writes them from a dedicated
+    writer thread, so the reactor thread never blocks on log I/O. Batches are
+    written one at a time in the order they were flushed."""
+
+    def __init__(self, reactor, flush_interval=1.0, max_buffer=10000, thread_pool=None, **kwargs):
+        """Sets up the logger. Call start() to begin periodic flushing.
+
+        Arguments:
+
+            reactor (twisted.internet.reactor) - Reactor to schedule flushes on.
+            flush_interval (float) - Seconds between flushes.
+            max_buffer (int) - Maximum buffered events. Once full the oldest are dropped.
+            thread_pool (twisted.python.threadpool.ThreadPool) - Optional. Pool that
+                            writes batches. Must run at most one thread so batches stay in
+                            order. A single thread pool is created if not specified.
+
+            (Remaining keyword arguments are passed to Logger.)
+        """
+        Logger.__init__(self, **kwargs)
+        self.reactor = reactor
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.dropped = 0
+        self.flusher = None
+        if thread_pool == None:
+            thread_pool = ThreadPool(minthreads=1, maxthreads=1, name="shiji.log")
+        self.thread_pool = thread_pool
+
+    def _emit(self, event):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped = self.dropped + 1
+        self.buffer.append(event)
+
+    def start(self):
+        """Starts the writer thread and flushes the buffer every flush_interval seconds."""
+        from twisted.internet.task import LoopingCall
+
+        self.thread_pool.start()
+        self.flusher = LoopingCall(self.flush)
+        self.flusher.clock = self.reactor
+        self.flusher.start(self.flush_interval, now=False)
+
+    def stop(self):
+        """Stops periodic flushing, waits for the writer thread to finish the batches
+        already handed to it and writes anything still buffered synchronously."""
+        if self.flusher != None and self.flusher.running:
+            self.flusher.stop()
+        self.flusher = None
+        if self.thread_pool.started:
+            self.thread_pool.stop()
+        events, suppressed, dropped = self._takeBuffer()
+        if events or suppressed or dropped:
+            self._write(events, suppressed, dropped)
+
+    def _takeBuffer(self):
+        events = list(self.buffer)
+        self.buffer.clear()
+        dropped = self.dropped
+        self.dropped = 0
+        return (events, self._takeSuppressed(), dropped)
+
+    def flush(self):
+        """Queues everything buffered on the writer thread for formatting and writing."""
+        events, suppressed, dropped = self._takeBuffer()
+        if events or suppressed or dropped:
+            self.thread_pool.callInThread(self._write, events, suppressed, dropped)
+
+# Default to synchronous logging until install_logger() is called.
+logger = Logger()
+
+def install_logger(reactor, flush_interval=1.0, max_buffer=10000, rate_limit=100, rate_period=1.0):
+    """Installs and starts a BufferedLogger as the Shiji request path logger.
+
+    Arguments:
+
+        reactor (twisted.internet.reactor) - Running reactor.
+        flush_interval (float) - Seconds between buffer flushes.
+        max_buffer (int) - Maximum buffered events.
+        rate_limit (int) - Maximum events of a single type per rate_period. None disables.
+        rate_period (float) - Rate limiting window in seconds.
+
+    Returns:
+
+        The installed BufferedLogger.
+    """
+    global logger
+
+    logger = BufferedLogger(reactor, flush_interval=flush_interval, max_buffer=max_buffer,
+                            rate_limit=rate_limit, rate_period=rate_period)
+    logger.start()
+    reactor.addSystemEventTrigger("before", "shutdown", logger.stop)
+    return logger
@@ -0,0 +1,149 @@
+# -*- coding: utf-8-*-
+####################################################################
+# FILENAME: lru.py
+# PROJECT: Shiji API
+# DESCRIPTION: Bounded least recently used cache shared by Shiji's
+#              memoized parsers, route cache and auth caches.
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+from shiji import stats
+import time
+
+# Link fields of the nodes in LRUCache's doubly linked list
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+    """
+    Bounded cache that evicts the least recently used entry once full. Hit, miss and
+    eviction counts are kept locally and, if metric_prefix is given, reported to
+    shiji.stats.metrics as <metric_prefix>.hit, .miss and .eviction.
+
+    Entries may be stored with an expiry time. Expired entries are dropped (and counted
+    as misses) the next time they're looked up.
+
+    Entries are kept in a dict of [prev, next, key, value, expires] nodes linked in
+    recency order, so a hit is a dict lookup plus a few list assignments.
+    """
+
+    def __init__(self, max_size=1024, metric_prefix=None, clock=time.time):
+        """Sets up an empty cache.
+
+        Arguments:
+
+            max_size (int) - Maximum number of entries to keep.
+            metric_prefix (string) - Optional. statsd prefix for hit/miss/eviction
+                                     counters. Not reported if not specified.
+            clock (function) - Returns the current time in seconds. Only used for
+                               entries stored with an expiry time.
+        """
+        if max_size < 1:
+            raise Exception("%s: max_size (%d) must be 1 or greater." % (self.__class__.__name__, max_size))
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = {}
+        # Sentinel of the circular list: root[NEXT] is least, root[PREV] most recently used
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        if metric_prefix != None:
+            self.metric_names = (metric_prefix + ".hit", metric_prefix + ".miss",
+                                 metric_prefix + ".eviction")
+        else:
+            self.metric_names = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the value cached for key (refreshing its LRU position), or default
+           if there isn't one or it has expired."""
+        node = self.entries.get(key)
+        if node == None:
+            return self._miss(default)
+
+        if node[EXPIRES] != None and node[EXPIRES] <= self.clock():
+            self._unlink(node)
+            return self._miss(default)
+
+        # Move to the most recently used end
+        root = self.root
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+        last = root[PREV]
+        last[NEXT] = root[PREV] = node
+        node[PREV] = last
+        node[NEXT] = root
+
+        self.hits = self.hits + 1
+        if self.metric_names != None:
+            stats.metrics.increment(self.metric_names[0])
+        return node[VALUE]
+
+    def _miss(self, default):
+        self.misses = self.misses + 1
+        if self.metric_names != None:
+            stats.metrics.increment(self.metric_names[1])
+        return default
+
+    def _unlink(self, node):
+        """Removes node from the list and the entries dict."""
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+        del self.entries[node[KEY]]
+
+    def set(self, key, value, expires=None):
+        """Stores value under key, evicting the least recently used entry if full.
+
+        Arguments:
+
+            key (hashable) - Cache key.
+            value (object) - Value to cache.
+            expires (float) - Optional. clock() time after which the entry is dropped.
+        """
+        node = self.entries.get(key)
+        if node != None:
+            self._unlink(node)
+
+        root = self.root
+        last = root[PREV]
+        node = [last, root, key, value, expires]
+        last[NEXT] = root[PREV] = node
+        self.entries[key] = node
+
+        if len(self.entries) > self.max_size:
+            self._unlink(root[NEXT])
+            self.evictions = self.evictions + 1
+            if self.metric_names != None:
+                stats.metrics.increment(self.metric_names[2])
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value (expired or not), or default if it isn't cached."""
+        node = self.entries.get(key)
+        if node == None:
+            return default
+        self._unlink(node)
+        return node[VALUE]
+
+    def keys(self):
+        """Returns the cached keys, least recently used first."""
+        keys = []
+        node = self.root[NEXT]
+        while node is not self.root:
+            keys.append(node[KEY])
+            node = node[NEXT]
+        return keys
+
+    def clear(self):
+        """Drops every cached entry."""
+        self.entries.clear()
+        self.root[:] = [self.root, self.root, None, None, None]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8-*-
+####################################################################
+# FILENAME: signing.py
+# PROJECT: Shiji API
+# DESCRIPTION: HMAC-SHA1 signing with the secure cookie secrets.
+#              Used for secure cookies (shiji.auth) and paging
+#              cursors (shiji.webapi).
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+import hashlib, hmac
+
+secrets = None
+hmacs = None # Keyed HMAC for each secret (primary first), copied per signature
+
+def install_secrets(new_secrets):
+    """Sets the secrets signatures are made and checked with. Called by
+       shiji.auth.install_secure_cookies.
+    
+    Arguments:
+    
+        new_secrets (list of strings) - Valid secrets. The first signs new signatures.
+    
+    Returns:
+    
+        Nothing."""
+    global secrets, hmacs
+    
+    secrets = new_secrets
+    hmacs = [hmac.new(secret, digestmod=hashlib.sha1) for secret in new_secrets]
+
+def installed():
+    """Returns True if secrets have been installed."""
+    return bool(secrets)
+
+def _sign(keyed_hmac, parts):
+    "Signs parts with a copy of keyed_hmac."
+    hash = keyed_hmac.copy()
+    for part in parts: hash.update(part)
+    return hash.hexdigest()
+
+def sign(*parts):
+    """Returns the hex signature of the concatenated parts with the primary (first) secret."""
+    return _sign(hmacs[0], parts)
+
+def valid_signature(signature, *parts):
+    """Returns True if signature is the signature of parts for any installed secret.
+    Tries the primary secret first, stops at the first match and compares in constant time."""
+    if not isinstance(signature, str):
+        return False
+    
+    for keyed_hmac in hmacs:
+        if hmac.compare_digest(_sign(keyed_hmac, parts), signature):
+            return True
+    
+    return False
@@ -0,0 +1,308 @@
+####################################################################
+# FILENAME: auth/test_cache.py
+# PROJECT: Shiji API
+# DESCRIPTION: Tests auth.cache module.
+#
+#               Requires: TwistedWeb >= 10.0
+#                         (Python 2.5 & SimpleJSON) or Python 2.6
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from shiji import auth
+from shiji.testutil import DummyRequest
+from shiji.auth import errors, base_backend, cache
+
+class CountingBackend(base_backend.AuthBackend):
+    "Backend whose authenticate calls are answered by the test."
+
+    def __init__(self):
+        self.pending = []
+
+    def credentials(self, request):
+        return request.getHeader("Authorization")
+
+    def authenticate(self, request):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+class UncachedBackend(CountingBackend):
+    "Backend that doesn't provide credential material."
+
+    def credentials(self, request):
+        return None
+
+class AuthCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = cache.AuthCache(max_size=2, clock=lambda: self.now)
+        self.backend = CountingBackend()
+
+    def auth_request(self, authorization="Basic dXNlcjpwYXNz"):
+        "Authenticates a request carrying authorization through the cache."
+        request = DummyRequest()
+        request.setHeader("Authorization", authorization)
+        return self.cache.authenticate(self.backend, request)
+
+    def test_max_size(self):
+        "Validate the cache size must be positive"
+        self.assertRaises(Exception, cache.AuthCache, 0)
+
+    def test_positive_ttl(self):
+        "Validate successful results are reused until auth_cache_ttl passes"
+        d = self.auth_request()
+        self.backend.pending[0].callback({"digitar.com" : ["read"]})
+        self.assertEqual({"digitar.com" : ["read"]}, self.successResultOf(d))
+
+        self.now = self.now + 59
+        self.assertEqual({"digitar.com" : ["read"]}, self.successResultOf(self.auth_request()))
+        self.assertEqual(1, len(self.backend.pending))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+        self.now = self.now + 2
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_negative_ttl(self):
+        "Validate credential failures are reused until auth_negative_cache_ttl passes"
+        d = self.auth_request()
+        self.backend.pending[0].errback(errors.InvalidAuthentication("Bad password."))
+        self.failureResultOf(d, errors.InvalidAuthentication)
+
+        self.now = self.now + 4
+        self.failureResultOf(self.auth_request(), errors.InvalidAuthentication)
+        self.assertEqual(1, len(self.backend.pending))
+
+        self.now = self.now + 2
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_transient_failure_not_cached(self):
+        "Validate backend failures other than bad credentials aren't cached"
+        d = self.auth_request()
+        self.backend.pending[0].errback(errors.BackendWarmingUp("Not yet."))
+        self.failureResultOf(d, errors.BackendWarmingUp)
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_keyed_on_credentials(self):
+        "Validate different credentials don't share results"
+        self.auth_request("Basic one")
+        self.backend.pending[0].callback({"a" : []})
+        self.auth_request("Basic two")
+        self.assertEqual(2, len(self.backend.pending))
+        self.assertFalse("Basic one" in self.cache)
+
+    def test_lru_eviction(self):
+        "Validate the least recently used credentials are evicted when full"
+        for authorization in ["Basic one", "Basic two"]:
+            self.auth_request(authorization)
+            self.backend.pending[-1].callback({})
+        self.auth_request("Basic one")
+        self.auth_request("Basic three")
+        self.backend.pending[-1].callback({})
+        self.assertEqual((2, 1), (len(self.cache), self.cache.evictions))
+
+        self.auth_request("Basic one")
+        self.assertEqual(3, len(self.backend.pending))
+        self.auth_request("Basic two")
+        self.assertEqual(4, len(self.backend.pending))
+
+    def test_coalesced(self):
+        "Validate concurrent misses for the same credentials share one backend call"
+        d1 = self.auth_request()
+        d2 = self.auth_request()
+        self.assertEqual((1, 1), (len(self.backend.pending), self.cache.single_flight.coalesced))
+        self.backend.pending[0].callback({"a" : ["read"]})
+        self.assertEqual({"a" : ["read"]}, self.successResultOf(d1))
+        self.assertEqual({"a" : ["read"]}, self.successResultOf(d2))
+        self.assertEqual({}, self.cache.single_flight.in_flight)
+
+    def test_synchronous_exception(self):
+        "Validate a backend raising instead of returning a Deferred doesn't wedge the key"
+        def raise_error(request):
+            raise errors.InvalidAuthentication("No header.")
+        self.backend.authenticate = raise_error
+        self.failureResultOf(self.auth_request(), errors.InvalidAuthentication)
+        self.assertEqual({}, self.cache.single_flight.in_flight)
+
+    def test_backend_opt_out(self):
+        "Validate backends without credentials or with zero TTLs bypass the cache"
+        self.backend = UncachedBackend()
+        self.auth_request()
+        self.auth_request()
+        self.assertEqual((2, 0), (len(self.backend.pending), self.cache.misses))
+
+        self.backend = CountingBackend()
+        self.backend.auth_cache_ttl = 0
+        self.backend.auth_negative_cache_ttl = 0
+        self.backend.coalesce_authentication = False
+        self.auth_request()
+        self.auth_request()
+        self.assertEqual((2, 0), (len(self.backend.pending), self.cache.misses))
+
+    def test_coalesced_without_caching(self):
+        "Validate backends with zero TTLs still share in-flight calls"
+        self.backend.auth_cache_ttl = 0
+        self.backend.auth_negative_cache_ttl = 0
+        d1 = self.auth_request()
+        d2 = self.auth_request()
+        self.backend.pending[0].callback({"a" : []})
+        self.assertIdentical(self.successResultOf(d1), self.successResultOf(d2))
+        self.auth_request()
+        self.assertEqual((2, 0, 0), (len(self.backend.pending), len(self.cache), self.cache.misses))
+
+    def test_not_coalesced(self):
+        "Validate backends can turn coalescing off while still caching"
+        self.backend.coalesce_authentication = False
+        self.auth_request()
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_backend_ttls(self):
+        "Validate backends may cache only negative results"
+        self.backend.auth_cache_ttl = 0
+        self.auth_request()
+        self.backend.pending[0].callback({})
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_install_auth(self):
+        "Validate install_auth sets up (or disables) the cache"
+        auth.install_auth(self.backend, cache_size=10)
+        self.assertEqual(10, auth.auth_cache.max_size)
+        auth.install_auth(self.backend, cache_size=0)
+        self.assertEqual(None, auth.auth_cache)
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.single_flight = cache.SingleFlight()
+        self.calls = []
+
+    def func(self, *args):
+        "Shared call answered by the test."
+        d = defer.Deferred()
+        self.calls.append((args, d))
+        return d
+
+    def test_shared_result(self):
+        "Validate every waiter gets the shared call's result and the key is released"
+        waiters = [self.single_flight.call("key", self.func, i) for i in range(3)]
+        self.assertEqual([((0,), self.calls[0][1])], self.calls)
+        self.assertEqual((1, 2), (len(self.single_flight), self.single_flight.coalesced))
+
+        self.calls[0][1].callback("result")
+        for d in waiters:
+            self.assertEqual("result", self.successResultOf(d))
+        self.assertEqual(0, len(self.single_flight))
+
+        self.single_flight.call("key", self.func, 4)
+        self.assertEqual(2, len(self.calls))
+
+    def test_shared_failure(self):
+        "Validate every waiter gets the shared call's failure and the key is released"
+        waiters = [self.single_flight.call("key", self.func) for i in range(3)]
+        self.calls[0][1].errback(errors.InvalidAuthentication("Bad password."))
+        for d in waiters:
+            self.failureResultOf(d, errors.InvalidAuthentication)
+        self.assertEqual(0, len(self.single_flight))
+
+    def test_keys_independent(self):
+        "Validate different keys don't share calls"
+        self.single_flight.call("key1", self.func)
+        self.single_flight.call("key2", self.func)
+        self.assertEqual(2, len(self.calls))
+
+    def test_synchronous_results(self):
+        "Validate functions that return or raise immediately release the key"
+        self.assertEqual(1, self.successResultOf(self.single_flight.call("key", lambda: 1)))
+        self.failureResultOf(self.single_flight.call("key", lambda: 1 / 0), ZeroDivisionError)
+        self.assertEqual(0, len(self.single_flight))
+
+    def test_waiter_error_isolated(self):
+        "Validate an exception in one waiter's callbacks doesn't reach the others"
+        d1 = self.single_flight.call("key", self.func)
+        d2 = self.single_flight.call("key", self.func)
+        d1.addCallback(lambda result: 1 / 0)
+        self.calls[0][1].callback("result")
+        self.failureResultOf(d1, ZeroDivisionError)
+        self.assertEqual("result", self.successResultOf(d2))
+
+    def test_cancel_waiter(self):
+        "Validate cancelling one waiter leaves the shared call running for the rest"
+        d1 = self.single_flight.call("key", self.func)
+        d2 = self.single_flight.call("key", self.func)
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        self.calls[0][1].callback("result")
+        self.assertEqual("result", self.successResultOf(d2))
+
+    def test_cancel_all_waiters(self):
+        "Validate the shared call is cancelled and the key released once every waiter is gone"
+        cancelled = []
+        shared = defer.Deferred(cancelled.append)
+        d1 = self.single_flight.call("key", lambda: shared)
+        d2 = self.single_flight.call("key", lambda: shared)
+        d1.cancel()
+        d2.cancel()
+        self.assertEqual([shared], cancelled)
+        self.assertEqual(0, len(self.single_flight))
+        self.failureResultOf(d1, defer.CancelledError)
+        self.failureResultOf(d2, defer.CancelledError)
+
+class AuthenticateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = CountingBackend()
+
+    def tearDown(self):
+        auth.auth_backend = None
+        auth.auth_cache = None
+
+    def auth_request(self):
+        request = DummyRequest()
+        request.setHeader("Authorization", "Basic dXNlcjpwYXNz")
+        return auth.authenticate(request)
+
+    def test_coalesced_without_cache(self):
+        "Validate concurrent authentications share one backend call with the cache disabled"
+        auth.install_auth(self.backend, cache_size=0)
+        d1 = self.auth_request()
+        d2 = self.auth_request()
+        self.assertEqual(1, len(self.backend.pending))
+        self.backend.pending[0].callback({"a" : ["read"]})
+        self.assertEqual({"a" : ["read"]}, self.successResultOf(d1))
+        self.assertEqual({"a" : ["read"]}, self.successResultOf(d2))
+
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_not_coalesced(self):
+        "Validate backends without credentials or with coalescing off aren't coalesced"
+        auth.install_auth(self.backend, cache_size=0)
+        self.backend.coalesce_authentication = False
+        self.auth_request()
+        self.auth_request()
+
+        self.backend = UncachedBackend()
+        auth.install_auth(self.backend, cache_size=0)
+        self.auth_request()
+        self.auth_request()
+        self.assertEqual(2, len(self.backend.pending))
+
+    def test_cached(self):
+        "Validate the auth cache answers once installed"
+        auth.install_auth(self.backend, cache_size=10)
+        self.auth_request()
+        self.backend.pending[0].callback({})
+        self.assertEqual({}, self.successResultOf(self.auth_request()))
+        self.assertEqual(1, len(self.backend.pending))
@@ -14,11 +14,12 @@
 ####################################################################
 
 from twisted.trial import unittest
+from twisted.internet import defer
 from shiji import auth
-from shiji import webapi
+from shiji import webapi, signing, lru
 from shiji.testutil import DummyRequest
 from shiji.auth import errors, base_backend
-import base64, datetime, email.utils
+import base64, datetime, email.utils, hmac, hashlib, time
 
 class BadBackend(object):
     
@@ -42,6 +43,149 @@ class InstallAuthTestCase(unittest.TestCase):
        auth.install_auth(backend)
        self.assertEqual(auth.auth_backend, backend)
 
+class StaticBackend(base_backend.AuthBackend):
+    "Backend that grants the same permissions to every request."
+    def __init__(self, auth_return):
+        self.auth_return = auth_return
+    
+    def authenticate(self, request):
+        return defer.succeed(self.auth_return)
+
+class AccessTestCase(unittest.TestCase):
+    
+    # (possessed permissions, required permissions, all_required, allowed)
+    PERMISSION_TABLE = [(["read", "write"], ("read",), False, True),
+                        (["read", "write"], ("admin", "write"), False, True),
+                        (["read", "write"], ("admin",), False, False),
+                        (["read", "write"], ("read", "write"), True, True),
+                        (["read", "write", "admin"], ("read", "write"), True, True),
+                        (["read"], ("read", "write"), True, False),
+                        (["read", "read"], ("read", "write"), True, False),
+                        ([], ("read",), False, False),
+                        (["read"], (), False, False),
+                        (["read"], (), True, False)]
+    
+    def tearDown(self):
+        auth.auth_backend = None
+        auth.auth_cache = None
+    
+    def render_func(self, request):
+        "Dummy render function"
+        return "okey dokey"
+    
+    def check_access(self, possessed, required, all_required, auth_return=None):
+        "Runs a request for the digitar.com namespace through access()."
+        if auth_return == None:
+            auth_return = {"digitar.com" : possessed}
+        auth.install_auth(StaticBackend(auth_return), cache_size=0)
+        request = DummyRequest()
+        request.args["domain"] = ["digitar.com"]
+        auth.access("domain", all_required, *required)(AccessTestCase.render_func.im_func)(self, request)
+        return request
+    
+    def test_permission_table(self):
+        "Validate any/all permission matching."
+        for possessed, required, all_required, allowed in self.PERMISSION_TABLE:
+            request = self.check_access(possessed, required, all_required)
+            if allowed:
+                self.assertEqual("okey dokey", request.content.getvalue(), (possessed, required, all_required))
+                self.assertEqual(possessed, request.permissions)
+                self.assertEqual("digitar.com", request.auth_namespace)
+            else:
+                self.assertEqual(str(webapi.AccessDeniedError(request)), request.content.getvalue(),
+                                 (possessed, required, all_required))
+    
+    def test_namespace_missing(self):
+        "Validate callers without permissions in the namespace are denied."
+        request = self.check_access(None, ("read",), False, auth_return={"other.com" : ["read"]})
+        self.assertEqual(str(webapi.AccessDeniedError(request)), request.content.getvalue())
+    
+    def test_permission_sets_reused(self):
+        "Validate an AuthResult converts a namespace's permissions once."
+        auth_return = base_backend.AuthResult({"digitar.com" : ["read", "write"]})
+        self.check_access(None, ("read",), False, auth_return=auth_return)
+        permissions = auth_return.permission_sets["digitar.com"]
+        self.check_access(None, ("write",), True, auth_return=auth_return)
+        self.assertIdentical(permissions, auth_return.permission_sets["digitar.com"])
+        self.assertEqual(frozenset(["read", "write"]), permissions)
+
+    def test_permissions_not_shared(self):
+        "Validate changes to request.permissions don't leak into a shared (cached) AuthResult."
+        auth_return = base_backend.AuthResult({"digitar.com" : ["read"]})
+        request = self.check_access(None, ("read",), False, auth_return=auth_return)
+        request.permissions.append("admin")
+        self.assertEqual(["read"], auth_return["digitar.com"])
+        request = self.check_access(None, ("read",), False, auth_return=auth_return)
+        self.assertEqual(["read"], request.permissions)
+
+class VerifiedCookieCacheTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        auth.install_secure_cookies(["supersecret"])
+        self.verifications = 0
+        valid_signature = signing.valid_signature
+        def counting_valid_signature(*args):
+            self.verifications = self.verifications + 1
+            return valid_signature(*args)
+        self.patch(signing, "valid_signature", counting_valid_signature)
+    
+    def tearDown(self):
+        auth.verified_cookies.clear()
+    
+    def cookie_request(self, raw_value, age=0, secret_index=0):
+        "Returns a request carrying a secure cookie signed age seconds ago."
+        value = base64.b64encode(raw_value)
+        timestamp = str(int(time.time()) - age)
+        signature = hmac.new(auth.cookie_secrets[secret_index], value + timestamp, hashlib.sha1).hexdigest()
+        request = DummyRequest()
+        request.received_cookies["testkey"] = "|".join([value, timestamp, signature])
+        return request
+    
+    def test_verified_once(self):
+        "Validate repeat requests with the same cookie skip the HMAC check."
+        for i in range(3):
+            self.assertEqual("session1", auth.get_secure_cookie(self.cookie_request("session1"), "testkey"))
+        self.assertEqual(1, self.verifications)
+        self.assertEqual(1, len(auth.verified_cookies))
+    
+    def test_invalid_not_cached(self):
+        "Validate cookies with bad signatures are re-checked every time."
+        request = self.cookie_request("session1")
+        request.received_cookies["testkey"] = request.received_cookies["testkey"][:-1] + "x"
+        for i in range(2):
+            self.assertTrue(isinstance(auth.get_secure_cookie(request, "testkey"), webapi.InvalidSecureCookieError))
+        self.assertEqual(2, self.verifications)
+        self.assertEqual(0, len(auth.verified_cookies))
+    
+    def test_cached_cookie_expires(self):
+        "Validate cached cookies still expire and drop out of the cache."
+        request = self.cookie_request("session1", age=86400 * 2)
+        self.assertEqual("session1", auth.get_secure_cookie(request, "testkey", expiry_days=3))
+        self.assertTrue(isinstance(auth.get_secure_cookie(request, "testkey", expiry_days=1),
+                                   webapi.ExpiredSecureCookieError))
+        self.assertEqual(0, len(auth.verified_cookies))
+    
+    def test_flushed_on_rotation(self):
+        "Validate rotating secrets flushes the cache so retired secrets stop working."
+        auth.install_secure_cookies(["oldsecret", "supersecret"])
+        request = self.cookie_request("session1", secret_index=0)
+        self.assertEqual("session1", auth.get_secure_cookie(request, "testkey"))
+        
+        auth.install_secure_cookies(["supersecret"])
+        self.assertEqual(0, len(auth.verified_cookies))
+        self.assertTrue(isinstance(auth.get_secure_cookie(request, "testkey"), webapi.InvalidSecureCookieError))
+    
+    def test_bounded(self):
+        "Validate the least recently used cookies are evicted once the cache is full."
+        self.patch(auth, "verified_cookies", lru.LRUCache(2))
+        requests = [self.cookie_request("session%d" % i) for i in range(3)]
+        auth.get_secure_cookie(requests[0], "testkey")
+        auth.get_secure_cookie(requests[1], "testkey")
+        auth.get_secure_cookie(requests[0], "testkey")
+        auth.get_secure_cookie(requests[2], "testkey")
+        self.assertEqual([requests[0].received_cookies["testkey"], requests[2].received_cookies["testkey"]],
+                         auth.verified_cookies.keys())
+
 class SecureCookiesTestCase(unittest.TestCase):
     
     def test_secure_cookies_installed(self):
@@ -49,6 +193,19 @@ class SecureCookiesTestCase(unittest.TestCase):
         auth.install_secure_cookies(["supersecret"])
         self.assertEqual(auth.cookie_secrets, ["supersecret"])
     
+    def test_secure_cookie_hmacs(self):
+        "Validate installing secrets pre-derives keyed HMACs that sign like fresh ones."
+        auth.install_secure_cookies(["supersecret1", "supersecret"])
+        self.assertEqual(["supersecret1", "supersecret"], signing.secrets)
+        self.assertEqual(2, len(signing.hmacs))
+        expected = [hmac.new(secret, "valuetimestamp", hashlib.sha1).hexdigest() for secret in ["supersecret1", "supersecret"]]
+        self.assertEqual(expected[0], signing.sign("value", "timestamp"))
+        self.assertEqual(expected[0], signing.sign("value", "timestamp"))
+        self.assertTrue(signing.valid_signature(expected[0], "value", "timestamp"))
+        self.assertTrue(signing.valid_signature(expected[1], "value", "timestamp"))
+        self.assertFalse(signing.valid_signature(expected[1], "value", "timestamp2"))
+        self.assertFalse(signing.valid_signature(unicode(expected[0]), "value", "timestamp"))
+    
     def test_set_secure_cookie(self):
         "Validate setting a secure cookie."
         request = DummyRequest()
@@ -69,7 +226,7 @@ class SecureCookiesTestCase(unittest.TestCase):
         self.assertEqual(base64.b64encode("testvalue"), value)
         self.assertTrue(timestamp > 0)
         
-        expected_signature = auth._cookie_signature(value, timestamp)[0]
+        expected_signature = signing.sign(value, timestamp)
         self.assertEqual(expected_signature, signature)
     
     def test_get_secure_cookie_ok(self):
@@ -113,10 +270,10 @@ class SecureCookiesTestCase(unittest.TestCase):
         auth.install_secure_cookies(["supersecret"])
         value = base64.b64encode("testvalue")
         timestamp = "1360023531"
-        expected_signature = ["e90904d67de2fd6e4d4f3c9a736e3b8c457526f9"]
+        expected_signature = "e90904d67de2fd6e4d4f3c9a736e3b8c457526f9"
         
-        self.assertEqual(expected_signature,
-                         auth._cookie_signature(value, timestamp))
+        self.assertEqual(expected_signature, signing.sign(value, timestamp))
+        self.assertTrue(signing.valid_signature(expected_signature, value, timestamp))
     
     def test_get_secure_cookie_ok_multiple_secrets(self):
         "Validate retrieving a secure cookie with multiple secrets installed."
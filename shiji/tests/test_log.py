@@ -0,0 +1,143 @@
+####################################################################
+# FILENAME: test_log.py
+# PROJECT: Shiji API
+# DESCRIPTION: Tests log module.
+#
+#               Requires: TwistedWeb >= 10.0
+#                         (Python 2.5 & SimpleJSON) or Python 2.6
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.python.failure import Failure
+from shiji import log
+import time
+
+class CountingArg(object):
+    "Format argument that counts how often it's rendered."
+    renders = 0
+
+    def __str__(self):
+        CountingArg.renders = CountingArg.renders + 1
+        return "arg"
+
+class FakeThreadPool(object):
+    "Thread pool that runs calls immediately."
+    started = False
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def callInThread(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+class LoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = []
+        self.logger = log.Logger(rate_limit=2, rate_period=60, writer=self.lines.extend)
+
+    def test_msg(self):
+        "Messages are formatted and written immediately."
+        self.logger.msg("UnknownAPI", "Unknown API %s", "/bad")
+        self.assertEqual(self.lines, ["Unknown API /bad"])
+
+    def test_msg_no_args(self):
+        "Messages without arguments aren't %-formatted."
+        self.logger.msg("UnknownAPI", "100% bad")
+        self.assertEqual(self.lines, ["100% bad"])
+
+    def test_rate_limit(self):
+        "Events beyond the rate limit are suppressed without formatting them."
+        CountingArg.renders = 0
+        for i in range(5):
+            self.logger.msg("UnknownAPI", "Unknown API %s", CountingArg())
+        self.assertEqual(CountingArg.renders, 2)
+        self.assertEqual(self.logger.suppressed, {"UnknownAPI" : 3})
+
+    def test_rate_limit_per_event_type(self):
+        "Rate limits are tracked separately per event type."
+        for i in range(3):
+            self.logger.msg("UnknownAPI", "api")
+        self.logger.msg("UnknownCall", "call")
+        self.assertTrue("call" in self.lines[-2])
+        self.assertTrue("suppressed 1 'UnknownAPI' events" in self.lines[-1])
+
+    def test_failure(self):
+        "Failures are written with their traceback."
+        self.logger.failure("UnexpectedServerError", Failure(Exception("kaboom")))
+        self.assertTrue("kaboom" in self.lines[0])
+
+    def test_exception(self):
+        "Exceptions being handled are written with their traceback."
+        try:
+            raise Exception("kaboom")
+        except Exception:
+            self.logger.exception("UnexpectedServerError")
+        self.assertTrue("Traceback" in self.lines[0])
+        self.assertTrue("kaboom" in self.lines[0])
+
+class BufferedLoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = []
+        self.reactor = task.Clock()
+        self.logger = log.BufferedLogger(self.reactor, flush_interval=1.0, max_buffer=3,
+                                         thread_pool=FakeThreadPool(), writer=self.lines.extend)
+        self.logger.start()
+
+    def tearDown(self):
+        self.logger.stop()
+
+    def test_buffered_until_flush(self):
+        "Events are written and formatted only when the buffer is flushed."
+        CountingArg.renders = 0
+        self.logger.msg("UnknownAPI", "Unknown API %s", CountingArg())
+        self.assertEqual(self.lines, [])
+        self.assertEqual(CountingArg.renders, 0)
+        self.reactor.advance(1.0)
+        self.assertEqual(self.lines, ["Unknown API arg"])
+        self.assertEqual(CountingArg.renders, 1)
+
+    def test_buffer_overflow(self):
+        "The oldest events are dropped once the buffer is full."
+        for i in range(5):
+            self.logger.msg("event%d" % i, "message %d", i)
+        self.reactor.advance(1.0)
+        self.assertEqual(self.lines, ["message 2", "message 3", "message 4",
+                                      "Shiji log: dropped 2 events (buffer full)."])
+
+    def test_stop_flushes(self):
+        "Stopping the logger writes anything still buffered."
+        self.logger.msg("UnknownAPI", "Unknown API")
+        self.logger.stop()
+        self.assertEqual(self.lines, ["Unknown API"])
+
+    def test_writes_in_order(self):
+        "Batches are written one at a time, in the order they were flushed."
+        lines = []
+        def slow_writer(batch):
+            for line in batch:
+                time.sleep(0.0001)
+                lines.append(line)
+        logger = log.BufferedLogger(self.reactor, rate_limit=None, writer=slow_writer)
+        logger.start()
+        expected = []
+        for batch in range(20):
+            for i in range(5):
+                logger.msg("Event", "batch %d line %d", batch, i)
+                expected.append("batch %d line %d" % (batch, i))
+            logger.flush()
+        logger.msg("Event", "final")
+        logger.stop()
+        self.assertEqual(expected + ["final"], lines)
+        self.assertEqual(1, logger.thread_pool.max)
@@ -0,0 +1,87 @@
+####################################################################
+# FILENAME: test_lru.py
+# PROJECT: Shiji API
+# DESCRIPTION: Tests lru module.
+#
+#
+# $Id$
+####################################################################
+# (C)2016 DigiTar Inc.
+# Licensed under the MIT License.
+####################################################################
+
+from twisted.trial import unittest
+from shiji import lru, stats
+
+class CountingMetrics(object):
+    "Records statsd counter increments."
+    def __init__(self):
+        self.counts = {}
+    
+    def increment(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+class LRUCacheTestCase(unittest.TestCase):
+    
+    def test_invalid_size(self):
+        "Cache size must be positive."
+        self.assertRaises(Exception, lru.LRUCache, 0)
+    
+    def test_lru_eviction(self):
+        "Least recently used entries are evicted first."
+        cache = lru.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual((1, 3), (cache.get("a"), cache.get("c")))
+        self.assertEqual(["a", "c"], cache.keys())
+        self.assertEqual((3, 1, 1), (cache.hits, cache.misses, cache.evictions))
+    
+    def test_keeps_caching_when_full(self):
+        "A flood of one-off keys evicts old entries but new keys are still cached."
+        cache = lru.LRUCache(4)
+        for i in range(100):
+            cache.set("junk%d" % i, i)
+        cache.set("real", 1)
+        self.assertEqual(1, cache.get("real"))
+        self.assertEqual(4, len(cache))
+    
+    def test_expiry(self):
+        "Expired entries are dropped and counted as misses."
+        now = [100.0]
+        cache = lru.LRUCache(2, clock=lambda: now[0])
+        cache.set("a", 1, expires=110.0)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        now[0] = 110.0
+        self.assertEqual("gone", cache.get("a", "gone"))
+        self.assertEqual(2, cache.get("b"))
+        self.assertEqual((["b"], 2, 1), (cache.keys(), cache.hits, cache.misses))
+    
+    def test_pop(self):
+        "pop removes entries without counting a lookup."
+        cache = lru.LRUCache(2)
+        cache.set("a", 1)
+        self.assertEqual((1, None), (cache.pop("a"), cache.pop("a")))
+        self.assertFalse("a" in cache)
+        self.assertEqual((0, 0), (cache.hits, cache.misses))
+    
+    def test_metrics(self):
+        "Counters are reported under metric_prefix."
+        metrics = CountingMetrics()
+        self.patch(stats, "metrics", metrics)
+        cache = lru.LRUCache(1, "test_cache")
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        cache.set("b", 2)
+        self.assertEqual({"test_cache.hit" : 1, "test_cache.miss" : 1, "test_cache.eviction" : 1},
+                         metrics.counts)
+        
+        metrics.counts.clear()
+        unreported = lru.LRUCache(1)
+        unreported.set("a", 1)
+        unreported.get("a")
+        self.assertEqual({}, metrics.counts)
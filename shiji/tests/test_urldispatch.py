@@ -16,13 +16,15 @@
 from twisted.trial import unittest
 from twisted.internet import defer, address
 from twisted.web.server import NOT_DONE_YET
+from twisted.web.error import UnsupportedMethod
 from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
 from twisted.web.test.test_web import DummyChannel
-import json, types
+import json, types, re, zlib
 from shiji import urldispatch, webapi, foundation
-from shiji.testutil import DummyRequest, DummyRequestNew
+from shiji.testutil import DummyRequest, DummyRequestNew, site_request
 from shiji import dummy_api
-from shiji.dummy_api.v1_0 import calls, calls_list, calls_unicode
+from shiji.dummy_api.v1_0 import calls, calls_list, calls_unicode, calls_shared
 from shiji.dummy_api import v1_0
 
 class ShijiRequestTestCase(unittest.TestCase):
@@ -238,6 +240,20 @@ class CallRouterTestCase(unittest.TestCase):
                found_list_versions = True
         self.assertEqual(found_list_versions, True)
     
+    def test_call_router_init_compiles_once(self):
+        "Validate the route map (including list_versions) is only compiled once."
+        compiled_maps = []
+        CompiledRouteMap = urldispatch.CompiledRouteMap
+        class CountingRouteMap(CompiledRouteMap):
+            def __init__(self, route_map):
+                compiled_maps.append(route_map)
+                CompiledRouteMap.__init__(self, route_map)
+        self.patch(urldispatch, "CompiledRouteMap", CountingRouteMap)
+        
+        call_router = urldispatch.CallRouter(calls, self.version_router, True)
+        self.assertEqual(len(compiled_maps), 1)
+        self.assertEqual(call_router.compiled_routes.match("list_versions")[0].__name__, "ListVersionsCall")
+    
     def test_create_route_map_from_string(self):
         "Validate building route map from single route string."
         call_router = urldispatch.CallRouter(calls, self.version_router)
@@ -312,6 +328,318 @@ class CallRouterTestCase(unittest.TestCase):
         self.assertTrue(res.url_matches.has_key("group1"))
         self.assertEqual(res.url_matches["group1"], "&io")
 
+class CompiledRouteMapTestCase(unittest.TestCase):
+
+    def build(self, routes):
+        return urldispatch.CompiledRouteMap([(re.compile(route + "$"), handler) for route, handler in routes])
+
+    def test_literal_match(self):
+        "Literal routes resolve without URL matches."
+        compiled = self.build([(r"ping", "ping"), (r"pong", "pong")])
+        self.assertEqual(compiled.match("pong"), ("pong", {}))
+        self.assertEqual(compiled.match("ping"), ("ping", {}))
+        self.assertEqual(compiled.match("pin"), None)
+
+    def test_dynamic_match_groupdict(self):
+        "Dynamic routes return their original named groups."
+        compiled = self.build([(r"user/(?P<user_id>\d+)/(?P<field>\w+)", "user"),
+                               (r"item/(?P<user_id>\w+)", "item")])
+        self.assertEqual(compiled.match("user/12/name"),
+                         ("user", {"user_id" : "12", "field" : "name"}))
+        self.assertEqual(compiled.match("item/abc"), ("item", {"user_id" : "abc"}))
+        self.assertEqual(compiled.match("user/abc/name"), None)
+
+    def test_first_match_wins_dynamic_before_literal(self):
+        "Earlier dynamic routes shadow later literal routes."
+        compiled = self.build([(r"p(?P<rest>.*)", "dynamic"), (r"ping", "literal")])
+        self.assertEqual(compiled.match("ping"), ("dynamic", {"rest" : "ing"}))
+
+    def test_first_match_wins_literal_before_dynamic(self):
+        "Earlier literal routes shadow later dynamic routes."
+        compiled = self.build([(r"ping", "literal"), (r"p(?P<rest>.*)", "dynamic")])
+        self.assertEqual(compiled.match("ping"), ("literal", {}))
+        self.assertEqual(compiled.match("pong"), ("dynamic", {"rest" : "ong"}))
+
+    def test_first_match_wins_dynamic(self):
+        "Overlapping dynamic routes resolve in route map order."
+        compiled = self.build([(r"a(?P<x>.*)", "first"), (r"(?P<x>.*)", "second")])
+        self.assertEqual(compiled.match("abc"), ("first", {"x" : "bc"}))
+        self.assertEqual(compiled.match("bc"), ("second", {"x" : "bc"}))
+
+    def test_many_routes_chunked(self):
+        "Route tables exceeding the regex group limit still match in order."
+        routes = [(r"call%d/(?P<arg>\w+)" % i, i) for i in range(250)]
+        compiled = self.build(routes)
+        self.assertFalse(compiled.linear)
+        self.assertTrue(len(compiled.chunks) > 1)
+        self.assertEqual(compiled.match("call0/x"), (0, {"arg" : "x"}))
+        self.assertEqual(compiled.match("call249/y"), (249, {"arg" : "y"}))
+
+    def test_backreference_falls_back_to_linear(self):
+        "Routes with numeric backreferences are matched by linear scan."
+        compiled = self.build([(r"(\w)x\1", "backref"), (r"(?P<x>.*)", "catchall")])
+        self.assertTrue(compiled.linear)
+        self.assertEqual(compiled.match("axa"), ("backref", {}))
+        self.assertEqual(compiled.match("axb"), ("catchall", {"x" : "axb"}))
+
+class RouteReportTestCase(unittest.TestCase):
+
+    def build(self, routes):
+        return [(re.compile(route + "$"), handler) for route, handler in routes]
+
+    def test_compiled_route_map_frozen(self):
+        "Compiled route tables can't be modified."
+        compiled = urldispatch.CompiledRouteMap(self.build([(r"ping", "ping")]))
+        self.assertTrue(isinstance(compiled.route_map, tuple))
+        self.assertRaises(AttributeError, setattr, compiled, "linear", True)
+        self.assertRaises(TypeError, compiled.literal_routes.__setitem__, "pong", 0)
+        self.assertRaises(TypeError, compiled.literal_routes.update, {"pong" : 0})
+        self.assertEqual(compiled.literal_routes, {"ping" : 0})
+
+    def test_call_router_compile_time(self):
+        "Compile time covers building the whole route map, not just the combined regexes."
+        clock = iter([10.0, 10.25])
+        self.patch(urldispatch.time, "time", lambda: next(clock))
+        call_router = urldispatch.CallRouter(calls)
+        self.assertEqual(call_router.compile_time, 0.25)
+
+    def test_sample_route_path(self):
+        "Sample paths are matched by the route they're built from."
+        for route in [r"user/(?P<id>\d+)/[a-z]*x", r"[^/]+/item", r"(a|b)c?", r"\w{3}"]:
+            route_re = re.compile(route + "$")
+            self.assertTrue(route_re.match(urldispatch.sample_route_path(route_re)))
+
+    def test_duplicate_route_unreachable(self):
+        "Duplicate patterns are reported unreachable."
+        unreachable, overlapping = urldispatch.find_shadowed_routes(
+            self.build([(r"item/(?P<id>\d+)", "first"), (r"item/(?P<id>\d+)", "second")]))
+        self.assertEqual(len(unreachable), 1)
+        self.assertEqual(unreachable[0]["handler"], "second")
+        self.assertEqual(unreachable[0]["shadowed_by_handler"], "first")
+        self.assertEqual(overlapping, [])
+
+    def test_literal_route_unreachable(self):
+        "Literal routes matched by an earlier pattern are reported unreachable."
+        unreachable, overlapping = urldispatch.find_shadowed_routes(
+            self.build([(r"item/(?P<id>\w+)", "dynamic"), (r"item/new", "literal")]))
+        self.assertEqual([route["route"] for route in unreachable], ["item/new"])
+
+    def test_overlapping_route(self):
+        "Dynamic routes partly matched by an earlier pattern are reported overlapping."
+        unreachable, overlapping = urldispatch.find_shadowed_routes(
+            self.build([(r"item/(?P<id>\w+)", "word"), (r"item/(?P<id>\d+)", "digit")]))
+        self.assertEqual(unreachable, [])
+        self.assertEqual([route["route"] for route in overlapping], [r"item/(?P<id>\d+)"])
+
+    def test_no_shadowing(self):
+        "Disjoint routes aren't reported."
+        self.assertEqual(urldispatch.find_shadowed_routes(
+                            self.build([(r"ping", "ping"), (r"item/(?P<id>\d+)", "item")])),
+                         ([], []))
+
+    def test_api_router_route_report(self):
+        "APIRouter reports on each API version's route table."
+        router = urldispatch.APIRouter([(r"dummy_api", dummy_api)])
+        report = router.route_report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["api"], "dummy_api")
+        self.assertEqual(report[0]["version"], "1.0")
+        self.assertEqual(report[0]["routes"], 2)
+        self.assertEqual(report[0]["compile_ms"], round(v1_0.call_router.compile_time * 1000, 3))
+        self.assertEqual(report[0]["unreachable"], [])
+        self.assertEqual(report[0]["overlapping"], [])
+
+class RouteCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = urldispatch.APIRouter([(r"dummy_api", dummy_api)], route_cache_size=2)
+
+    def make_request(self, uri):
+        request = DummyRequest(api_mode="", api_version="", api_name="", uri=uri)
+        request.setHeader("X-DigiTar-API-Version", "dummy_api-1.0+prod")
+        return request
+
+    def resolve(self, request):
+        resource = self.router.getChild("dummy_api", request)
+        if isinstance(resource, urldispatch.VersionRouter):
+            resource = resource.getChild(request.uri.split("/")[2], request)
+        return resource
+
+    def test_invalid_size(self):
+        "Cache size must be positive."
+        self.assertRaises(Exception, urldispatch.RouteCache, 0)
+
+    def test_disabled_by_default(self):
+        "APIRouter has no route cache unless one is requested."
+        router = urldispatch.APIRouter([(r"dummy_api", dummy_api)])
+        self.assertEqual(router.route_cache, None)
+
+    def test_lru_eviction(self):
+        "Least recently used entries are evicted first."
+        cache = urldispatch.RouteCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (3, 1, 1))
+
+    def test_hit_rebuilds_resource(self):
+        "A cached path resolves straight to the call resource."
+        first = self.resolve(self.make_request("/dummy_api/ping"))
+        self.assertTrue(isinstance(first, calls.PingCall))
+        self.assertEqual(self.router.route_cache.misses, 1)
+
+        request = self.make_request("/dummy_api/ping")
+        resource = self.router.getChild("dummy_api", request)
+        self.assertTrue(isinstance(resource, calls.PingCall))
+        self.assertEqual(self.router.route_cache.hits, 1)
+        self.assertEqual(request.api_name, "dummy_api")
+        self.assertEqual(request.api_version, "1.0")
+        self.assertEqual(request.api_mode, "prod")
+        self.assertEqual(resource.call_router, v1_0.call_router)
+
+    def test_unknown_call_not_cached(self):
+        "Failed resolutions are not cached."
+        self.assertTrue(isinstance(self.resolve(self.make_request("/dummy_api/nope")),
+                                   urldispatch.UnknownCall))
+        self.assertEqual(len(self.router.route_cache), 0)
+
+    def test_invalidated_on_route_map_rebuild(self):
+        "Rebuilding a call router's route map clears cached resolutions."
+        self.resolve(self.make_request("/dummy_api/ping"))
+        self.assertEqual(len(self.router.route_cache), 1)
+        urldispatch.CallRouter(calls)
+        self.assertEqual(len(self.router.route_cache), 0)
+
+class SharedResourceTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.api_router = urldispatch.APIRouter([(r"dummy_api", dummy_api)], cross_origin_domains="*")
+        self.version_router = urldispatch.VersionRouter({"1.0" : (r"1.0", object())},
+                                                        self.api_router)
+        self.call_router = urldispatch.CallRouter(calls_shared, self.version_router)
+    
+    def make_request(self, uri):
+        request = DummyRequest(api_mode="", api_version="1.0", api_name="dummy_api", uri=uri)
+        request.setHeader("X-DigiTar-API-Version", "dummy_api-1.0+prod")
+        return request
+    
+    def test_shared_instance_created(self):
+        "Validate shared call classes get one instance per call router."
+        shared = self.call_router.shared_resources[calls_shared.EchoCall]
+        self.assertEqual(shared.call_router, self.call_router)
+        self.assertEqual(shared.url_matches, None)
+    
+    def test_get_child_reuses_instance(self):
+        "Validate every request is served by the shared instance."
+        request1 = self.make_request("/dummy_api/echo/hello")
+        request2 = self.make_request("/dummy_api/echo/there%20you")
+        res1 = self.call_router.getChild("noname", request1)
+        res2 = self.call_router.getChild("noname", request2)
+        self.assertTrue(res1 is res2)
+        self.assertEqual(request1.url_matches, {"word" : "hello"})
+        self.assertEqual(request2.url_matches, {"word" : "there you"})
+    
+    def test_get_child_applies_headers(self):
+        "Validate the API's response headers are applied to each request."
+        request = self.make_request("/dummy_api/echo/hello")
+        self.call_router.getChild("noname", request)
+        self.assertEqual(request.getHeader("Content-Type"), "application/json; charset=utf-8")
+        self.assertEqual(request.getHeader("Access-Control-Allow-Origin"), "*")
+        self.assertEqual(request.getHeader("Access-Control-Allow-Credentials"), "true")
+        self.assertEqual(request.getHeader("Cache-Control"), "no-cache")
+        self.assertEqual(request.getHeader("Pragma"), "no-cache")
+    
+    def test_render(self):
+        "Validate a shared instance renders from request state."
+        request = self.make_request("/dummy_api/echo/hello")
+        res = self.call_router.getChild("noname", request)
+        request.method = "GET"
+        res.render(request)
+        self.assertEqual(request.content.getvalue(), json.dumps("hello"))
+
+class RenderTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class GetPostCall(urldispatch.URLMatchJSONResource):
+            routes = r"getpost"
+            def render_GET(self, request):
+                return "get"
+            def render_POST(self, request):
+                return "post"
+
+        class PostOnlyCall(urldispatch.URLMatchJSONResource):
+            routes = r"postonly"
+            allowedMethods = ("POST",)
+            def render_POST(self, request):
+                return "post"
+
+        self.GetPostCall = GetPostCall
+        self.PostOnlyCall = PostOnlyCall
+        self.request = DummyRequest(api_mode="", api_version="1.0", api_name="dummy_api")
+
+    def test_methods(self):
+        "Validate the table maps each render_* method and HEAD straight to render_GET."
+        table = urldispatch.RenderTable(self.GetPostCall)
+        self.assertEqual(sorted(table.methods.keys()), ["GET", "HEAD", "POST"])
+        self.assertTrue(table.methods["HEAD"] is self.GetPostCall.render_GET.im_func)
+        self.assertEqual(table.allowed_methods, ("GET", "HEAD", "POST"))
+
+    def test_no_get(self):
+        "Validate HEAD is unsupported without render_GET and allowedMethods is honored."
+        table = urldispatch.RenderTable(self.PostOnlyCall)
+        self.assertEqual(table.methods.keys(), ["POST"])
+        self.assertEqual(table.allowed_methods, ("POST",))
+
+    def test_render(self):
+        "Validate rendering dispatches on the request method."
+        table = urldispatch.RenderTable(self.GetPostCall)
+        res = self.GetPostCall(self.request, url_matches={})
+        self.request.method = "HEAD"
+        self.assertEqual(table.render(res, self.request), "get")
+        self.request.method = "POST"
+        self.assertEqual(table.render(res, self.request), "post")
+
+    def test_render_unsupported(self):
+        "Validate unsupported methods raise UnsupportedMethod with the allowed methods."
+        table = urldispatch.RenderTable(self.GetPostCall)
+        res = self.GetPostCall(self.request, url_matches={})
+        self.request.method = "DELETE"
+        try:
+            table.render(res, self.request)
+            self.fail("UnsupportedMethod not raised.")
+        except UnsupportedMethod, e:
+            self.assertEqual(e.allowedMethods, ("GET", "HEAD", "POST"))
+
+    def test_unsupported_method_405(self):
+        "Validate routed calls answer unsupported methods with a 405 and an Allow header."
+        call_router = urldispatch.CallRouter(calls)
+        resource = calls.PingCall(None, url_matches={}, call_router=call_router)
+        code, headers, body = site_request(resource, method="POST")
+        self.assertEqual((code, headers["allow"]), (405, "GET, HEAD"))
+        
+        # Unrouted calls go through Twisted's own method lookup
+        resource = calls.PingCall(None, url_matches={})
+        code, headers, body = site_request(resource, method="POST")
+        self.assertEqual((code, sorted(headers["allow"].split(", "))), (405, ["GET", "HEAD"]))
+
+    def test_call_router_tables(self):
+        "Validate CallRouter builds one table per routed class and resources render through it."
+        call_router = urldispatch.CallRouter(calls, auto_list_versions=True)
+        routed_classes = set([route[1] for route in call_router.route_map])
+        self.assertEqual(set(call_router.render_tables.keys()), routed_classes)
+
+        res = self.GetPostCall(self.request, url_matches={}, call_router=call_router)
+        call_router.render_tables[self.GetPostCall] = urldispatch.RenderTable(self.GetPostCall)
+        self.request.method = "POST"
+        self.assertEqual(res.render(self.request), "post")
+
+        self.request.method = "DELETE"
+        self.assertRaises(UnsupportedMethod, res.render, self.request)
+
 class VersionRouterTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -349,6 +677,31 @@ class VersionRouterTestCase(unittest.TestCase):
         res = self.version_router.getChild("noname", self.request)
         self.assertTrue(isinstance(res, calls.PingCall))
     
+    def test_call_router_wired_at_init(self):
+        "Validate version modules are wired to the version router at construction."
+        self.assertEqual(v1_0.call_router.version_router, self.version_router)
+    
+    def test_exact_versions_table(self):
+        "Validate exact version strings resolve via the precomputed table."
+        version_router = urldispatch.VersionRouter({"1.0" : (r"1.0", object()),
+                                                    "1.1" : (r"1\.1", object()),
+                                                    "2.x" : (r"2\.\d+", object())})
+        self.assertEqual(version_router.exact_versions, {"1.0" : "1.0", "1.1" : "1.1"})
+    
+    def test_get_child_wildcard_version_match(self):
+        "Validate wildcard version patterns resolve in sorted order."
+        version_router = urldispatch.VersionRouter({"1.0" : (r"1\.\d+", v1_0),
+                                                    "1.5" : (r"1\.5", object())},
+                                                   self.api_router)
+        self.request.setHeader("X-DigiTar-API-Version", "testapi-1.5+prod")
+        self.request.uri = "/level1/ping"
+        res = version_router.getChild("noname", self.request)
+        self.assertTrue(isinstance(res, calls.PingCall))
+        self.assertEqual(self.request.api_version, "1.0")
+        self.request.setHeader("X-DigiTar-API-Version", "testapi-1.42+prod")
+        res = version_router.getChild("noname", self.request)
+        self.assertEqual(self.request.api_version, "1.0")
+    
     def test_get_version_map(self):
         "Validate correct version map is returned."
         self.assertEqual(self.version_router.version_map,
@@ -388,6 +741,40 @@ class UtilityFunctionsTestCase(unittest.TestCase):
         self.request.setHeader("X-DigiTar-API-Version", "badmojo")
         self.assertRaises(IndexError, urldispatch.get_version, self.request)
     
+    def test_get_version_memoized(self):
+        "Version extraction - parsed once per request"
+        self.request.setHeader("X-DigiTar-API-Version", "dummy_api-1.0+prod")
+        result = urldispatch.get_version(self.request)
+        self.assertEquals(self.request.parsed_version, ("dummy_api-1.0+prod", result))
+        self.assertTrue(urldispatch.get_version(self.request) is result)
+    
+    def test_get_version_memo_header_changed(self):
+        "Version extraction - memo is discarded if the header changes"
+        self.request.setHeader("X-DigiTar-API-Version", "dummy_api-1.0+prod")
+        urldispatch.get_version(self.request)
+        self.request.setHeader("X-DigiTar-API-Version", "dummy_api-2.0+test")
+        result = urldispatch.get_version(self.request)
+        self.assertEquals(result["version"], "2.0")
+        self.assertEquals(result["mode"], "test")
+    
+    def test_parse_version_interned(self):
+        "Version parsing - repeat header values share one parse"
+        first = urldispatch.parse_version("Dummy_API-1.0+Prod")
+        self.assertTrue(urldispatch.parse_version("Dummy_API-1.0+Prod") is first)
+        self.assertEquals(first, {"api" : "dummy_api", "version" : "1.0", "mode" : "prod"})
+    
+    def test_parse_version_cache_bounded(self):
+        "Version parsing - junk header values can't stop new values being memoized"
+        for i in range(urldispatch.VERSION_CACHE_SIZE + 10):
+            urldispatch.parse_version("junk%d-1.0+prod" % i)
+        self.assertEquals(urldispatch.VERSION_CACHE_SIZE, len(urldispatch.version_cache))
+        first = urldispatch.parse_version("Dummy_API-2.0+Prod")
+        self.assertTrue(urldispatch.parse_version("Dummy_API-2.0+Prod") is first)
+    
+    def test_parse_version_bad_version(self):
+        "Version parsing - malformed version"
+        self.assertRaises(IndexError, urldispatch.parse_version, "badmojo-1.0")
+    
     def tearDown(self):
         del(self.request)
 
@@ -492,6 +879,66 @@ class CORSInterrogationTestCase(unittest.TestCase):
                           "PUT,GET,DELETE,POST,HEAD,TRACE,CONNECT,PROPFIND,PROPPATCH,MKCOL,COPY,MOVE,LOCK,UNLOCK")
         self.assertEquals(body, "")
 
+    def test_options_request_max_age(self):
+        "Test an OPTIONS request advertises how long the preflight may be cached."
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*",
+                                       cors_max_age=600)
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        request.setHeader("Access-Control-Request-Headers", "Content-Type")
+        urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+        self.assertEquals(request.getHeader("Access-Control-Max-Age"), "600")
+    
+    def test_options_request_no_max_age(self):
+        "Test an OPTIONS request w/ preflight caching disabled omits Access-Control-Max-Age."
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*",
+                                       cors_max_age=0)
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        request.setHeader("Access-Control-Request-Headers", "Content-Type")
+        urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+        self.assertEquals(request.getHeader("Access-Control-Max-Age"), None)
+    
+    def test_options_request_cached(self):
+        "Test repeat OPTIONS requests are served from the preflight cache."
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*")
+        responses = []
+        for i in range(2):
+            request = DummyRequest(api_mode="", api_version="", api_name="")
+            request.setHeader("Origin", "https://example.com")
+            request.setHeader("Access-Control-Request-Headers", "Content-Type")
+            body = urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+            self.assertEquals(body, "")
+            self.assertEquals(request.response_code, 200)
+            responses.append(request.headers)
+        self.assertEquals(responses[0], responses[1])
+        self.assertEquals(router.preflight_cache.keys(), ["Content-Type"])
+    
+    def test_options_request_cache_ignores_origin(self):
+        "Test the preflight cache isn't keyed on Origin and keeps caching once full."
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*")
+        for i in range(urldispatch.PREFLIGHT_CACHE_SIZE + 10):
+            request = DummyRequest(api_mode="", api_version="", api_name="")
+            request.setHeader("Origin", "https://junk%d.example.com" % i)
+            request.setHeader("Access-Control-Request-Headers", "Content-Type")
+            urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+        self.assertEquals(router.preflight_cache.keys(), ["Content-Type"])
+        
+        for i in range(urldispatch.PREFLIGHT_CACHE_SIZE + 10):
+            request = DummyRequest(api_mode="", api_version="", api_name="")
+            request.setHeader("Access-Control-Request-Headers", "X-Junk-%d" % i)
+            urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        request.setHeader("Access-Control-Request-Headers", "Content-Type")
+        urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+        self.assertEquals(len(router.preflight_cache), urldispatch.PREFLIGHT_CACHE_SIZE)
+        self.assertEquals(router.preflight_cache.keys()[-1], "Content-Type")
+    
+    def test_options_request_no_acrh_not_cached(self):
+        "Test OPTIONS requests w/o Access-Control-Request-Headers bypass the preflight cache."
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*")
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        urldispatch.CORSInterrogation(request, api_router=router).render_OPTIONS(request)
+        self.assertEquals(len(router.preflight_cache), 0)
+
 class UnknownVersionTestCase(unittest.TestCase):
     
     def test_get_bad_header(self):
@@ -609,6 +1056,94 @@ class APIRouterTestCase(unittest.TestCase):
         resource = router.getChild("/example/", request)
         self.assertTrue(isinstance(resource, urldispatch.UnknownVersion))
     
+    def test_response_headers_compiled(self):
+        "Test the static response header block is built at construction"
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)],
+                                       cross_origin_domains="*",
+                                       inhibit_http_caching=True)
+        self.assertEquals(router.response_headers,
+                          (("Content-Type", "application/json; charset=utf-8"),
+                           ("Access-Control-Allow-Origin", "*"),
+                           ("Access-Control-Allow-Credentials", "true"),
+                           ("Access-Control-Expose-Headers", "ETag"),
+                           ("Cache-Control", "no-cache"),
+                           ("Pragma", "no-cache")))
+    
+    def test_response_headers_minimal(self):
+        "Test the static response header block without CORS or cache inhibition"
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)],
+                                       inhibit_http_caching=False)
+        self.assertEquals(router.response_headers,
+                          (("Content-Type", "application/json; charset=utf-8"),))
+    
+    def test_apply_response_headers(self):
+        "Test applying the static response header block to a request"
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*")
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        router.apply_response_headers(request)
+        self.assertEquals(request.headers, dict(router.response_headers))
+    
+    def test_apply_response_headers_twisted_request(self):
+        "Test the header block written straight into a Twisted request matches setHeader"
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*")
+        request = foundation.ShijiRequest(DummyChannel(), None)
+        request.setHeader("X-Existing", "kept")
+        router.apply_response_headers(request)
+        
+        expected = foundation.ShijiRequest(DummyChannel(), None)
+        expected.setHeader("X-Existing", "kept")
+        for name, value in router.response_headers:
+            expected.setHeader(name, value)
+        self.assertEquals(request.responseHeaders, expected.responseHeaders)
+        
+        # Each request gets its own value lists
+        request.responseHeaders.addRawHeader("Cache-Control", "private")
+        other_request = foundation.ShijiRequest(DummyChannel(), None)
+        router.apply_response_headers(other_request)
+        self.assertEquals(other_request.responseHeaders.getRawHeaders("cache-control"), ["no-cache"])
+    
+    def test_call_resource_uses_response_headers(self):
+        "Test call resources get their headers from the API router's header block"
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)], cross_origin_domains="*")
+        version_router = urldispatch.VersionRouter({"1.0" : (r"1.0", object())}, router)
+        call_router = urldispatch.CallRouter(calls, version_router)
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        calls.PingCall(request, url_matches={}, call_router=call_router)
+        self.assertEquals(request.headers, dict(router.response_headers))
+    
+    def test_compression_encoder(self):
+        "Test call resources return the API's compression encoder only when enabled"
+        request = DummyRequest(api_mode="", api_version="", api_name="")
+        request.requestHeaders = Headers({"accept-encoding" : ["gzip"]})
+        request.responseHeaders = Headers()
+        for compress_responses in (False, True):
+            router = urldispatch.APIRouter([(r"^/example/", dummy_api)],
+                                           compress_responses=compress_responses,
+                                           compress_min_size=512, compress_level=1)
+            version_router = urldispatch.VersionRouter({"1.0" : (r"1.0", object())}, router)
+            call_router = urldispatch.CallRouter(calls, version_router)
+            encoder = calls.PingCall(request, url_matches={}, call_router=call_router).getEncoder(request)
+            if compress_responses:
+                self.assertEquals((encoder.encoding, encoder.min_size, encoder.level), ("gzip", 512, 1))
+            else:
+                self.assertEquals(encoder, None)
+        self.assertEquals(urldispatch.URLMatchJSONResource(None, url_matches={}).getEncoder(request), None)
+    
+    def test_compressed_write_json(self):
+        "Test compressed responses of calls that write_json and return None hold only the JSON"
+        router = urldispatch.APIRouter([(r"^/example/", dummy_api)],
+                                       compress_responses=True, compress_min_size=0)
+        version_router = urldispatch.VersionRouter({"1.0" : (r"1.0", object())}, router)
+        call_router = urldispatch.CallRouter(calls, version_router)
+        class WritingCall(urldispatch.URLMatchJSONResource):
+            def render_GET(self, request):
+                webapi.write_json(request, {"entries" : range(10)})
+        
+        code, headers, body = site_request(WritingCall(None, url_matches={}, call_router=call_router),
+                                           headers={"Accept-Encoding" : "gzip"})
+        self.assertEquals((code, headers["content-encoding"]), (200, "gzip"))
+        self.assertEquals(zlib.decompress(body, 16 + zlib.MAX_WBITS), json.dumps({"entries" : range(10)}))
+    
     def test_get_route_map(self):
         route_map = [(r"^/example/", dummy_api)]
         router = urldispatch.APIRouter(route_map)
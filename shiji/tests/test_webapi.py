@@ -13,9 +13,13 @@
 # Licensed under the MIT License.
 ####################################################################
 from twisted.trial import unittest
-import json
-from shiji import webapi
-from shiji.testutil import DummyRequest
+from twisted.internet import defer
+import json, base64, urllib, hashlib, zlib, time
+from twisted.web.test.test_web import DummyChannel
+from twisted.web.server import NOT_DONE_YET
+from shiji import webapi, urldispatch, foundation, log, auth, signing
+from shiji.auth import base_backend
+from shiji.testutil import DummyRequest, site_request
 
 ## Tests
 
@@ -167,6 +171,288 @@ class JSONArgumentsTestCase(unittest.TestCase):
         self.assertTrue(hasattr(test_request, "jsonArgs"))
         self.assertTrue(test_request.jsonArgs.has_key("arg1"))
         self.assertEqual(test_request.jsonArgs["arg1"], unicode("hi"))
+    
+    def test_body_too_large(self):
+        "Request body larger than max_body_size is rejected."
+        test_request = DummyRequest()
+        test_request.setHeader("Content-Type", "application/json; charset=utf-8")
+        test_request.write(json.dumps({"arg1" : unicode("hello")}))
+        outer_wrap = webapi.json_arguments([("arg1", unicode)], max_body_size=10)
+        inner_wrap = outer_wrap(self.dummy_render_func)
+        self.assertEqual(str(webapi.RequestTooLargeError(test_request, 10)),
+                         inner_wrap(self, test_request))
+        self.assertEqual(test_request.response_code, 413)
+        self.assertEqual(test_request.content.tell(), 0)
+    
+    def test_body_at_limit(self):
+        "Request body exactly max_body_size long is accepted."
+        body = json.dumps({"arg1" : unicode("hello")})
+        test_request = DummyRequest()
+        test_request.setHeader("Content-Type", "application/json; charset=utf-8")
+        test_request.write(body)
+        outer_wrap = webapi.json_arguments([("arg1", unicode)], max_body_size=len(body))
+        inner_wrap = outer_wrap(JSONArgumentsTestCase.dummy_render_func.im_func)
+        self.assertEqual("okey dokey", inner_wrap(self, test_request))
+    
+    def test_default_max_body_size(self):
+        "Default body size limit applies unless the decorator overrides it."
+        self.addCleanup(webapi.set_max_body_size, 0)
+        webapi.set_max_body_size(5)
+        
+        test_request = DummyRequest()
+        test_request.setHeader("Content-Type", "application/json; charset=utf-8")
+        test_request.write(json.dumps({"arg1" : unicode("hi")}))
+        self.assertEqual(str(webapi.RequestTooLargeError(test_request, 5)),
+                         self.dummy_render_func2(test_request))
+        
+        test_request = DummyRequest()
+        test_request.setHeader("Content-Type", "application/json; charset=utf-8")
+        test_request.write(json.dumps({"arg1" : unicode("hi")}))
+        outer_wrap = webapi.json_arguments([("arg1", unicode)], max_body_size=0)
+        inner_wrap = outer_wrap(JSONArgumentsTestCase.dummy_render_func.im_func)
+        self.assertEqual("okey dokey", inner_wrap(self, test_request))
+    
+    def test_invalid_default_max_body_size(self):
+        "Negative default body size limit is rejected."
+        self.assertRaises(Exception, webapi.set_max_body_size, -1)
+    
+    def test_body_spooled_to_file(self):
+        "Request bodies Twisted spooled to a temporary file are parsed."
+        import tempfile
+        test_request = DummyRequest()
+        test_request.setHeader("Content-Type", "application/json; charset=utf-8")
+        test_request.content = tempfile.TemporaryFile()
+        test_request.content.write(json.dumps({"arg1" : u"caf\xe9"}))
+        test_request.content.seek(0)
+        self.assertEqual(webapi.request_body_size(test_request), 21)
+        self.dummy_render_func2(test_request)
+        self.assertEqual(test_request.jsonArgs, {"arg1" : u"caf\xe9"})
+
+class ArgumentValidatorTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.validator = webapi.ArgumentValidator([("arg1", unicode),
+                                                   ("arg2", int, webapi.ARG_REQUIRED),
+                                                   ("arg3", dict, webapi.ARG_OPTIONAL)])
+    
+    def test_compiled(self):
+        "Required and optional arguments are split & type messages precomputed."
+        self.assertEqual(self.validator.required_checks, (("arg1", unicode, 0), ("arg2", int, 1)))
+        self.assertEqual(self.validator.optional_checks, (("arg3", dict, 2),))
+        self.assertEqual([arg[3] for arg in self.validator.arg_list],
+                         ["Must be of type unicode", "Must be of type int", "Must be of type dict"])
+    
+    def test_valid(self):
+        "Valid arguments with & without optional arguments."
+        self.assertEqual(self.validator.validate({"arg1" : u"hi", "arg2" : 1}), None)
+        self.assertEqual(self.validator.validate({"arg1" : u"hi", "arg2" : 1, "arg3" : {}}), None)
+    
+    def test_missing(self):
+        "Missing required argument is reported."
+        self.assertEqual(self.validator.validate({"arg1" : u"hi"}),
+                         ("arg2", "Argument is missing."))
+    
+    def test_type_mismatch(self):
+        "Type mismatches are reported for required & optional arguments."
+        self.assertEqual(self.validator.validate({"arg1" : u"hi", "arg2" : "1"}),
+                         ("arg2", "Must be of type int"))
+        self.assertEqual(self.validator.validate({"arg1" : u"hi", "arg2" : 1, "arg3" : []}),
+                         ("arg3", "Must be of type dict"))
+    
+    def test_error_order(self):
+        "The first invalid argument in arg_list order is reported."
+        self.assertEqual(self.validator.validate({"arg1" : 1}),
+                         ("arg1", "Must be of type unicode"))
+        self.assertEqual(self.validator.validate({"arg2" : "1"}),
+                         ("arg1", "Argument is missing."))
+    
+    def test_error_order_unchecked(self):
+        "Errors are picked from the arguments the fast checks hadn't reached, in arg_list order."
+        validator = webapi.ArgumentValidator([("opt1", int, webapi.ARG_OPTIONAL),
+                                              ("obj1", webapi.ObjectSchema([("a", int)])),
+                                              ("req1", unicode),
+                                              ("opt2", dict, webapi.ARG_OPTIONAL)])
+        self.assertEqual([len(unchecked) for unchecked in validator.unchecked_before], [0, 0, 2, 1])
+        
+        # Required check fails, earlier optional & schema arguments are reported first
+        self.assertEqual(validator.validate({"opt1" : "x", "obj1" : {"a" : 1}}),
+                         ("opt1", "Must be of type int"))
+        self.assertEqual(validator.validate({"obj1" : {"a" : "x"}}),
+                         ("/obj1/a", "Must be of type int"))
+        self.assertEqual(validator.validate({"obj1" : {"a" : 1}}),
+                         ("req1", "Argument is missing."))
+        
+        # Optional check fails, an earlier schema argument is reported first
+        self.assertEqual(validator.validate({"obj1" : {}, "req1" : u"hi", "opt2" : []}),
+                         ("/obj1/a", "Argument is missing."))
+        self.assertEqual(validator.validate({"obj1" : {"a" : 1}, "req1" : u"hi", "opt2" : []}),
+                         ("opt2", "Must be of type dict"))
+    
+    def test_uninstantiable_type(self):
+        "Types that can't be instantiated still validate."
+        validator = webapi.ArgumentValidator([("arg1", basestring)])
+        self.assertEqual(validator.validate({"arg1" : "hi"}), None)
+        self.assertRaises(TypeError, validator.validate, {"arg1" : 1})
+
+class SchemaTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.validator = webapi.ArgumentValidator(
+            [("name", webapi.StringSchema(min_length=1, max_length=8)),
+             ("order", webapi.EnumSchema([u"asc", u"desc"]), webapi.ARG_OPTIONAL),
+             ("items", webapi.ArraySchema(webapi.ObjectSchema([("id", webapi.IntegerSchema(minimum=0)),
+                                                               ("price", webapi.NumberSchema(maximum=100)),
+                                                               ("tags", webapi.ArraySchema(unicode), webapi.ARG_OPTIONAL),
+                                                               ("gift", webapi.BooleanSchema(), webapi.ARG_OPTIONAL)]),
+                                          max_length=3))])
+        self.valid_args = {"name" : u"order1",
+                           "order" : u"asc",
+                           "items" : [{"id" : 1, "price" : 9.5, "tags" : [u"a"], "gift" : True},
+                                      {"id" : 2, "price" : 10}]}
+    
+    def error_for(self, **changes):
+        json_args = json.loads(json.dumps(self.valid_args))
+        for key, value in changes.items():
+            json_args[key] = value
+        return self.validator.validate(json_args)
+    
+    def test_valid(self):
+        "Valid nested payload passes."
+        self.assertEqual(self.validator.validate(self.valid_args), None)
+    
+    def test_top_level(self):
+        "Top level schema arguments report JSON pointers; missing arguments their name."
+        self.assertEqual(self.error_for(name=u""), ("/name", "Must be at least 1 characters long."))
+        self.assertEqual(self.error_for(name=u"123456789"), ("/name", "Must be 8 characters or less."))
+        self.assertEqual(self.error_for(name=1), ("/name", "Must be of type unicode"))
+        self.assertEqual(self.error_for(order=u"up"), ("/order", 'Must be one of ["asc", "desc"].'))
+        self.assertEqual(self.validator.validate({"name" : u"order1"}), ("items", "Argument is missing."))
+    
+    def test_nested(self):
+        "Nested errors report the JSON pointer of the invalid value."
+        item = {"id" : 1, "price" : 1}
+        self.assertEqual(self.error_for(items={}), ("/items", "Must be of type list"))
+        self.assertEqual(self.error_for(items=[item] * 4), ("/items", "Must contain 3 items or less."))
+        self.assertEqual(self.error_for(items=[item, 1]), ("/items/1", "Must be of type dict"))
+        self.assertEqual(self.error_for(items=[item, {"price" : 1}]), ("/items/1/id", "Argument is missing."))
+        self.assertEqual(self.error_for(items=[{"id" : -1, "price" : 1}]), ("/items/0/id", "Must be 0 or greater."))
+        self.assertEqual(self.error_for(items=[{"id" : 1, "price" : 100.5}]), ("/items/0/price", "Must be 100 or less."))
+        self.assertEqual(self.error_for(items=[{"id" : 1, "price" : 1, "tags" : [u"a", 2]}]),
+                         ("/items/0/tags/1", "Must be of type unicode"))
+        self.assertEqual(self.error_for(items=[{"id" : 1, "price" : 1, "gift" : 1}]),
+                         ("/items/0/gift", "Must be of type bool"))
+    
+    def test_bools_not_numbers(self):
+        "JSON true/false aren't accepted as numbers, nor 1/0 as enum booleans."
+        self.assertEqual(self.error_for(items=[{"id" : True, "price" : 1}]), ("/items/0/id", "Must be of type int"))
+        self.assertEqual(self.error_for(items=[{"id" : 1, "price" : False}]), ("/items/0/price", "Must be of type float"))
+        validator = webapi.ArgumentValidator([("flag", webapi.EnumSchema([True]))])
+        self.assertEqual(validator.validate({"flag" : 1}), ("/flag", "Must be one of [true]."))
+        self.assertEqual(validator.validate({"flag" : [1]}), ("/flag", "Must be one of [true]."))
+    
+    def test_enum_str_values(self):
+        "str enum values match decoded (unicode) JSON strings."
+        validator = webapi.ArgumentValidator([("order", webapi.EnumSchema(["asc", "desc", "\xc3\xa9t\xc3\xa9"]))])
+        self.assertEqual(validator.validate(webapi.json_codec.decode('{"order" : "asc"}')), None)
+        self.assertEqual(validator.validate(webapi.json_codec.decode('{"order" : "\xc3\xa9t\xc3\xa9"}')), None)
+        self.assertEqual(validator.validate({"order" : u"up"}),
+                         ("/order", 'Must be one of ["asc", "desc", "\\u00e9t\\u00e9"].'))
+        
+        validator = webapi.ArgumentValidator([("count", webapi.EnumSchema([1, 2]))])
+        self.assertEqual(validator.validate({"count" : 2.0}), None)
+        self.assertEqual(validator.validate({"count" : True}), ("/count", "Must be one of [1, 2]."))
+    
+    def test_error_order(self):
+        "Errors are reported in arg_list order across plain & schema arguments."
+        validator = webapi.ArgumentValidator([("a", webapi.ArraySchema(int)), ("b", unicode)])
+        self.assertEqual(validator.validate({"a" : [u"x"]}), ("/a/0", "Must be of type int"))
+        self.assertEqual(validator.validate({"a" : [1], "b" : 1}), ("b", "Must be of type unicode"))
+    
+    def test_json_pointer_escaping(self):
+        "JSON pointer segments are escaped."
+        self.assertEqual(webapi.json_pointer(["a/b", "c~d", 0]), "/a~1b/c~0d/0")
+    
+    def test_invalid_schemas(self):
+        "Invalid schema definitions are rejected at definition time."
+        self.assertRaises(Exception, webapi.ObjectSchema, ("id", int))
+        self.assertRaises(Exception, webapi.ObjectSchema, [("id",)])
+        self.assertRaises(Exception, webapi.EnumSchema, [])
+    
+    def test_json_arguments(self):
+        "json_arguments returns a webapi.ValueError naming the JSON pointer."
+        outer_wrap = webapi.json_arguments([("items", webapi.ArraySchema(webapi.ObjectSchema([("id", int)])))])
+        inner_wrap = outer_wrap(JSONArgumentsTestCase.dummy_render_func.im_func)
+        test_request = DummyRequest()
+        test_request.setHeader("Content-Type", "application/json; charset=utf-8")
+        test_request.write(json.dumps({"items" : [{"id" : 1}, {"id" : u"2"}]}))
+        self.assertEqual(str(webapi.ValueError(test_request, "/items/1/id", "Must be of type int")),
+                         inner_wrap(self, test_request))
+
+class ContentTypeTestCase(unittest.TestCase):
+    
+    # (raw Content-Type header, (media_type, charset))
+    PARSE_TABLE = [("application/json; charset=utf-8", ("application/json", "utf-8")),
+                   ("application/json;charset=utf-8", ("application/json", "utf-8")),
+                   ("Application/JSON; Charset=UTF-8", ("application/json", "utf-8")),
+                   (" application/json ;  charset = utf-8 ", ("application/json", "utf-8")),
+                   ('application/json; charset="utf-8"', ("application/json", "utf-8")),
+                   ("application/json; version=2; charset=utf-8", ("application/json", "utf-8")),
+                   ('application/json; boundary="a;charset=latin1"; charset=utf-8', ("application/json", "utf-8")),
+                   ("application/json; charset=iso-8859-1", ("application/json", "iso-8859-1")),
+                   ("application/json", ("application/json", None)),
+                   ("application/json;", ("application/json", None)),
+                   ("application/json; charset", ("application/json", None)),
+                   ("", ("", None))]
+    
+    # (raw Content-Type header, expected error class or None)
+    CHECK_TABLE = [(None, webapi.ContentTypeError),
+                   ("application/json; charset=utf-8", None),
+                   ("APPLICATION/JSON; CHARSET=UTF-8", None),
+                   ("application/json; version=2; charset=utf-8", None),
+                   ("application/json", webapi.CharsetNotUTF8Error),
+                   ("application/json; charset=latin1", webapi.CharsetNotUTF8Error),
+                   ("text/plain; charset=utf-8", webapi.ContentTypeError),
+                   ("text/plain", webapi.CharsetNotUTF8Error)]
+    
+    def setUp(self):
+        webapi.content_type_cache.clear()
+    
+    def tearDown(self):
+        webapi.content_type_cache.clear()
+    
+    def test_parse_table(self):
+        "parse_content_type matches the conformance table."
+        for raw_content_type, parsed in self.PARSE_TABLE:
+            self.assertEqual(parsed, webapi.parse_content_type(raw_content_type), raw_content_type)
+    
+    def test_parse_memoized(self):
+        "Parsed headers are cached on the raw header value."
+        parsed = webapi.parse_content_type("application/json; charset=utf-8")
+        self.assertIdentical(parsed, webapi.content_type_cache.get("application/json; charset=utf-8"))
+        self.assertIdentical(parsed, webapi.parse_content_type("application/json; charset=utf-8"))
+    
+    def test_parse_cache_bounded(self):
+        "Content-Type cache holds CONTENT_TYPE_CACHE_SIZE headers and keeps memoizing new ones."
+        for i in range(webapi.CONTENT_TYPE_CACHE_SIZE + 10):
+            webapi.parse_content_type("application/x-%d; charset=utf-8" % i)
+        self.assertEqual(webapi.CONTENT_TYPE_CACHE_SIZE, len(webapi.content_type_cache))
+        parsed = webapi.parse_content_type("application/json; charset=utf-8")
+        self.assertIdentical(parsed, webapi.parse_content_type("application/json; charset=utf-8"))
+    
+    def test_check_table(self):
+        "json_arguments & url_arguments return the same Content-Type errors."
+        json_wrap = webapi.json_arguments([])(JSONArgumentsTestCase.dummy_render_func.im_func)
+        url_wrap = webapi.url_arguments([], content_type="application/json")(URLArgumentsTestCase.dummy_render_func.im_func)
+        for raw_content_type, error_class in self.CHECK_TABLE:
+            for wrapped_func in (json_wrap, url_wrap):
+                test_request = DummyRequest()
+                if raw_content_type != None:
+                    test_request.setHeader("Content-Type", raw_content_type)
+                test_request.write("{}")
+                if error_class == None:
+                    self.assertEqual("okey dokey", wrapped_func(self, test_request), raw_content_type)
+                else:
+                    self.assertEqual(str(error_class(test_request)), wrapped_func(self, test_request), raw_content_type)
 
 class PagedResultsTestCase(unittest.TestCase):
     
@@ -288,6 +574,111 @@ class PagedResultsTestCase(unittest.TestCase):
         self.assertEqual(res,
                          str(webapi.ValueError(test_request, "page_len", "Argument must be 500 or less.")))
 
+class PagedResultsCursorTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.saved_secrets = (auth.cookie_secrets, signing.secrets, signing.hmacs)
+        auth.install_secure_cookies(["supersecret"])
+        self.scope = webapi.cursor_scope(self)
+    
+    def tearDown(self):
+        auth.cookie_secrets, signing.secrets, signing.hmacs = self.saved_secrets
+    
+    @webapi.paged_results(default_page_len=25,max_page_len=100,cursor=True)
+    def dummy_render_func(self, request):
+        "Dummy render function"
+        return (request.cursor, request.page_len)
+    
+    def make_cursor(self, position):
+        "Mints a cursor the way a render function wrapped by paged_results would."
+        test_request = DummyRequest()
+        test_request.cursor_scope = self.scope
+        return webapi.make_cursor(test_request, position)
+    
+    def invalid_cursor_error(self):
+        return str(webapi.ValueError(DummyRequest(), "cursor", "Argument must be a cursor returned by this API."))
+    
+    def test_first_page(self):
+        "No cursor argument gives a None cursor and the default page_len."
+        test_request = DummyRequest()
+        self.assertEqual((None, 25), self.dummy_render_func(test_request))
+        self.assertFalse(test_request.args.has_key("page"))
+        self.assertEqual(self.scope, test_request.cursor_scope)
+    
+    def test_cursor_round_trip(self):
+        "Cursors decode to the typed position they were minted with."
+        position = [1451606400, u"user_\u4e2d", 42.5]
+        test_request = DummyRequest()
+        test_request.args["cursor"] = [self.make_cursor(position)]
+        test_request.args["page_len"] = ["10"]
+        self.assertEqual((position, 10), self.dummy_render_func(test_request))
+    
+    def test_cursor_url_safe(self):
+        "Cursors don't need escaping in a URL query string."
+        cursor = self.make_cursor({"id" : "?>>>&"})
+        self.assertEqual(cursor, urllib.quote(cursor))
+    
+    def test_rotated_secret(self):
+        "Cursors signed with a secondary secret are still accepted."
+        cursor = self.make_cursor(7)
+        auth.install_secure_cookies(["newsecret", "supersecret"])
+        self.assertEqual(7, webapi.read_cursor(cursor, self.scope))
+        self.assertNotEqual(cursor, self.make_cursor(7))
+    
+    def test_invalid_cursors(self):
+        "Tampered, unsigned & garbage cursors are rejected."
+        cursor = self.make_cursor([10, 20])
+        payload, signature = cursor.split(".")
+        forged_payload = base64.urlsafe_b64encode("[%d,[10,21]]" % time.time()).rstrip("=")
+        for bad_cursor in ["", "garbage", payload, "%s.%s" % (forged_payload, signature),
+                           "%s.%s" % (payload, "0" * len(signature)), cursor + "0"]:
+            test_request = DummyRequest()
+            test_request.args["cursor"] = [bad_cursor]
+            self.assertEqual(self.invalid_cursor_error(), self.dummy_render_func(test_request))
+    
+    def test_other_call_cursor(self):
+        "A cursor minted by one call isn't accepted by another."
+        class OtherCall(object):
+            pass
+        test_request = DummyRequest()
+        test_request.cursor_scope = webapi.cursor_scope(OtherCall())
+        test_request.args["cursor"] = [webapi.make_cursor(test_request, 7)]
+        self.assertEqual(self.invalid_cursor_error(), self.dummy_render_func(test_request))
+        self.assertTrue(webapi.read_cursor(test_request.args["cursor"][0], self.scope) is webapi.INVALID_CURSOR)
+    
+    def test_expired_cursor(self):
+        "Cursors are rejected once they're older than cursor_max_age."
+        now = time.time()
+        cursor = self.make_cursor(7)
+        self.patch(webapi.time, "time", lambda: now + webapi.CURSOR_MAX_AGE - 10)
+        self.assertEqual(7, webapi.read_cursor(cursor, self.scope))
+        self.patch(webapi.time, "time", lambda: now + webapi.CURSOR_MAX_AGE + 10)
+        test_request = DummyRequest()
+        test_request.args["cursor"] = [cursor]
+        self.assertEqual(self.invalid_cursor_error(), self.dummy_render_func(test_request))
+        self.assertEqual(7, webapi.read_cursor(cursor, self.scope, max_age=0))
+        self.assertRaises(Exception, webapi.paged_results, cursor=True, cursor_max_age=-1)
+    
+    def test_cookie_signature_not_cursor(self):
+        "A secure cookie signature can't be replayed as a cursor."
+        payload = base64.urlsafe_b64encode("[%d,1]" % time.time()).rstrip("=")
+        self.assertTrue(webapi.read_cursor("%s.%s" % (payload, signing.sign(payload)),
+                                           self.scope) is webapi.INVALID_CURSOR)
+    
+    def test_page_len_still_validated(self):
+        "page_len is validated in cursor mode."
+        test_request = DummyRequest()
+        test_request.args["page_len"] = ["101"]
+        self.assertEqual(str(webapi.ValueError(test_request, "page_len", "Argument must be 100 or less.")),
+                         self.dummy_render_func(test_request))
+    
+    def test_no_scope_or_secrets(self):
+        "Minting a cursor outside a cursor call or without secure cookie secrets is an error."
+        self.assertRaises(Exception, webapi.make_cursor, DummyRequest(), 1)
+        signing.secrets = signing.hmacs = None
+        self.assertRaises(Exception, self.make_cursor, 1)
+        self.assertRaises(Exception, webapi.read_cursor, "abc.def", self.scope)
+
 class URLArgumentsTestCase(unittest.TestCase):
     
     def dummy_render_func(self, request):
@@ -418,6 +809,631 @@ class WriteJSONTestCase(unittest.TestCase):
         self.assertEquals(test_request.getAllHeaders()["Content-Length"], len(json.dumps(test_obj)))
         self.assertEquals(test_request.content.getvalue(), json.dumps(test_obj))
 
+    def test_write_json_non_ascii(self):
+        "Validate write_json outputs UTF-8 & sets content length in bytes"
+
+        test_request = DummyRequest()
+        webapi.write_json(test_request, {"name": u"caf\xe9"})
+
+        self.assertEquals(test_request.content.getvalue(), '{"name": "caf\xc3\xa9"}')
+        self.assertEquals(test_request.getAllHeaders()["Content-Length"], 17)
+
+class ConditionalGetTestCase(unittest.TestCase):
+    
+    body = json.dumps({"entries" : range(10)})
+    
+    def setUp(self):
+        self.render_calls = 0
+    
+    def version_func(self, request):
+        "Cheap version token"
+        return "rev-42"
+    
+    @webapi.conditional_get()
+    def hashed_render_func(self, request):
+        "Dummy render function"
+        self.render_calls += 1
+        return self.body
+    
+    @webapi.conditional_get(version=version_func)
+    def versioned_render_func(self, request):
+        "Dummy render function"
+        self.render_calls += 1
+        return self.body
+    
+    @webapi.conditional_get(version=lambda self, request: defer.succeed(42))
+    def async_versioned_render_func(self, request):
+        "Dummy render function"
+        self.render_calls += 1
+        return defer.succeed(self.body)
+    
+    @webapi.conditional_get()
+    def error_render_func(self, request):
+        "Dummy render function"
+        return str(webapi.ValueError(request, "entries", "Bad entries."))
+    
+    def test_make_etag(self):
+        "Version tokens are quoted as-is unless they contain invalid characters."
+        self.assertEqual('"rev-42"', webapi.make_etag(version="rev-42"))
+        self.assertEqual('"42"', webapi.make_etag(version=42))
+        self.assertEqual('"%s"' % hashlib.sha1('a "b"').hexdigest(), webapi.make_etag(version='a "b"'))
+        self.assertEqual('"%s"' % hashlib.sha1(self.body).hexdigest(), webapi.make_etag(body=self.body))
+    
+    def test_etag_matches(self):
+        "If-None-Match lists, wildcards & weak tags use weak comparison."
+        for if_none_match, matches in [(None, False), ('"abc"', True), ('W/"abc"', True), ("*", True),
+                                       ('"xyz", W/"abc"', True), ('"xyz","abcd"', False), ("abc", False)]:
+            test_request = DummyRequest()
+            if if_none_match != None:
+                test_request.setHeader("If-None-Match", if_none_match)
+            self.assertEqual(matches, webapi.etag_matches(test_request, '"abc"'), if_none_match)
+    
+    def test_hashed_etag(self):
+        "Rendered bodies are hashed into the ETag and a matching request gets a finished 304."
+        test_request = DummyRequest()
+        first_body = self.hashed_render_func(test_request)
+        etag = test_request.getHeader("ETag")
+        self.assertEqual(self.body, first_body)
+        self.assertEqual(webapi.make_etag(body=self.body), etag)
+        
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", etag)
+        self.assertEqual(NOT_DONE_YET, self.hashed_render_func(test_request))
+        self.assertEqual((304, 1), (test_request.response_code, test_request.finished))
+        self.assertEqual(etag, test_request.getHeader("ETag"))
+    
+    def test_version_etag_skips_render(self):
+        "A matching version token answers with a 304 without rendering."
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", '"rev-42"')
+        self.assertEqual(NOT_DONE_YET, self.versioned_render_func(test_request))
+        self.assertEqual((304, 1), (test_request.response_code, test_request.finished))
+        self.assertEqual(0, self.render_calls)
+        
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", '"rev-41"')
+        self.assertEqual(self.body, self.versioned_render_func(test_request))
+        self.assertEqual(200, test_request.response_code)
+        self.assertEqual('"rev-42"', test_request.getHeader("ETag"))
+        self.assertEqual(1, self.render_calls)
+    
+    def test_deferred_version(self):
+        "Version functions may return a Deferred."
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", '"42"')
+        self.assertEqual(NOT_DONE_YET, self.successResultOf(self.async_versioned_render_func(test_request)))
+        self.assertEqual((304, 1), (test_request.response_code, test_request.finished))
+        self.assertEqual(0, self.render_calls)
+        
+        test_request = DummyRequest()
+        self.assertEqual(self.body, self.successResultOf(self.async_versioned_render_func(test_request)))
+        self.assertEqual(1, self.render_calls)
+    
+    def test_errors_not_tagged(self):
+        "Error responses don't get an ETag."
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", "*")
+        self.assertEqual(str(webapi.ValueError(test_request, "entries", "Bad entries.")), self.error_render_func(test_request))
+        self.assertEqual(409, test_request.response_code)
+        self.assertEqual(None, test_request.getHeader("ETag"))
+    
+    def test_post_not_modified(self):
+        "Only GET & HEAD requests are answered with a 304."
+        test_request = DummyRequest(method="POST")
+        test_request.setHeader("If-None-Match", '"rev-42"')
+        self.assertEqual(self.body, self.versioned_render_func(test_request))
+        self.assertEqual(200, test_request.response_code)
+    
+    def test_write_json_etag(self):
+        "write_json skips the body & Content-Length on a 304."
+        etag = webapi.make_etag(body=json.dumps({"a" : 1}))
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", etag)
+        webapi.write_json(test_request, {"a" : 1}, etag=True)
+        self.assertEqual(304, test_request.response_code)
+        self.assertEqual("", test_request.content.getvalue())
+        self.assertEqual(None, test_request.getHeader("Content-Length"))
+        
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", '"other"')
+        webapi.write_json(test_request, {"a" : 1}, etag='"v1"')
+        self.assertEqual(200, test_request.response_code)
+        self.assertEqual('"v1"', test_request.getHeader("ETag"))
+        self.assertEqual(json.dumps({"a" : 1}), test_request.content.getvalue())
+    
+    def test_write_json_hashed_by_default(self):
+        "write_json hashes successful output in calls wrapped by conditional_get()."
+        @webapi.conditional_get()
+        def render_func(self, request):
+            webapi.write_json(request, {"a" : 1})
+        
+        etag = webapi.make_etag(body=json.dumps({"a" : 1}))
+        test_request = DummyRequest()
+        self.assertEqual(None, render_func(self, test_request))
+        self.assertEqual(etag, test_request.getHeader("ETag"))
+        
+        test_request = DummyRequest()
+        test_request.setHeader("If-None-Match", etag)
+        self.assertEqual(None, render_func(self, test_request))
+        self.assertEqual((304, ""), (test_request.response_code, test_request.content.getvalue()))
+        
+        # Outside conditional_get() & for errors nothing is hashed
+        test_request = DummyRequest()
+        webapi.write_json(test_request, {"a" : 1})
+        test_request.etag_body = True
+        test_request.setResponseCode(409)
+        webapi.write_json(test_request, {"a" : 1})
+        self.assertEqual(None, test_request.getHeader("ETag"))
+
+class GrantingBackend(base_backend.AuthBackend):
+    "Backend that grants read in every namespace."
+    def __init__(self):
+        pass
+    
+    def authenticate(self, request):
+        return defer.succeed({"digitar.com" : ["read"]})
+
+class ConditionalGetSiteTestCase(unittest.TestCase):
+    "Conditional GETs served through a real twisted.web Site."
+    
+    body = json.dumps({"entries" : range(10)})
+    etag = webapi.make_etag(body=json.dumps({"entries" : range(10)}))
+    
+    def setUp(self):
+        auth.install_auth(GrantingBackend(), cache_size=0)
+    
+    def tearDown(self):
+        auth.auth_backend = None
+        auth.auth_cache = None
+    
+    def serve(self, render_func, if_none_match=None):
+        "Serves one GET with render_func as a call's render_GET."
+        class Call(urldispatch.URLMatchJSONResource):
+            render_GET = render_func
+        headers = {}
+        if if_none_match != None:
+            headers["If-None-Match"] = if_none_match
+        return site_request(Call(None, url_matches={}), uri="/call?domain=digitar.com", headers=headers)
+    
+    def assertConditional(self, render_func, etag):
+        "Validates a 200 with etag, then a bodyless 304 for a client holding it."
+        code, headers, body = self.serve(render_func)
+        self.assertEqual((200, etag, self.body), (code, headers.get("etag"), body))
+        
+        code, headers, body = self.serve(render_func, etag)
+        self.assertEqual((304, etag, ""), (code, headers.get("etag"), body))
+        self.assertFalse(headers.has_key("content-length"))
+    
+    def test_write_json_etag(self):
+        "write_json(etag=...) handlers that return None get a real 304."
+        def render_func(self, request):
+            webapi.write_json(request, {"entries" : range(10)}, etag=True)
+        self.assertConditional(render_func, self.etag)
+    
+    def test_write_json_no_error_page(self):
+        "write_json handlers that return None send only their JSON."
+        def render_func(self, request):
+            webapi.write_json(request, {"entries" : range(10)})
+        self.assertEqual((200, self.body), self.serve(render_func)[::2])
+    
+    def test_hashed(self):
+        "conditional_get() hashes returned & write_json bodies."
+        @webapi.conditional_get()
+        def returned(self, request):
+            return ConditionalGetSiteTestCase.body
+        self.assertConditional(returned, self.etag)
+        
+        @webapi.conditional_get()
+        def written(self, request):
+            webapi.write_json(request, {"entries" : range(10)})
+        self.assertConditional(written, self.etag)
+    
+    def test_version(self):
+        "conditional_get(version) answers sync & Deferred version tokens."
+        @webapi.conditional_get(version=lambda self, request: "rev-1")
+        def sync_version(self, request):
+            return ConditionalGetSiteTestCase.body
+        self.assertConditional(sync_version, '"rev-1"')
+        
+        @webapi.conditional_get(version=lambda self, request: defer.succeed("rev-2"))
+        def deferred_version(self, request):
+            webapi.write_json(request, {"entries" : range(10)})
+        self.assertConditional(deferred_version, '"rev-2"')
+    
+    def test_outside_access(self):
+        "conditional_get wrapping auth.access."
+        @webapi.conditional_get(version=lambda self, request: "rev-1")
+        @auth.access("domain", False, "read")
+        def sync_version(self, request):
+            return ConditionalGetSiteTestCase.body
+        self.assertConditional(sync_version, '"rev-1"')
+        
+        @webapi.conditional_get(version=lambda self, request: defer.succeed("rev-2"))
+        @auth.access("domain", False, "read")
+        def deferred_version(self, request):
+            return ConditionalGetSiteTestCase.body
+        self.assertConditional(deferred_version, '"rev-2"')
+        
+        @webapi.conditional_get()
+        @auth.access("domain", False, "read")
+        def written(self, request):
+            webapi.write_json(request, {"entries" : range(10)})
+        self.assertConditional(written, self.etag)
+    
+    def test_inside_access(self):
+        "auth.access wrapping conditional_get."
+        @auth.access("domain", False, "read")
+        @webapi.conditional_get()
+        def returned(self, request):
+            return ConditionalGetSiteTestCase.body
+        self.assertConditional(returned, self.etag)
+        
+        @auth.access("domain", False, "read")
+        @webapi.conditional_get()
+        def written(self, request):
+            webapi.write_json(request, {"entries" : range(10)})
+        self.assertConditional(written, self.etag)
+        
+        @auth.access("domain", False, "read")
+        @webapi.conditional_get(version=lambda self, request: defer.succeed("rev-2"))
+        def deferred_version(self, request):
+            return defer.succeed(ConditionalGetSiteTestCase.body)
+        self.assertConditional(deferred_version, '"rev-2"')
+
+class WriteJSONStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.request = DummyRequest()
+        self.consumed = 0
+
+    def counted_items(self, count):
+        "Generator that records how many items have been consumed."
+        for i in range(count):
+            self.consumed = self.consumed + 1
+            yield {"id" : i, "name" : u"item %d" % i}
+
+    def drain(self):
+        "Pulls from the registered producer until it unregisters."
+        while self.request.producer != None:
+            self.request.producer.resumeProducing()
+
+    def test_stream_matches_write_json(self):
+        "Validate the streamed array is identical to write_json's output"
+        items = list(self.counted_items(25))
+        d = webapi.write_json_stream(self.request, iter(items), batch_size=10)
+        self.drain()
+
+        expected_request = DummyRequest()
+        webapi.write_json(expected_request, items)
+        self.assertEquals(self.request.content.getvalue(), expected_request.content.getvalue())
+        self.assertEquals(self.request.getHeader("Content-Length"), None)
+        self.assertTrue(d.called)
+
+    def test_stream_empty(self):
+        "Validate an empty iterable streams an empty array"
+        webapi.write_json_stream(self.request, [])
+        self.drain()
+        self.assertEquals(self.request.content.getvalue(), "[]")
+
+    def test_stream_exact_batches(self):
+        "Validate item counts that are a multiple of batch_size close the array"
+        webapi.write_json_stream(self.request, range(4), batch_size=2)
+        self.drain()
+        self.assertEquals(self.request.content.getvalue(), "[0, 1, 2, 3]")
+
+    def test_stream_lazy(self):
+        "Validate items are only consumed as the transport pulls data"
+        webapi.write_json_stream(self.request, self.counted_items(1000), batch_size=10)
+        self.assertEquals(self.consumed, 0)
+        self.request.producer.resumeProducing()
+        self.assertEquals(self.consumed, 10)
+        self.request.producer.resumeProducing()
+        self.assertEquals(self.consumed, 20)
+
+    def test_stop_producing(self):
+        "Validate a disconnect stops consuming & closes the iterable"
+        items = self.counted_items(1000)
+        d = webapi.write_json_stream(self.request, items, batch_size=10)
+        producer = self.request.producer
+        producer.resumeProducing()
+        producer.stopProducing()
+        producer.resumeProducing()
+        self.assertEquals(self.consumed, 10)
+        self.assertRaises(StopIteration, items.next)
+        self.assertFalse(d.called)
+
+    def failing_items(self, fail_at):
+        for i in range(fail_at):
+            yield i
+        raise Exception("cursor went away")
+
+    def test_fail_before_write(self):
+        "Validate an iterable failing before anything is written fails the deferred"
+        d = webapi.write_json_stream(self.request, self.failing_items(0))
+        self.request.producer.resumeProducing()
+        self.assertEquals(self.request.producer, None)
+        self.assertEquals(self.request.content.getvalue(), "")
+        return self.assertFailure(d, Exception)
+
+    def test_fail_mid_stream(self):
+        "Validate an iterable failing mid-stream drops the connection"
+        transport = DummyChannel.TCP()
+        self.request.transport = transport
+        log_lines = []
+        self.patch(log, "logger", log.Logger(writer=log_lines.extend))
+        d = webapi.write_json_stream(self.request, self.failing_items(5), batch_size=2)
+        self.drain()
+        self.assertEquals(self.request.content.getvalue(), "[0, 1, 2, 3")
+        self.assertTrue(transport.disconnected)
+        self.assertFalse(d.called)
+        self.assertTrue("cursor went away" in log_lines[0])
+
+    def test_chunked_response(self):
+        "Validate HTTP/1.1 responses are streamed with chunked transfer encoding"
+        channel = DummyChannel()
+        channel.transport.unregisterProducer = lambda: None
+        request = foundation.ShijiRequest(channel, False)
+        request.gotLength(0)
+        request.clientproto = "HTTP/1.1"
+        request.method = "GET"
+
+        d = webapi.write_json_stream(request, range(3), batch_size=2)
+        producer, streaming = channel.transport.producers[0]
+        self.assertFalse(streaming)
+        producer.resumeProducing()
+        producer.resumeProducing()
+        self.assertTrue(d.called)
+        request.finish()
+
+        written = channel.transport.written.getvalue()
+        headers, body = written.split("\r\n\r\n", 1)
+        self.assertTrue("Transfer-Encoding: chunked" in headers)
+        self.assertEquals(body, "5\r\n[0, 1\r\n4\r\n, 2]\r\n0\r\n\r\n")
+
+class CompressionTestCase(unittest.TestCase):
+    
+    body_obj = [{"id" : i, "name" : "user%d" % i} for i in range(100)]
+    
+    def make_request(self, accept_encoding="gzip", min_size=1024):
+        "Builds a request with the compression encoder installed as twisted.web.server would."
+        self.channel = DummyChannel()
+        self.channel.transport.unregisterProducer = lambda: None
+        request = foundation.ShijiRequest(self.channel, False)
+        request.gotLength(0)
+        request.clientproto = "HTTP/1.1"
+        request.method = "GET"
+        if accept_encoding != None:
+            request.requestHeaders.setRawHeaders("accept-encoding", [accept_encoding])
+        request._encoder = webapi.CompressionEncoderFactory(min_size=min_size).encoderForRequest(request)
+        return request
+    
+    def response(self, request):
+        "Returns the (headers, body) written to the transport, with chunking removed."
+        headers, body = self.channel.transport.written.getvalue().split("\r\n\r\n", 1)
+        if "Transfer-Encoding: chunked" in headers:
+            chunks = []
+            while True:
+                length, body = body.split("\r\n", 1)
+                if int(length, 16) == 0:
+                    break
+                chunks.append(body[:int(length, 16)])
+                body = body[int(length, 16) + 2:]
+            body = "".join(chunks)
+        return headers, body
+    
+    def test_factory_arguments(self):
+        "Validate compression level and minimum size are range checked"
+        self.assertRaises(Exception, webapi.CompressionEncoderFactory, -1, 6)
+        self.assertRaises(Exception, webapi.CompressionEncoderFactory, 1024, 0)
+        self.assertRaises(Exception, webapi.CompressionEncoderFactory, 1024, 10)
+    
+    def test_negotiation(self):
+        "Validate content-coding negotiation honors q-values and prefers gzip"
+        for accept_encoding, encoding in [(None, None), ("identity", None), ("gzip", "gzip"),
+                                          ("deflate", "deflate"), ("deflate, gzip", "gzip"),
+                                          ("gzip;q=0.5, deflate", "deflate"), ("gzip;q=0", None),
+                                          ("*", "gzip"), ("br, GZIP", "gzip")]:
+            request = self.make_request(accept_encoding)
+            self.assertEquals(getattr(request._encoder, "encoding", None), encoding, accept_encoding)
+            self.assertEquals(request.responseHeaders.getRawHeaders("vary"), ["Accept-Encoding"])
+    
+    def test_vary_merged(self):
+        "Validate an existing Vary header is extended rather than replaced"
+        request = self.make_request(None)
+        request.responseHeaders.setRawHeaders("vary", ["Origin"])
+        webapi.CompressionEncoderFactory().encoderForRequest(request)
+        webapi.CompressionEncoderFactory().encoderForRequest(request)
+        self.assertEquals(request.responseHeaders.getRawHeaders("vary"), ["Origin", "Accept-Encoding"])
+    
+    def test_gzip_write_json(self):
+        "Validate large write_json responses are gzipped without a Content-Length"
+        request = self.make_request("gzip")
+        webapi.write_json(request, self.body_obj)
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertTrue("Content-Encoding: gzip" in headers)
+        self.assertFalse("Content-Length" in headers)
+        self.assertEquals(zlib.decompress(body, 16 + zlib.MAX_WBITS), json.dumps(self.body_obj))
+    
+    def test_deflate_write_json(self):
+        "Validate deflate responses use zlib framing"
+        request = self.make_request("deflate")
+        webapi.write_json(request, self.body_obj)
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertTrue("Content-Encoding: deflate" in headers)
+        self.assertEquals(zlib.decompress(body), json.dumps(self.body_obj))
+    
+    def test_below_min_size(self):
+        "Validate responses below the minimum size are sent as-is"
+        request = self.make_request("gzip")
+        webapi.write_json(request, {"a" : 1})
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertFalse("Content-Encoding" in headers)
+        self.assertTrue("Content-Length: 8" in headers)
+        self.assertTrue("Vary: Accept-Encoding" in headers)
+        self.assertEquals(body, '{"a": 1}')
+    
+    def test_not_modified_uncompressed(self):
+        "Validate 304 responses aren't given a Content-Encoding"
+        request = self.make_request("gzip", min_size=0)
+        request.setResponseCode(304)
+        request.write("")
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertFalse("Content-Encoding" in headers)
+        self.assertEquals(body, "")
+    
+    def test_etag_coding_suffix(self):
+        "Validate compressed responses get a distinct strong ETag that still revalidates"
+        request = self.make_request("gzip")
+        webapi.write_json(request, self.body_obj, etag='"v1"')
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertTrue('ETag: "v1-gzip"' in headers)
+        
+        request = self.make_request("gzip")
+        request.requestHeaders.setRawHeaders("if-none-match", ['"v1-gzip"'])
+        webapi.write_json(request, self.body_obj, etag='"v1"')
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertTrue(headers.startswith("HTTP/1.1 304"))
+        self.assertTrue('ETag: "v1-gzip"' in headers)
+        self.assertEquals(body, "")
+    
+    def serve(self, method="GET", headers={}):
+        "Serves write_json(body_obj) with a hashed ETag through a real Site, gzip accepted."
+        body_obj = self.body_obj
+        class Call(urldispatch.URLMatchJSONResource):
+            def render_GET(self, request):
+                webapi.write_json(request, body_obj, etag=True)
+            def getEncoder(self, request):
+                return webapi.CompressionEncoderFactory().encoderForRequest(request)
+        request_headers = {"Accept-Encoding" : "gzip"}
+        request_headers.update(headers)
+        return site_request(Call(None, url_matches={}), method=method, headers=request_headers)
+    
+    def test_etag_revalidated_through_site(self):
+        "Validate the 200, its 304 and HEAD carry the same ETag"
+        code, headers, body = self.serve()
+        etag = headers["etag"]
+        self.assertEquals((200, "gzip"), (code, headers["content-encoding"]))
+        self.assertEquals(webapi.make_etag(body=json.dumps(self.body_obj))[:-1] + '-gzip"', etag)
+        self.assertEquals(zlib.decompress(body, 16 + zlib.MAX_WBITS), json.dumps(self.body_obj))
+        
+        code, not_modified_headers, body = self.serve(headers={"If-None-Match" : etag})
+        self.assertEquals((304, etag, ""), (code, not_modified_headers["etag"], body))
+        
+        code, head_headers, body = self.serve("HEAD")
+        self.assertEquals((200, ""), (code, body))
+        for name in ("etag", "content-encoding", "content-length"):
+            self.assertEquals(headers.get(name), head_headers.get(name), name)
+    
+    def test_streamed_response(self):
+        "Validate streamed responses are compressed and every batch produces output"
+        request = self.make_request("gzip")
+        d = webapi.write_json_stream(request, range(1000), batch_size=100)
+        producer, streaming = self.channel.transport.producers[0]
+        written_len = len(self.channel.transport.written.getvalue())
+        while not d.called:
+            producer.resumeProducing()
+            self.assertTrue(len(self.channel.transport.written.getvalue()) > written_len)
+            written_len = len(self.channel.transport.written.getvalue())
+        request.finish()
+        
+        headers, body = self.response(request)
+        self.assertTrue("Content-Encoding: gzip" in headers)
+        self.assertEquals(zlib.decompress(body, 16 + zlib.MAX_WBITS), json.dumps(range(1000)))
+
+class JSONCodecTestCase(unittest.TestCase):
+
+    test_vectors = [{"test_key": "test_value"},
+                    {"result" : None,
+                     "error" : {"error_code" : 502,
+                                "exception_class" : "ValueError",
+                                "exception_text" : u"Invalid value for argument 'caf\xe9'."}},
+                    [1, 2.5, 0.1, 1e100, 10**20, -3, True, False, None, "a/b", u"\u4e2d\n\"\\"],
+                    {}, [], u"", 0]
+
+    def tearDown(self):
+        webapi.install_json_codec("json")
+
+    def test_stdlib_encode(self):
+        "Validate the stdlib codec matches json.dumps encoded as UTF-8"
+        codec = webapi.json_codecs["json"]
+        for vector in self.test_vectors:
+            self.assertEquals(codec.encode(vector),
+                              json.dumps(vector, ensure_ascii=False).encode("utf-8"))
+
+    def test_codecs_identical(self):
+        "Validate every registered codec encodes & decodes identically to the stdlib codec"
+        stdlib_codec = webapi.json_codecs["json"]
+        for codec in webapi.json_codecs.values():
+            for vector in self.test_vectors:
+                encoded = codec.encode(vector)
+                self.assertEquals(encoded, stdlib_codec.encode(vector))
+                self.assertEquals(repr(codec.decode(encoded)), repr(stdlib_codec.decode(encoded)))
+
+    def test_simplejson_identical(self):
+        "Validate the simplejson codec encodes & decodes identically to the stdlib codec"
+        if not webapi.json_codecs.has_key("simplejson"):
+            raise unittest.SkipTest("simplejson isn't installed, so SimpleJSONCodec isn't registered.")
+        
+        stdlib_codec = webapi.json_codecs["json"]
+        codec = webapi.json_codecs["simplejson"]
+        self.assertTrue(isinstance(codec, webapi.SimpleJSONCodec))
+        for vector in self.test_vectors:
+            encoded = codec.encode(vector)
+            self.assertEquals(encoded, stdlib_codec.encode(vector))
+            self.assertEquals(repr(codec.decode(encoded)), repr(stdlib_codec.decode(encoded)))
+    
+    def test_decode_unicode_strings(self):
+        "Validate decoded strings are unicode"
+        for codec in webapi.json_codecs.values():
+            decoded = codec.decode('{"a": "b", "c": "caf\xc3\xa9"}')
+            self.assertEquals(decoded, {u"a": u"b", u"c": u"caf\xe9"})
+            self.assertTrue(isinstance(decoded["a"], unicode))
+
+    def test_install_codec(self):
+        "Validate installing a codec selects it for write_json"
+
+        class UpperCodec(webapi.JSONCodec):
+            name = "upper"
+            def encode(self, obj):
+                return webapi.JSONCodec.encode(self, obj).upper()
+
+        self.assertTrue(webapi.register_json_codec(UpperCodec))
+        try:
+            webapi.install_json_codec("upper")
+            test_request = DummyRequest()
+            webapi.write_json(test_request, {"a": "b"})
+            self.assertEquals(test_request.content.getvalue(), '{"A": "B"}')
+        finally:
+            del webapi.json_codecs["upper"]
+
+    def test_install_unknown_codec(self):
+        "Validate installing an unavailable codec fails"
+        self.assertRaises(Exception, webapi.install_json_codec, "no_such_codec")
+        self.assertEquals(webapi.json_codec, webapi.json_codecs["json"])
+
+    def test_register_unavailable_codec(self):
+        "Validate codecs whose backend can't be imported aren't registered"
+
+        class MissingCodec(webapi.JSONCodec):
+            name = "missing"
+            def __init__(self):
+                import no_such_json_module
+
+        self.assertFalse(webapi.register_json_codec(MissingCodec))
+        self.assertFalse(webapi.json_codecs.has_key("missing"))
+
 class APIErrorsTestCase(unittest.TestCase):
     "Validate APIError"
     
@@ -562,6 +1578,49 @@ class APIErrorsTestCase(unittest.TestCase):
         self.assertEquals(obj_error.exception_text , "Request body must be a JSON-encoded hash table/dictionary.")
         self.assertEquals(request.response_code , 409)
 
+    def test_constant_error_body_cached(self):
+        "Validate errors with class-fixed payloads are serialized once per class"
+        webapi.error_body_cache.clear()
+        first_body = str(webapi.ContentTypeError(DummyRequest()))
+        self.assertEquals(webapi.error_body_cache.keys(), [webapi.ContentTypeError])
+        self.assertTrue(webapi.ContentTypeError(DummyRequest()).json_err() is first_body)
+        self.assertEquals(json.loads(first_body), webapi.ContentTypeError(DummyRequest()).obj_err())
+    
+    def test_parameterized_error_body_not_cached(self):
+        "Validate errors with per-instance payloads are serialized every time"
+        webapi.error_body_cache.clear()
+        self.assertTrue("'arg1'" in str(webapi.ValueError(DummyRequest(), "arg1", "Bad.")))
+        self.assertTrue("'arg2'" in str(webapi.ValueError(DummyRequest(), "arg2", "Bad.")))
+        self.assertTrue("CustomError" in str(webapi.APIError(DummyRequest(), 600, "CustomError", "Custom.")))
+        self.assertEquals(webapi.error_body_cache, {})
+    
+    def test_error_metric_name(self):
+        "Validate error metric names are precomputed per API & exception class"
+        webapi.error_metric_names.clear()
+        webapi.AccessDeniedError(DummyRequest(api_name="my_api"))
+        self.assertEquals(webapi.error_metric_names,
+                          {("my_api", "AccessDeniedError") : "my_api.error.AccessDeniedError"})
+        self.assertTrue(webapi.error_metric_name("my_api", "AccessDeniedError") is \
+                        webapi.error_metric_names[("my_api", "AccessDeniedError")])
+    
+    def test_error_metric_name_cache_bounded(self):
+        "Validate the error metric name cache stops growing at its size limit"
+        webapi.error_metric_names.clear()
+        self.patch(webapi, "ERROR_METRIC_CACHE_SIZE", 2)
+        for i in range(5):
+            self.assertEquals(webapi.error_metric_name("api%d" % i, "ValueError"), "api%d.error.ValueError" % i)
+        self.assertEquals(len(webapi.error_metric_names), 2)
+    
+    def test_request_too_large_error(self):
+        "Validate RequestTooLargeError"
+        request = DummyRequest()
+        obj_error = webapi.RequestTooLargeError(request, 1024)
+        
+        self.assertEquals(obj_error.error_code , 209)
+        self.assertEquals(obj_error.exception_class , "RequestTooLargeError")
+        self.assertEquals(obj_error.exception_text , "Request body exceeds the maximum allowed size of 1024 bytes.")
+        self.assertEquals(request.response_code , 413)
+    
     def test_access_denied_error(self):
         "Validate AccessDeniedError"
         request = DummyRequest()
@@ -20,6 +20,7 @@ from twisted.internet.defer import Deferred
 from twisted.internet import address
 from twisted.web.test.test_web import DummyChannel
 from twisted.web.http import parse_qs
+from twisted.test.proto_helpers import StringTransport
 from StringIO import StringIO
 from shiji import foundation
 import traceback
@@ -97,12 +98,60 @@ class DummyRequestNew(foundation.ShijiRequest):
         self.channel = DummyChannel()
         self.save_channel = self.channel
 
+def site_request(resource, method="GET", uri="/call", headers={}):
+    """Sends one HTTP/1.1 request through a real ShijiSite serving resource, so the
+    response is exactly what Twisted would put on the wire. The resource should answer
+    synchronously (or with Deferreds that have already fired).
+    
+    Arguments:
+        resource (Resource) - Root resource to serve (e.g. a URLMatchJSONResource).
+        method (string) - HTTP method.
+        uri (string) - Request URI (path & query string).
+        headers (dict) - Request headers.
+    
+    Returns:
+        Tuple of (code, headers, body). headers is a dictionary of lowercased header
+        names to values. Chunked bodies are decoded.
+    """
+    site = foundation.ShijiSite(resource, timeout=None)
+    channel = site.buildProtocol(address.IPv4Address("TCP", "127.0.0.1", 40323))
+    transport = StringTransport()
+    channel.makeConnection(transport)
+    
+    request_lines = ["%s %s HTTP/1.1" % (method, uri), "Host: localhost"]
+    for name, value in headers.items():
+        request_lines.append("%s: %s" % (name, value))
+    channel.dataReceived("\r\n".join(request_lines) + "\r\n\r\n")
+    channel.connectionLost(None)
+    
+    head, body = transport.value().split("\r\n\r\n", 1)
+    head_lines = head.split("\r\n")
+    response_headers = {}
+    for line in head_lines[1:]:
+        name, value = line.split(": ", 1)
+        response_headers[name.lower()] = value
+    
+    if response_headers.get("transfer-encoding") == "chunked":
+        chunks = []
+        while True:
+            size, body = body.split("\r\n", 1)
+            size = int(size, 16)
+            if size == 0:
+                break
+            chunks.append(body[:size])
+            body = body[size + 2:]
+        body = "".join(chunks)
+    
+    return (int(head_lines[0].split(" ")[1]), response_headers, body)
+
 # Dummy Classes
 class DummyRequest(object):
     """Dummy request object that imitates twisted.web.http.Request's
     interfaces."""
     
     finished = 0
+    producer = None
+    code = 200
     response_code = 200
     response_msg = None
     metrics = Metrics(FakeStatsDClient(), 'webprotectme.null')
@@ -218,9 +267,17 @@ class DummyRequest(object):
                 obs.callback(None)
     
     def setResponseCode(self, code, message=None):
+        self.code = code
         self.response_code = code
         self.response_msg = message
     
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+    
+    def unregisterProducer(self):
+        self.producer = None
+    
     def getUser(self):
         return self.user
     
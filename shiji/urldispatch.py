@@ -12,21 +12,45 @@
 # (C)2015 DigiTar Inc.
 # Licensed under the MIT License.
 ####################################################################
-import re, sys, inspect, urllib, traceback
+import re, sys, inspect, urllib, traceback, weakref, time, sre_parse, sre_constants
 try:
     import json
 except ImportError:
     import simplejson as json
-from twisted.web.resource import Resource
+from zope.interface import implementer
+from twisted.web.resource import Resource, _IEncodingResource
 from twisted.web.server import NOT_DONE_YET
+from twisted.web.error import UnsupportedMethod
+from twisted.python.reflect import prefixedMethodNames
 from twisted.internet import defer
-from shiji import webapi, stats, testutil
+from shiji import webapi, stats, testutil, log, lru
 
 API_VERSION_HEADER = "X-DigiTar-API-Version"
 
 ### Utility Functions
+# Parsed version headers keyed on the raw header value.
+VERSION_CACHE_SIZE = 256
+version_cache = lru.LRUCache(VERSION_CACHE_SIZE)
+
+def parse_version(raw_version):
+    """Parses a raw API version string (e.g. "myapi-1.0+prod") into a dictionary
+    of api, version and mode. Raises IndexError if raw_version is malformed."""
+    parsed_version = version_cache.get(raw_version)
+    if parsed_version != None:
+        return parsed_version
+    
+    version_parts = raw_version.split("-")
+    mode_parts = version_parts[1].split("+")
+    parsed_version = {"api" : version_parts[0].lower(),
+                      "version" : mode_parts[0],
+                      "mode" : mode_parts[1].lower()}
+    
+    version_cache.set(raw_version, parsed_version)
+    return parsed_version
+
 def get_version(request):
-    """Locates and parses the API version headers if present."""
+    """Locates and parses the API version headers if present. The result is
+    memoized on the request so the routing chain only parses it once."""
     raw_version = request.getHeader(API_VERSION_HEADER)
     
     if not raw_version and not request.args.has_key(API_VERSION_HEADER):
@@ -36,16 +60,373 @@ def get_version(request):
     elif not raw_version:
         raw_version = request.args[API_VERSION_HEADER][0]
     
-    api = raw_version.split("-")[0].lower()
-    version = raw_version.split("-")[1].split("+")[0]
-    mode = raw_version.split("-")[1].split("+")[1].lower()
+    memo = getattr(request, "parsed_version", None)
+    if memo != None and memo[0] == raw_version:
+        return memo[1]
+    
+    parsed_version = dict(parse_version(raw_version))
+    request.parsed_version = (raw_version, parsed_version)
+    return parsed_version
+
+
+### Route Compilation
+# Python 2's sre refuses patterns with 100 or more groups, so the combined
+# route regex is split into chunks that stay under the limit.
+MAX_GROUPS_PER_CHUNK = 99
+REGEX_METACHARS = frozenset(".^$*+?{}[]\\|()")
+RE_NAMED_GROUP = re.compile(r"\(\?P<([A-Za-z_][A-Za-z0-9_]*)>")
+RE_NAMED_BACKREF = re.compile(r"\(\?P=([A-Za-z_][A-Za-z0-9_]*)\)")
+RE_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?[iLmsux]")
+
+class FrozenDict(dict):
+    """dict that raises TypeError on any attempt to modify it after it's built."""
+    
+    def _frozen(self, *args, **kwargs):
+        raise TypeError("FrozenDict can't be modified.")
     
-    return {"api" : api,
-            "version" : version,
-            "mode" : mode}
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _frozen
+
+class CompiledRouteMap(object):
+    """
+    Single-pass dispatch structure built from an ordered route map.
+
+    Fully literal routes (e.g. r"ping") are resolved with one dictionary
+    lookup. All remaining routes are folded into alternation regexes where each
+    route is wrapped in a sentinel group, so a single regex evaluation finds
+    the first matching route. First-match-wins ordering is preserved across
+    both structures.
+
+    The table is frozen once built: attributes can't be reassigned, the
+    route map is stored as a tuple and the literal routes as a FrozenDict.
+    """
+
+    frozen = False
+
+    def __init__(self, route_map):
+        """Compiles the dispatch structure.
+
+        Arguments:
+
+            route_map (list) - List of (compiled_regex, handler) tuples in match
+                               priority order. Each regex must end with "$".
+        """
+        self.route_map = tuple(route_map)
+        self.linear = False
+
+        literal_routes = {}
+        dynamic_routes = []
+        for index, (route_re, handler) in enumerate(self.route_map):
+            pattern = route_re.pattern[:-1]
+            if not (set(pattern) & REGEX_METACHARS):
+                # Earliest literal wins if the same route is listed twice.
+                literal_routes.setdefault(pattern, index)
+            else:
+                dynamic_routes.append((index, route_re))
+
+        self.literal_routes = FrozenDict(literal_routes)
+
+        self.first_dynamic = dynamic_routes[0][0] if dynamic_routes else None
+
+        try:
+            self.chunks = self._compileChunks(dynamic_routes)
+        except (re.error, AssertionError, OverflowError):
+            # Patterns that can't be safely combined fall back to a linear scan.
+            self.chunks = ()
+            self.linear = True
+
+        self.dynamic_routes = tuple(dynamic_routes)
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError("CompiledRouteMap is frozen. Build a new one instead.")
+        object.__setattr__(self, name, value)
+
+    def _compileChunks(self, dynamic_routes):
+        """Folds the dynamic routes into as few alternation regexes as possible.
+        Returns a tuple of (compiled_regex, sentinel_groups) chunks."""
+        chunks = []
+        chunk_parts = []
+        chunk_groups = {}
+        chunk_group_count = 0
+
+        for index, route_re in dynamic_routes:
+            pattern = route_re.pattern
+            if RE_UNCOMBINABLE.search(pattern):
+                raise re.error("Route '%s' cannot be combined." % pattern)
+
+            prefix = "_r%d_" % index
+            renamed = RE_NAMED_GROUP.sub(lambda m: "(?P<%s%s>" % (prefix, m.group(1)), pattern)
+            renamed = RE_NAMED_BACKREF.sub(lambda m: "(?P=%s%s)" % (prefix, m.group(1)), renamed)
+            group_names = [(prefix + name, name) for name in route_re.groupindex.keys()]
+
+            if chunk_parts and \
+               chunk_group_count + route_re.groups + 1 > MAX_GROUPS_PER_CHUNK:
+                chunks.append((re.compile("|".join(chunk_parts)), chunk_groups))
+                chunk_parts = []
+                chunk_groups = {}
+                chunk_group_count = 0
+
+            chunk_parts.append("(?P<_r%d>%s)" % (index, renamed))
+            chunk_groups["_r%d" % index] = (index, group_names)
+            chunk_group_count = chunk_group_count + route_re.groups + 1
+
+        if chunk_parts:
+            chunks.append((re.compile("|".join(chunk_parts)), chunk_groups))
+
+        return tuple(chunks)
+
+    def _matchDynamic(self, path, before=None):
+        """Returns (index, groupdict) for the first dynamic route matching path
+        with an index lower than 'before', or None."""
+        if self.linear:
+            for index, route_re in self.dynamic_routes:
+                if before != None and index >= before:
+                    return None
+                route_match = route_re.match(path)
+                if route_match:
+                    return (index, route_match.groupdict())
+            return None
+
+        for chunk_re, chunk_groups in self.chunks:
+            route_match = chunk_re.match(path)
+            if route_match:
+                index, group_names = chunk_groups[route_match.lastgroup]
+                if before != None and index >= before:
+                    return None
+                match_dict = {}
+                for combined_name, name in group_names:
+                    match_dict[name] = route_match.group(combined_name)
+                return (index, match_dict)
+
+        return None
+
+    def shadowed_routes(self):
+        """Returns the (unreachable, overlapping) routes in this table. See find_shadowed_routes."""
+        return find_shadowed_routes(self.route_map)
+
+    def match(self, path):
+        """Finds the first route matching path.
+
+        Arguments:
+
+            path (string) - URL path relative to the call router.
+
+        Returns:
+
+            Match: Tuple of (handler, match_dict) where match_dict contains the
+                   route's named groups (not yet URL decoded).
+            No Match: None
+        """
+        literal_index = self.literal_routes.get(path)
+        if literal_index != None:
+            if self.first_dynamic == None or self.first_dynamic > literal_index:
+                return (self.route_map[literal_index][1], {})
+            result = self._matchDynamic(path, before=literal_index)
+            if result == None:
+                return (self.route_map[literal_index][1], {})
+        else:
+            result = self._matchDynamic(path)
+            if result == None:
+                return None
+
+        return (self.route_map[result[0]][1], result[1])
+
+
+def sample_route_path(route_re):
+    """Builds one example path matched by route_re, for detecting overlapping routes.
+    Returns None if the pattern uses constructs the sampler doesn't model."""
+
+    sample_chars = "a0_-."
+
+    def in_set(char, items):
+        for op, av in items:
+            if op == "literal" and ord(char) == av:
+                return True
+            if op == "range" and av[0] <= ord(char) <= av[1]:
+                return True
+            if op == "category":
+                if av == sre_constants.CATEGORY_DIGIT and char.isdigit():
+                    return True
+                if av == sre_constants.CATEGORY_WORD and (char.isalnum() or char == "_"):
+                    return True
+        return False
+
+    def sample(parsed):
+        result = []
+        for op, av in parsed:
+            if op == "literal":
+                result.append(unichr(av))
+            elif op == "not_literal" or op == "any":
+                result.append([c for c in sample_chars if op == "any" or ord(c) != av][0])
+            elif op == "in":
+                if av and av[0][0] == "negate":
+                    chars = [c for c in sample_chars if not in_set(c, av[1:])]
+                else:
+                    chars = [c for c in sample_chars if in_set(c, av)] or \
+                            [unichr(item[1]) for item in av if item[0] == "literal"] or \
+                            [unichr(item[1][0]) for item in av if item[0] == "range"]
+                if not chars:
+                    return None
+                result.append(chars[0])
+            elif op == "max_repeat" or op == "min_repeat":
+                sub_sample = sample(av[2])
+                if sub_sample == None:
+                    return None
+                result.append(sub_sample * max(av[0], min(av[1], 1)))
+            elif op == "subpattern":
+                sub_sample = sample(av[1])
+                if sub_sample == None:
+                    return None
+                result.append(sub_sample)
+            elif op == "branch":
+                sub_sample = sample(av[1][0])
+                if sub_sample == None:
+                    return None
+                result.append(sub_sample)
+            elif op in ("at", "assert", "assert_not"):
+                continue
+            else:
+                return None
+        return "".join(result)
+
+    try:
+        path = sample(sre_parse.parse(route_re.pattern))
+    except (re.error, IndexError, ValueError):
+        return None
+
+    if path == None or not route_re.match(path):
+        return None
+    return path
+
+def find_shadowed_routes(route_map):
+    """Checks an ordered route map for routes hidden by earlier routes.
+
+    Arguments:
+
+        route_map (list) - List of (compiled_regex, handler) tuples in match priority order.
+
+    Returns:
+
+        Tuple of (unreachable, overlapping). Each is a list of dictionaries with the keys
+        "route", "handler", "shadowed_by" and "shadowed_by_handler".
+
+            unreachable - Routes that can never match: a duplicate of an earlier pattern,
+                          or a literal route an earlier pattern also matches.
+            overlapping - Routes for which an earlier pattern matches at least one of their
+                          paths, so some requests meant for them go elsewhere.
+    """
+
+    def describe(route_re, handler, earlier_re, earlier_handler):
+        return {"route" : route_re.pattern[:-1],
+                "handler" : getattr(handler, "__name__", str(handler)),
+                "shadowed_by" : earlier_re.pattern[:-1],
+                "shadowed_by_handler" : getattr(earlier_handler, "__name__", str(earlier_handler))}
+
+    unreachable = []
+    overlapping = []
+    for index, (route_re, handler) in enumerate(route_map):
+        pattern = route_re.pattern[:-1]
+        is_literal = not (set(pattern) & REGEX_METACHARS)
+        sample_path = pattern if is_literal else sample_route_path(route_re)
+
+        for earlier_re, earlier_handler in route_map[:index]:
+            if earlier_re.pattern == route_re.pattern or \
+               (is_literal and earlier_re.match(pattern)):
+                unreachable.append(describe(route_re, handler, earlier_re, earlier_handler))
+                break
+            if sample_path != None and earlier_re.match(sample_path):
+                overlapping.append(describe(route_re, handler, earlier_re, earlier_handler))
+                break
+
+    return (unreachable, overlapping)
+
+
+### Route Resolution Cache
+class RouteCache(lru.LRUCache):
+    """
+    Bounded LRU cache of resolved routes keyed on (api, version header, path).
+
+    Each entry holds everything needed to rebuild the leaf resource without
+    re-running API/version/call matching or URL decoding. Hit, miss and
+    eviction counts are kept locally and reported to shiji.stats.metrics.
+    """
+
+    # Every live cache, so route map rebuilds can invalidate all of them.
+    instances = weakref.WeakSet()
+
+    def __init__(self, max_size=1024):
+        """Sets up an empty cache.
+
+        Arguments:
+
+            max_size (int) - Maximum number of resolved paths to keep.
+        """
+        lru.LRUCache.__init__(self, max_size, "route_cache")
+        RouteCache.instances.add(self)
+
+def invalidate_route_caches():
+    """Clears every RouteCache. Called whenever a route map is (re)built."""
+    for cache in list(RouteCache.instances):
+        cache.clear()
+
+def route_cache_key(request):
+    """Builds the RouteCache key (api, version header, call path) for request.
+    Returns None if the request carries no API version."""
+    raw_version = request.getHeader(API_VERSION_HEADER)
+    if not raw_version:
+        if not request.args.has_key(API_VERSION_HEADER):
+            return None
+        raw_version = request.args[API_VERSION_HEADER][0]
+
+    path_parts = request.uri.split("?")[0].split("/")
+    if len(path_parts) < 2:
+        return None
+
+    return (path_parts[1], raw_version, "/".join(path_parts[2:]))
+
+class RenderTable(object):
+    """
+    Precomputed HTTP method dispatch for a Resource class. Replaces Twisted's per-request
+    getattr(self, "render_" + method) lookup with a single dict lookup.
+    """
+
+    def __init__(self, resource_class):
+        """Introspects resource_class's render_* methods.
+
+        Arguments:
+
+            resource_class (class) - Resource subclass to build the table for.
+        """
+        self.resource_class = resource_class
+        self.methods = {}
+        for method in prefixedMethodNames(resource_class, "render_"):
+            self.methods[method] = getattr(resource_class, "render_" + method).im_func
+
+        # Resource.render_HEAD only forwards to render_GET, so skip the extra hop.
+        # Without a render_GET it can only fail, so treat HEAD as unsupported.
+        if self.methods.get("HEAD") is Resource.render_HEAD.im_func:
+            if self.methods.has_key("GET"):
+                self.methods["HEAD"] = self.methods["GET"]
+            else:
+                del self.methods["HEAD"]
+
+        if hasattr(resource_class, "allowedMethods"):
+            self.allowed_methods = resource_class.allowedMethods
+        else:
+            self.allowed_methods = tuple(sorted(self.methods.keys()))
+
+    def render(self, resource, request):
+        """Calls the render function for request.method on resource. Raises
+        twisted.web.error.UnsupportedMethod if the class doesn't handle the method."""
+        render_func = self.methods.get(request.method)
+        if render_func == None:
+            raise UnsupportedMethod(self.allowed_methods)
+        return render_func(resource, request)
 
 
 ### Classes
+@implementer(_IEncodingResource)
 class URLMatchJSONResource(Resource):
     """Handles storage of URL matches."""
     
@@ -53,8 +434,25 @@ class URLMatchJSONResource(Resource):
     isLeaf = True
     routes = None # Replace with regex pattern string to match at end of URL (e.g. r"route_call")
                   # For multiple routes pointing to this call use a list (e.g. [r"route1_call", r"route2_call"])
+    shared_instance = False # Set True to serve every request with one shared instance of this class.
+                            # Handlers must then be stateless and read URL matches from
+                            # request.url_matches instead of self.url_matches.
     
     def __init__(self, request, url_matches, call_router=None):
+        self.url_matches = url_matches
+        self.call_router = call_router
+        Resource.__init__(self)
+        
+        # Shared instances are built without a request. Response headers are
+        # applied per request by the CallRouter instead.
+        if request == None:
+            return
+        
+        api_router = getattr(getattr(call_router, "version_router", None), "api_router", None)
+        if isinstance(api_router, APIRouter):
+            api_router.apply_response_headers(request)
+            return
+        
         request.setHeader("Content-Type", "application/json; charset=utf-8")
         if call_router and \
            hasattr(call_router, "version_router") and \
@@ -64,13 +462,24 @@ class URLMatchJSONResource(Resource):
                     request.setHeader("Access-Control-Allow-Origin", 
                                       call_router.version_router.api_router.cross_origin_domains)
                     request.setHeader("Access-Control-Allow-Credentials", "true")
+                    request.setHeader("Access-Control-Expose-Headers", "ETag")
                 if hasattr(call_router.version_router.api_router, "inhibit_http_caching") and \
                    call_router.version_router.api_router.inhibit_http_caching:
                     request.setHeader("Cache-Control", "no-cache")
                     request.setHeader("Pragma", "no-cache")
-        self.url_matches = url_matches
-        self.call_router = call_router
-        Resource.__init__(self)
+    
+    def getEncoder(self, request):
+        """Returns the response encoder (compression) for request, if the API has one.
+           Called by twisted.web.server.Request before rendering."""
+        try:
+            compression = self.call_router.version_router.api_router.compression
+        except AttributeError:
+            return None
+        
+        if compression == None:
+            return None
+        
+        return compression.encoderForRequest(request)
     
     def render(self, request):
         """
@@ -79,11 +488,18 @@ class URLMatchJSONResource(Resource):
         
         def cb_deferred_finish(result):
             "Deferred has completed. Finish the request."
+            # The render function (e.g. a conditional 304) finishes the request itself
+            if result is NOT_DONE_YET:
+                return
+            
             if isinstance(request, testutil.DummyRequest):
                 request._reset_body()
             
             if not result:
                 result = ""
+            elif not getattr(request, "startedWriting", False):
+                # Whole body in hand, so the response needn't be chunked
+                request.setHeader("Content-Length", str(len(result)))
             request.write(result)
             request.finish()
         
@@ -91,28 +507,55 @@ class URLMatchJSONResource(Resource):
             if isinstance(request, testutil.DummyRequest):
                 request._reset_body()
             
-            print failure.getTraceback()
+            log.logger.failure("UnexpectedServerError", failure)
             request.write(str(webapi.UnexpectedServerError(request,
                                                            failure.getErrorMessage())))
             request.finish()
         
+        # Classes routed by a CallRouter dispatch through its precomputed render table.
+        # Anything else (e.g. instantiated directly) falls back to Twisted's lookup.
         try:
-            res = Resource.render(self, request)
+            render_table = self.call_router.render_tables[self.__class__]
+        except (AttributeError, KeyError):
+            render_table = None
+        
+        try:
+            if render_table == None:
+                res = Resource.render(self, request)
+            else:
+                res = render_table.render(self, request)
+        except UnsupportedMethod:
+            # Twisted answers these with a 405 and an Allow header
+            raise
         except Exception, e:
             if isinstance(request, testutil.DummyRequest):
                 request._reset_body()
             
             tb_text = traceback.format_exc()
-            print tb_text
+            log.logger.msg("UnexpectedServerError", "%s", tb_text)
             return str(webapi.UnexpectedServerError(request,tb_text))
         
         if isinstance(res, defer.Deferred):
             res.addCallback(cb_deferred_finish)
             res.addErrback(eb_failed)
             return NOT_DONE_YET
+        elif res == None:
+            # The render function wrote its response (e.g. with write_json) and returned
+            # nothing. Finish it here, as Twisted would otherwise answer with its HTML
+            # "did not return bytes" error page.
+            if not request.finished:
+                request.finish()
+            return NOT_DONE_YET
         else:
             return res
 
+CORS_ALLOWED_VERBS = ",".join(["PUT", "GET", "DELETE",
+                                "POST", "HEAD", "TRACE",
+                                "CONNECT", "PROPFIND", "PROPPATCH",
+                                "MKCOL", "COPY", "MOVE", 
+                                "LOCK", "UNLOCK"])
+PREFLIGHT_CACHE_SIZE = 256
+
 class CORSInterrogation(Resource):
     """
     Returned for any OPTIONS request without API version headers.
@@ -124,24 +567,37 @@ class CORSInterrogation(Resource):
         if hasattr(api_router, "cross_origin_domains") and \
            api_router.cross_origin_domains:
             request.setHeader("Access-Control-Allow-Origin", api_router.cross_origin_domains)
+        self.api_router = api_router
         Resource.__init__(self)
-
+    
+    def _preflightHeaders(self, allowed_headers):
+        """Returns the preflight response headers as a tuple of (name, value) pairs."""
+        response_headers = [("Access-Control-Allow-Methods", CORS_ALLOWED_VERBS),
+                            ("Access-Control-Allow-Headers", allowed_headers),
+                            ("Access-Control-Allow-Credentials", "true")]
+        cors_max_age = getattr(self.api_router, "cors_max_age", None)
+        if cors_max_age:
+            response_headers.append(("Access-Control-Max-Age", str(cors_max_age)))
+        return tuple(response_headers)
+    
     def render_OPTIONS(self, request):
-        allowed_verbs = ["PUT", "GET", "DELETE",
-                         "POST", "HEAD", "TRACE",
-                         "CONNECT", "PROPFIND", "PROPPATCH",
-                         "MKCOL", "COPY", "MOVE", 
-                         "LOCK", "UNLOCK"]
-        print request.getHeader("Access-Control-Request-Headers")
-        if request.getHeader("Access-Control-Request-Headers"):
-            allowed_headers = request.getHeader("Access-Control-Request-Headers")
+        requested_headers = request.getHeader("Access-Control-Request-Headers")
+        preflight_cache = getattr(self.api_router, "preflight_cache", None)
+        
+        # Preflights that name their headers are cached per requested headers.
+        if requested_headers and preflight_cache != None:
+            response_headers = preflight_cache.get(requested_headers)
+            if response_headers == None:
+                response_headers = self._preflightHeaders(requested_headers)
+                preflight_cache.set(requested_headers, response_headers)
+        elif requested_headers:
+            response_headers = self._preflightHeaders(requested_headers)
         else:
-            allowed_headers = ",".join(request.getAllHeaders().keys())
+            response_headers = self._preflightHeaders(",".join(request.getAllHeaders().keys()))
         
         request.setResponseCode(200)
-        request.setHeader("Access-Control-Allow-Methods", ",".join(allowed_verbs))
-        request.setHeader("Access-Control-Allow-Headers", allowed_headers)
-        request.setHeader("Access-Control-Allow-Credentials", "true")
+        for name, value in response_headers:
+            request.setHeader(name, value)
         return ""
 
 class UnknownAPI(Resource):
@@ -151,7 +607,7 @@ class UnknownAPI(Resource):
     isLeaf = True
 
     def render_GET(self, request):
-        print "UnknownAPI: Unknown API %s" % request.uri
+        log.logger.msg("UnknownAPI", "UnknownAPI: Unknown API %s", request.uri)
         request.setResponseCode(404)
         request.setHeader("Content-Type", "application/json; charset=utf-8")
         return str(webapi.UnknownAPIError(request, request.uri.split("/")[1]))
@@ -166,7 +622,7 @@ class UnknownCall(Resource):
     isLeaf = True
 
     def render_GET(self, request):
-        print "UnknownAPI: Unknown API call %s" % request.uri
+        log.logger.msg("UnknownCall", "UnknownAPI: Unknown API call %s", request.uri)
         request.setResponseCode(404)
         request.setHeader("Content-Type", "application/json; charset=utf-8")
         return str(webapi.UnknownAPICallError(request, request.uri.split("/")[-1]))
@@ -183,8 +639,9 @@ class UnknownVersion(Resource):
 
     def render_GET(self, request):
         version_header = request.getHeader(API_VERSION_HEADER) if request.getHeader(API_VERSION_HEADER) != None else ""
-        print ("UnknownVersion: %s is missing, invalid or specifies " % API_VERSION_HEADER) + \
-               "an API/version that does not exist. %s" % version_header
+        log.logger.msg("UnknownVersion",
+                       "UnknownVersion: %s is missing, invalid or specifies " + \
+                       "an API/version that does not exist. %s", API_VERSION_HEADER, version_header)
         request.setResponseCode(406)
         request.setHeader("Content-Type", "application/json; charset=utf-8")
         return str(webapi.UnknownAPIVersionError(request, version_header))
@@ -226,26 +683,27 @@ class CallRouter(Resource):
                                            list the available versions of the current API.
         """
         self.version_router=version_router
-        self._createRouteMap(calls_module)
-        
-        if auto_list_versions:
-            self.route_map.append((re.compile(r"list_versions$"), ListVersionsCall))
+        self._createRouteMap(calls_module, auto_list_versions)
         
         Resource.__init__(self)
     
-    def _createRouteMap(self, calls_module):
+    def _createRouteMap(self, calls_module, auto_list_versions=False):
         """Introspects 'calls_module' to find URLMatchJSONResource classes and builds
         the internal route map.
         
         Arguments:
         
             calls_module (module) - Module to introspect for routes.
+            auto_list_versions (boolean) - If True, append the 'list_versions' route
+                                           before the route map is compiled.
         
         Returns:
         
-            Nothing.
+            Nothing. The time taken (introspection, route regexes and compilation) is
+            stored in self.compile_time.
         """
         
+        start_time = time.time()
         self.route_map = []
         
         for cur_class in inspect.getmembers(sys.modules[calls_module.__name__], inspect.isclass):
@@ -256,6 +714,48 @@ class CallRouter(Resource):
                     if isinstance(cur_class[1].routes, list):
                         for route in cur_class[1].routes:
                             self.route_map.append( (re.compile(route + "$"), cur_class[1]) )
+        
+        if auto_list_versions:
+            self.route_map.append((re.compile(r"list_versions$"), ListVersionsCall))
+        
+        self._compileRouteMap()
+        self.compile_time = time.time() - start_time
+    
+    def _compileRouteMap(self):
+        """Builds the single-pass dispatch structure for the current route map, the
+        per-class render tables, creates the shared instances of call classes that
+        request one, and invalidates any cached route resolutions."""
+        self.compiled_routes = CompiledRouteMap(self.route_map)
+        self.shared_resources = {}
+        self.render_tables = {}
+        for route in self.route_map:
+            if not self.render_tables.has_key(route[1]):
+                self.render_tables[route[1]] = RenderTable(route[1])
+            if route[1].shared_instance and not self.shared_resources.has_key(route[1]):
+                self.shared_resources[route[1]] = route[1](None, url_matches=None, call_router=self)
+        invalidate_route_caches()
+    
+    def buildResource(self, request, resource_class, url_matches):
+        """Returns the resource that will render request for resource_class.
+        
+        Arguments:
+        
+            request (t.w.http.Request) - Request being routed.
+            resource_class (class) - URLMatchJSONResource subclass the route resolved to.
+            url_matches (dict) - Decoded named groups from the route match.
+        
+        Returns:
+        
+            The shared instance of resource_class (if it sets shared_instance) with the
+            API's response headers applied to request, otherwise a new instance.
+        """
+        shared_resource = self.shared_resources.get(resource_class)
+        if shared_resource == None:
+            return resource_class(request, url_matches=url_matches, call_router=self)
+        
+        request.url_matches = url_matches
+        self.version_router.api_router.apply_response_headers(request)
+        return shared_resource
     
     def getChild(self, name, request):
         """
@@ -276,13 +776,19 @@ class CallRouter(Resource):
             request.api_mode = api_mode
         
         request.api_config = self.version_router.api_router.config
-        for route in self.route_map:
-            route_match = route[0].match("/".join(request.uri.split("?")[0].split("/")[2:]))
-            if route_match:
-                match_dict = route_match.groupdict()
-                for key in match_dict:
-                    match_dict[key] = urllib.unquote(match_dict[key])
-                return route[1](request, url_matches=match_dict, call_router=self)
+        route = self.compiled_routes.match("/".join(request.uri.split("?")[0].split("/")[2:]))
+        if route:
+            match_dict = route[1]
+            for key in match_dict:
+                match_dict[key] = urllib.unquote(match_dict[key])
+            
+            route_cache = getattr(self.version_router.api_router, "route_cache", None)
+            cache_key = getattr(request, "route_cache_key", None)
+            if route_cache != None and cache_key != None:
+                route_cache.set(cache_key, (route[0], dict(match_dict), self, request.api_name,
+                                            request.api_version, api_mode))
+            
+            return self.buildResource(request, route[0], match_dict)
         
         return UnknownCall()
 
@@ -311,8 +817,40 @@ class VersionRouter(Resource):
         for version in version_map.keys():
             temp_version_map[version]= (re.compile(version_map[version][0] + "$"), version_map[version][1])
         self.version_map = temp_version_map
+        self._createVersionTable()
+        invalidate_route_caches()
         Resource.__init__(self)
     
+    def _createVersionTable(self):
+        """Builds the ordered version table used by getChild and wires each version
+        module's call router back to this version router.
+        
+        Versions are matched in sorted order (first match wins). The header values
+        clients actually send (the version names and any pattern without wildcards)
+        are resolved ahead of time into the exact_versions dictionary. Any other
+        header value falls back to a single pass over the combined version regexes.
+        """
+        ordered_versions = [(self.version_map[version][0], version)
+                            for version in sorted(self.version_map.keys())]
+        self.compiled_versions = CompiledRouteMap(ordered_versions)
+        
+        candidates = set(self.version_map.keys())
+        for version_re, version in ordered_versions:
+            pattern = version_re.pattern[:-1]
+            if not (set(pattern) & (REGEX_METACHARS - set("."))):
+                candidates.add(pattern)
+        
+        self.exact_versions = {}
+        for candidate in candidates:
+            for version_re, version in ordered_versions:
+                if version_re.match(candidate):
+                    self.exact_versions[candidate] = version
+                    break
+        
+        for version in self.version_map.keys():
+            if hasattr(self.version_map[version][1], "call_router"):
+                self.version_map[version][1].call_router.version_router = self
+    
     def getChild(self, name, request):
         """
         Dispatches based on the version table.
@@ -323,14 +861,15 @@ class VersionRouter(Resource):
         except IndexError:
             return UnknownVersion()
         
-        for version in sorted(self.version_map.keys()):
-            version_match = self.version_map[version][0].match(header_version)
-            if version_match:
-                request.api_version = version
-                self.version_map[version][1].call_router.version_router = self
-                return self.version_map[version][1].call_router.getChild(name, request)
+        version = self.exact_versions.get(header_version)
+        if version == None:
+            version_match = self.compiled_versions.match(header_version)
+            if not version_match:
+                return UnknownVersion()
+            version = version_match[0]
         
-        return UnknownVersion()
+        request.api_version = version
+        return self.version_map[version][1].call_router.getChild(name, request)
     
     def get_version_map(self):
         """Returns the current API's version map.
@@ -364,7 +903,9 @@ class APIRouter(Resource):
         ** If not route match is made the verb is dispatched to the 
            unknown verb handler.
     """
-    def __init__(self, route_map, config={}, cross_origin_domains=None, inhibit_http_caching=True):
+    def __init__(self, route_map, config={}, cross_origin_domains=None, inhibit_http_caching=True,
+                 route_cache_size=0, cors_max_age=3600, compress_responses=False,
+                 compress_min_size=1024, compress_level=6):
         """Sets up the twisted.web.Resource and loads the route map.
         
         Arguments:
@@ -376,13 +917,48 @@ class APIRouter(Resource):
                                
                                (r"^/example/auth/", AuthAPI)
             config (dict) - Dictionary of optional configuration settings needed for your API.
+            route_cache_size (int) - If > 0, cache up to this many resolved request paths
+                                     (keyed on API, version header and path) so repeat
+                                     requests skip API/version/call matching.
+            cors_max_age (int) - Seconds browsers may cache CORS preflight responses
+                                 (Access-Control-Max-Age). 0 or None omits the header.
+            compress_responses (bool) - gzip/deflate call responses for clients that send
+                                        a matching Accept-Encoding.
+            compress_min_size (int) - Responses smaller than this many bytes are sent
+                                      uncompressed.
+            compress_level (int) - zlib compression level (1 fastest - 9 smallest).
         """
         self.cross_origin_domains = cross_origin_domains
         self.inhibit_http_caching = inhibit_http_caching
+        self.cors_max_age = cors_max_age
+        self.preflight_cache = lru.LRUCache(PREFLIGHT_CACHE_SIZE)
         for i in range(len(route_map)):
             route_map[i] = (re.compile(route_map[i][0] + "$"), route_map[i][1])
         self.route_map = route_map
         self.config = config
+        
+        # Headers every call response from this API carries, compiled once
+        response_headers = [("Content-Type", "application/json; charset=utf-8")]
+        if cross_origin_domains:
+            response_headers.append(("Access-Control-Allow-Origin", cross_origin_domains))
+            response_headers.append(("Access-Control-Allow-Credentials", "true"))
+            # Lets browser clients read ETags for conditional GETs (webapi.conditional_get)
+            response_headers.append(("Access-Control-Expose-Headers", "ETag"))
+        if inhibit_http_caching:
+            response_headers.append(("Cache-Control", "no-cache"))
+            response_headers.append(("Pragma", "no-cache"))
+        self.response_headers = tuple(response_headers)
+        
+        if compress_responses:
+            self.compression = webapi.CompressionEncoderFactory(compress_min_size, compress_level)
+        else:
+            self.compression = None
+        
+        invalidate_route_caches()
+        if route_cache_size > 0:
+            self.route_cache = RouteCache(route_cache_size)
+        else:
+            self.route_cache = None
         Resource.__init__(self)
     
     def getChild(self, name, request):
@@ -395,6 +971,14 @@ class APIRouter(Resource):
         if request.method.upper() == "OPTIONS":
             return CORSInterrogation(request, api_router=self)
         
+        if self.route_cache != None:
+            cache_key = route_cache_key(request)
+            if cache_key != None:
+                cached_route = self.route_cache.get(cache_key)
+                if cached_route != None:
+                    return self._cachedRouteResource(request, cached_route)
+                request.route_cache_key = cache_key
+        
         try:
             header_version = get_version(request)
         except IndexError:
@@ -412,6 +996,76 @@ class APIRouter(Resource):
         
         return UnknownAPI()
     
+    def apply_response_headers(self, request):
+        """Sets this API's static response headers (Content-Type, CORS and caching) on request.
+        
+        Arguments:
+        
+            request (t.w.http.Request) - Request whose response the headers are added to.
+        
+        Returns:
+        
+            Nothing.
+        """
+        # Twisted requests go straight to their Headers (a fresh value list per header,
+        # as setHeader would create). Anything else goes through setHeader.
+        try:
+            headers = request.responseHeaders
+        except AttributeError:
+            for name, value in self.response_headers:
+                request.setHeader(name, value)
+            return
+        
+        for name, value in self.response_headers:
+            headers.setRawHeaders(name, [value])
+    
+    def _cachedRouteResource(self, request, cached_route):
+        """Rebuilds the leaf resource for a RouteCache hit, attaching the same
+        request attributes the full API->version->call resolution would."""
+        resource_class, url_matches, call_router, api_name, api_version, api_mode = cached_route
+        request.api_name = api_name
+        request.api_version = api_version
+        request.api_mode = api_mode
+        request.api_config = self.config
+        call_router.version_router.api_router = self
+        return call_router.buildResource(request, resource_class, dict(url_matches))
+    
+    def route_report(self):
+        """Reports on the compiled call route table of every API version this router serves.
+        
+        Arguments:
+        
+            None
+        
+        Returns:
+        
+            report (list) - One dictionary per API version, in route map/version order:
+                            
+                                { "api" : "dummy_api",
+                                  "version" : "1.0",
+                                  "routes" : 2,
+                                  "compile_ms" : 0.12,
+                                  "unreachable" : [...],
+                                  "overlapping" : [...] }
+                            
+                            See find_shadowed_routes for the unreachable/overlapping entries.
+        """
+        report = []
+        for api_re, api_module in self.route_map:
+            version_map = api_module.version_router.get_version_map()
+            for version in sorted(version_map.keys()):
+                call_router = getattr(version_map[version][1], "call_router", None)
+                if call_router == None:
+                    continue
+                unreachable, overlapping = call_router.compiled_routes.shadowed_routes()
+                report.append({"api" : api_module.api_name,
+                               "version" : version,
+                               "routes" : len(call_router.compiled_routes.route_map),
+                               "compile_ms" : round(call_router.compile_time * 1000, 3),
+                               "unreachable" : unreachable,
+                               "overlapping" : overlapping})
+        return report
+    
     def get_route_map(self):
         """Returns the API map of API names to API modules."
         
@@ -21,7 +21,7 @@ except ImportError:
 pyfile_path = ''.join([path_part + "/" for path_part in __file__.split("/")[:-1]])
 sys.path.append(pyfile_path)
 
-from shiji import urldispatch, foundation, auth, stats
+from shiji import urldispatch, foundation, auth, stats, log, webapi
 import shiji
 
 from ConfigParser import SafeConfigParser, NoOptionError, NoSectionError
@@ -61,6 +61,10 @@ def main():
                       default="/var/run/shijid.pid",
                       help="Path to the Shiji PID file to be used. The " \
                       "default is /var/run/shijid.pid")
+    opt_parser.add_option("-r", "--route_report", dest="route_report",
+                      action="store_true", default=False,
+                      help="Print the compiled route table report (as JSON) " \
+                      "for every configured API and exit.")
     args = opt_parser.parse_args()[0]
     
     pid_file = args.pid_file
@@ -127,6 +131,53 @@ def main():
     except NoOptionError:
         honor_xrealip = True
     
+    try:
+        route_cache_size = cfg_central.getint("general", "route_cache_size")
+    except NoOptionError:
+        route_cache_size = 0
+    
+    try:
+        cors_max_age = cfg_central.getint("general", "cors_max_age")
+    except NoOptionError:
+        cors_max_age = 3600
+    
+    try:
+        json_codec = cfg_central.get("general", "json_codec").lower()
+    except NoOptionError:
+        json_codec = "json"
+    
+    try:
+        webapi.install_json_codec(json_codec)
+    except Exception, e:
+        print "WARNING: Could not select JSON codec. Falling back to the stdlib json codec. (%s)" % str(e)
+        webapi.install_json_codec("json")
+    
+    try:
+        max_body_size = cfg_central.getint("general", "max_body_size")
+    except NoOptionError:
+        max_body_size = 0
+    
+    try:
+        webapi.set_max_body_size(max_body_size)
+    except Exception, e:
+        print "Invalid 'max_body_size' directive. (%s)" % str(e)
+        sys.exit(-1)
+    
+    try:
+        compress_responses = cfg_central.getboolean("general", "compress_responses")
+    except NoOptionError:
+        compress_responses = False
+    
+    try:
+        compress_min_size = cfg_central.getint("general", "compress_min_size")
+    except NoOptionError:
+        compress_min_size = 1024
+    
+    try:
+        compress_level = cfg_central.getint("general", "compress_level")
+    except NoOptionError:
+        compress_level = 6
+    
     # Load statsd
     statsd_host = statsd_port = statsd_scheme = None
     if "statsd" in cfg_central.sections():
@@ -173,9 +224,32 @@ def main():
     
     root = urldispatch.APIRouter(routes, config=config, 
                                  cross_origin_domains=cross_origin_domains,
-                                 inhibit_http_caching=inhibit_http_caching)
+                                 inhibit_http_caching=inhibit_http_caching,
+                                 route_cache_size=route_cache_size,
+                                 cors_max_age=cors_max_age,
+                                 compress_responses=compress_responses,
+                                 compress_min_size=compress_min_size,
+                                 compress_level=compress_level)
     shiji.change_server_ident(server_ident)
     
+    # Report on the compiled route tables (compiled when the API modules were imported)
+    route_report = root.route_report()
+    if args.route_report:
+        print json.dumps(route_report, indent=4)
+        sys.exit(0)
+    
+    for table in route_report:
+        print "Compiled %d routes for API '%s' version %s in %.3fms." % (table["routes"],
+                                                                           table["api"],
+                                                                           table["version"],
+                                                                           table["compile_ms"])
+        for route in table["unreachable"]:
+            print "WARNING: Route '%s' (%s) is unreachable. Shadowed by '%s' (%s)." % \
+                  (route["route"], route["handler"], route["shadowed_by"], route["shadowed_by_handler"])
+        for route in table["overlapping"]:
+            print "WARNING: Route '%s' (%s) overlaps earlier route '%s' (%s)." % \
+                  (route["route"], route["handler"], route["shadowed_by"], route["shadowed_by_handler"])
+    
     # Setup logging
     try:
         fn_log = cfg_central.get("logging", "log_file")
@@ -187,6 +261,16 @@ def main():
     except NoOptionError:
         log_prefix = "Shiji"
     
+    try:
+        log_flush_interval = cfg_central.getfloat("logging", "flush_interval")
+    except NoOptionError:
+        log_flush_interval = 1.0
+    
+    try:
+        log_rate_limit = cfg_central.getint("logging", "rate_limit")
+    except NoOptionError:
+        log_rate_limit = 100
+    
     if fn_log:
         tw_log.startLogging(open(fn_log, "w"))
     else:
@@ -212,6 +296,9 @@ def main():
     print "Setting Thread Pool Size: %d" % thread_pool_size
     reactor.suggestThreadPoolSize(thread_pool_size)
     
+    # Move request path logging off the reactor thread
+    log.install_logger(reactor, flush_interval=log_flush_interval, rate_limit=log_rate_limit)
+    
     # Install Authentication
     
     try:
@@ -244,9 +331,14 @@ def main():
             print "'auth_args' contents is not valid JSON."
             sys.exit(-1)
         
+        try:
+            auth_cache_size = cfg_central.getint("auth", "auth_cache_size")
+        except NoOptionError:
+            auth_cache_size = 1024
+        
         auth_module = __import__(auth_mod_name, globals(), locals(), [], -1)
         auth_class = getattr(auth_module, auth_class_name)
-        auth.install_auth(auth_class(**auth_args))
+        auth.install_auth(auth_class(**auth_args), cache_size=auth_cache_size)
     
     try:
         secure_cookies_secrets = json.loads(cfg_central.get("auth", "secure_cookies_secrets"),
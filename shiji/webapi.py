@@ -10,38 +10,410 @@
 # (C)2015 DigiTar Inc.
 # Licensed under the MIT License.
 ####################################################################
-import exceptions
+import exceptions, re, base64, hashlib, zlib, time
 try:
     import json
 except exceptions.ImportError:
     import simplejson as json
+from zope.interface import implementer
+from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer
+from twisted.web.server import NOT_DONE_YET
+from twisted.python.failure import Failure
+from shiji import log, lru, signing
 
 ## CONSTANTS/ENUM
 ARG_OPTIONAL = True
 ARG_REQUIRED = False
 
-## Shiji JSON Argument Parsing Decorators
-def json_arguments(arg_list, content_type="application/json"):
-    """Wraps a Twisted Web render_POST function, parses the body as JSON arguments, and stores them as a dictionary
-       in request.jsonArgs. If the request's Content-Type is not the same as content_type, or the request body is
-       not valid JSON we'll throw  an error on-behalf of our wrapped function. Also, we'll validate to ensure the
-       expected request arguments & types are present.
+## Shiji JSON Codecs
+class JSONCodec(object):
+    """Stdlib JSON codec. Codecs encode objects straight to UTF-8 JSON bytes and
+       decode UTF-8 JSON bytes straight to objects (strings decoded as unicode).
+
+       Subclass and register_json_codec() to plug in another backend. A codec must produce
+       byte-identical output to this one."""
+    name = "json"
+
+    def encode(self, obj):
+        """Returns obj JSON-encoded as a UTF-8 byte string."""
+        json_output = json.dumps(obj, ensure_ascii=False)
+        if isinstance(json_output, unicode):
+            json_output = json_output.encode("utf-8")
+        return json_output
+
+    def decode(self, data):
+        """Returns the object JSON-encoded in the UTF-8 byte string data."""
+        # The stdlib scanner decodes UTF-8 while parsing, so there's no need for
+        # an intermediate unicode copy of the whole body.
+        return json.loads(data)
+
+class SimpleJSONCodec(JSONCodec):
+    """Encodes with simplejson's C encoder, which unlike the stdlib one also handles
+       ensure_ascii=False in C. Decoding stays with the stdlib, which is faster from bytes
+       and always returns unicode strings (simplejson returns str for ASCII strings)."""
+    name = "simplejson"
+
+    def __init__(self):
+        import simplejson
+        self.dumps = simplejson.dumps
+
+    def encode(self, obj):
+        """Returns obj JSON-encoded as a UTF-8 byte string."""
+        json_output = self.dumps(obj, ensure_ascii=False)
+        if isinstance(json_output, unicode):
+            json_output = json_output.encode("utf-8")
+        return json_output
+
+json_codecs = {}
+
+def register_json_codec(codec_class):
+    """Makes a JSONCodec subclass selectable by name with install_json_codec(). Codecs
+       whose backend can't be imported are skipped.
 
     Arguments:
 
-        arg_list (list of tuples) - List of tuples where each tuple represents a request argument in the format:
-                                    (arg_name, arg_type) for example an argument 'port' of type 'int':
-                                        ("port", int)
-        content_type (string) - Expected request Content-Type. Default: application/json
+        codec_class (class) - JSONCodec subclass.
 
     Returns:
 
-        A function object wrapping the original function."""
+        True if the codec was registered, otherwise False."""
+    try:
+        json_codecs[codec_class.name] = codec_class()
+    except exceptions.ImportError:
+        return False
+    return True
 
-    # Validate arg_list
+register_json_codec(JSONCodec)
+register_json_codec(SimpleJSONCodec)
+
+# Used by write_json and json_arguments. Stdlib until install_json_codec() is called.
+json_codec = json_codecs["json"]
+
+def install_json_codec(name):
+    """Selects the registered JSON codec write_json and json_arguments use.
+
+    Arguments:
+
+        name (string) - Codec name (e.g. "json" or "simplejson").
+
+    Returns:
+
+        Nothing. Raises an exception if no codec by that name is available."""
+    global json_codec
+
+    if not json_codecs.has_key(name):
+        raise Exception("JSON codec '%s' is not available. Available codecs: %s" % \
+                        (name, ", ".join(sorted(json_codecs.keys()))))
+    json_codec = json_codecs[name]
+
+## Request Body Limits
+# Largest request body (in bytes) json_arguments will read and parse. 0 disables the limit.
+default_max_body_size = 0
+
+def set_max_body_size(size):
+    """Sets the default request body size limit for json_arguments.
+
+    Arguments:
+
+        size (int) - Maximum body size in bytes. 0 disables the limit."""
+    global default_max_body_size
+
+    if size < 0:
+        raise Exception("Maximum body size (%d) cannot be < 0." % size)
+    default_max_body_size = size
+
+def request_body_size(request):
+    """Returns the number of unread bytes in request.content without reading them. Works
+       whether Twisted kept the body in memory or spooled it to a temporary file."""
+    content = request.content
+    position = content.tell()
+    content.seek(0, 2)
+    size = content.tell() - position
+    content.seek(position)
+    return size
+
+## Content-Type Parsing
+# Parsed Content-Type headers keyed on the raw header value.
+CONTENT_TYPE_CACHE_SIZE = 256
+content_type_cache = lru.LRUCache(CONTENT_TYPE_CACHE_SIZE)
+RE_CONTENT_TYPE_PARAM = re.compile(r';\s*([^\s;=]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+RE_QUOTED_PAIR = re.compile(r'\\(.)')
+
+def parse_content_type(raw_content_type):
+    """Parses a Content-Type header value (e.g. 'application/json; charset="UTF-8"').
+
+    Arguments:
+
+        raw_content_type (string) - Content-Type header value.
+
+    Returns:
+
+        A (media_type, charset) tuple. Both are lowercased with whitespace removed. charset
+        is None if the header doesn't specify one. Other parameters are ignored."""
+    parsed_content_type = content_type_cache.get(raw_content_type)
+    if parsed_content_type != None:
+        return parsed_content_type
+    
+    media_type = "".join(raw_content_type.split(";", 1)[0].split()).lower()
+    charset = None
+    for param_match in RE_CONTENT_TYPE_PARAM.finditer(raw_content_type):
+        if param_match.group(1).lower() == "charset":
+            charset = param_match.group(2).strip()
+            if len(charset) > 1 and charset[0] == '"' and charset[-1] == '"':
+                charset = RE_QUOTED_PAIR.sub(r"\1", charset[1:-1])
+            charset = charset.lower()
+            break
+    
+    parsed_content_type = (media_type, charset)
+    content_type_cache.set(raw_content_type, parsed_content_type)
+    return parsed_content_type
+
+def content_type_error(request, content_type):
+    """Checks request's Content-Type is content_type with a UTF-8 charset. Shared by the
+       argument validating decorators.
+
+    Arguments:
+
+        request (Twisted.web.http.Request) - HTTP request object
+        content_type (string) - Expected (lowercase) media type.
+
+    Returns:
+
+        None if the Content-Type is acceptable, otherwise the JSON-encoded ContentTypeError
+        or CharsetNotUTF8Error to return to the client."""
+    raw_content_type = request.getHeader("Content-Type")
+    if raw_content_type == None:
+        return str(ContentTypeError(request))
+    
+    media_type, charset = parse_content_type(raw_content_type)
+    if charset != "utf-8":
+        return str(CharsetNotUTF8Error(request))
+    
+    if media_type != content_type:
+        return str(ContentTypeError(request))
+    
+    return None
+
+## Shiji JSON Schema Validation
+MISSING_ARGUMENT = "Argument is missing."
+
+def json_pointer(path):
+    """Returns the JSON pointer (RFC 6901) for a list of keys/indexes, outermost first."""
+    return "".join(["/" + ("%s" % segment).replace("~", "~0").replace("/", "~1") for segment in path])
+
+def type_message(arg_type):
+    """Returns the json_arguments type mismatch message for a Python type, or None if the
+       type can't be instantiated to find its name."""
+    try:
+        return "Must be of type %s" % arg_type().__class__.__name__
+    except Exception:
+        return None
+
+def compile_check(arg_type):
+    """Compiles a Schema node or plain Python type into a check function. Check functions
+       take a value and return None if it's valid, otherwise a (path, message) tuple where
+       path lists the keys/indexes leading to the invalid value, innermost first."""
+    if isinstance(arg_type, Schema):
+        return arg_type.compile()
+
+    message = type_message(arg_type) or "Must be of type %s" % arg_type.__name__
+    def check_type(value):
+        if not isinstance(value, arg_type):
+            return ([], message)
+        return None
+    return check_type
+
+class Schema(object):
+    """Base class for declarative nested schema nodes. Nodes can be used anywhere json_arguments
+       accepts an argument type, and are compiled once (at decoration time) into check functions
+       that validate a whole payload in a single pass. Failures are reported as a webapi.ValueError
+       whose argument name is the JSON pointer to the invalid value (e.g. '/items/2/name')."""
+
+    python_types = object
+    type_name = "object"
+
+    def constraints(self):
+        """Returns a list of (test, message) tuples checked, in order, after the type check.
+           Subclasses only include constraints that were actually configured."""
+        return []
+
+    def compile(self):
+        """Returns the check function for this node (see compile_check)."""
+        python_types = self.python_types
+        # bool subclasses int, but JSON true/false is only valid for BooleanSchema.
+        reject_bools = python_types is not bool
+        type_error = "Must be of type %s" % self.type_name
+        constraints = tuple(self.constraints())
+
+        def check(value):
+            if not isinstance(value, python_types) or (reject_bools and isinstance(value, bool)):
+                return ([], type_error)
+            for test, message in constraints:
+                if not test(value):
+                    return ([], message)
+            return None
+        return check
+
+class BooleanSchema(Schema):
+    """JSON true/false."""
+    python_types = bool
+    type_name = "bool"
+
+class IntegerSchema(Schema):
+    """JSON integer (booleans are rejected), optionally limited to [minimum, maximum]."""
+    python_types = (int, long)
+    type_name = "int"
+
+    def __init__(self, minimum=None, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def constraints(self):
+        constraints = []
+        minimum, maximum = self.minimum, self.maximum
+        if minimum != None:
+            constraints.append((lambda value: value >= minimum, "Must be %s or greater." % minimum))
+        if maximum != None:
+            constraints.append((lambda value: value <= maximum, "Must be %s or less." % maximum))
+        return constraints
+
+class NumberSchema(IntegerSchema):
+    """JSON integer or float (booleans are rejected), optionally limited to [minimum, maximum]."""
+    python_types = (int, long, float)
+    type_name = "float"
+
+class StringSchema(Schema):
+    """JSON string, optionally limited to [min_length, max_length] characters."""
+    python_types = basestring
+    type_name = "unicode"
+
+    def __init__(self, min_length=None, max_length=None):
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def constraints(self):
+        constraints = []
+        min_length, max_length = self.min_length, self.max_length
+        if min_length != None:
+            constraints.append((lambda value: len(value) >= min_length,
+                                "Must be at least %d characters long." % min_length))
+        if max_length != None:
+            constraints.append((lambda value: len(value) <= max_length,
+                                "Must be %d characters or less." % max_length))
+        return constraints
+
+def enum_key(value):
+    """Returns the EnumSchema lookup key for an allowed value."""
+    if isinstance(value, str):
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    return (value.__class__ is bool, value)
+
+class EnumSchema(Schema):
+    """One of a fixed list of JSON values (e.g. EnumSchema(["asc", "desc"])). str and
+       unicode values are interchangeable."""
+
+    def __init__(self, values):
+        if not isinstance(values, (list, tuple)) or len(values) == 0:
+            raise Exception("EnumSchema values must be a non-empty list.")
+        self.values = list(values)
+
+    def compile(self):
+        # Hashable values are looked up in a set. Decoded JSON strings are always unicode,
+        # so str values are decoded to match. bool/int equality (True == 1) is ruled out by
+        # also matching on whether the value is a bool.
+        choices = frozenset([enum_key(value) for value in self.values])
+        message = "Must be one of %s." % json.dumps(self.values)
+
+        def check(value):
+            try:
+                if (value.__class__ is bool, value) in choices:
+                    return None
+            except TypeError:
+                pass
+            return ([], message)
+        return check
+
+class ArraySchema(Schema):
+    """JSON array whose items all match item_type (a Schema node or Python type), optionally
+       limited to [min_length, max_length] items."""
+    python_types = list
+    type_name = "list"
+
+    def __init__(self, item_type=None, min_length=None, max_length=None):
+        self.item_type = item_type
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def constraints(self):
+        constraints = []
+        min_length, max_length = self.min_length, self.max_length
+        if min_length != None:
+            constraints.append((lambda value: len(value) >= min_length,
+                                "Must contain at least %d items." % min_length))
+        if max_length != None:
+            constraints.append((lambda value: len(value) <= max_length,
+                                "Must contain %d items or less." % max_length))
+        return constraints
+
+    def compile(self):
+        check_array = Schema.compile(self)
+        if self.item_type == None:
+            return check_array
+        check_item = compile_check(self.item_type)
+
+        def check(value):
+            error = check_array(value)
+            if error != None:
+                return error
+            for index, item in enumerate(value):
+                error = check_item(item)
+                if error != None:
+                    error[0].append(index)
+                    return error
+            return None
+        return check
+
+class ObjectSchema(Schema):
+    """JSON object. Takes an argument list in the same format as json_arguments:
+       (arg_name, arg_type) or (arg_name, arg_type, optional_flag) tuples, where arg_type is
+       a Python type or another Schema node. Keys not in the list are allowed."""
+    python_types = dict
+    type_name = "dict"
+
+    def __init__(self, arg_list):
+        validate_arg_list(arg_list, "ObjectSchema")
+        self.arg_list = arg_list
+
+    def compile(self):
+        check_object = Schema.compile(self)
+        fields = tuple([(arg_pair[0],
+                         len(arg_pair) < 3 or arg_pair[2] == False,
+                         compile_check(arg_pair[1])) for arg_pair in self.arg_list])
+
+        def check(value):
+            error = check_object(value)
+            if error != None:
+                return error
+            for name, required, check_field in fields:
+                if name in value:
+                    error = check_field(value[name])
+                    if error != None:
+                        error[0].append(name)
+                        return error
+                elif required:
+                    return ([name], MISSING_ARGUMENT)
+            return None
+        return check
+
+def validate_arg_list(arg_list, caller="json_arguments"):
+    """Raises an exception if arg_list isn't a valid json_arguments/ObjectSchema argument list."""
     if not isinstance(arg_list, list):
-        if isinstance(arg_list, type(json_arguments)):
-            raise Exception("You must supply the arg_list argument to the json_arguments decorator.")
+        if isinstance(arg_list, type(validate_arg_list)):
+            raise Exception("You must supply the arg_list argument to the %s decorator." % caller)
         else:
             raise Exception("arg_list must be a list of tuples. arg_list is of type %s" % str(type(arg_list)))
     for arg_pair in arg_list:
@@ -54,31 +426,162 @@ def json_arguments(arg_list, content_type="application/json"):
         if len(arg_pair) > 3:
             raise Exception("arg_list items may only contain an argument name, type and optional_flag: %s" % repr(arg_pair))
 
+## Shiji JSON Argument Validation
+class ArgumentValidator(object):
+    """json_arguments arg_list compiled once at decoration time. Required and optional
+       arguments are split up front and error messages and type names are precomputed, so
+       a valid body costs one dict lookup and isinstance() per argument."""
+
+    missing_message = MISSING_ARGUMENT
+
+    def __init__(self, arg_list):
+        """Compiles the validator.
+
+        Arguments:
+
+            arg_list (list of tuples) - json_arguments argument list. Each tuple is
+                                        (arg_name, arg_type) or (arg_name, arg_type, optional_flag).
+                                        arg_type may be a Python type or a Schema node.
+        """
+        compiled_args = []
+        for arg_pair in arg_list:
+            required = len(arg_pair) < 3 or arg_pair[2] == False
+            if isinstance(arg_pair[1], Schema):
+                compiled_args.append((arg_pair[0], arg_pair[1], required, None, arg_pair[1].compile()))
+            else:
+                compiled_args.append((arg_pair[0], arg_pair[1], required, type_message(arg_pair[1]), None))
+        self.arg_list = tuple(compiled_args)
+
+        # Fast checks carry their arg_list index so a failure can be reported without rescanning
+        indexed_args = list(enumerate(self.arg_list))
+        self.required_checks = tuple([(arg[0], arg[1], index) for index, arg in indexed_args if arg[2] and arg[4] == None])
+        self.optional_checks = tuple([(arg[0], arg[1], index) for index, arg in indexed_args if not arg[2] and arg[4] == None])
+        self.schema_checks = tuple([(arg[0], arg[2], arg[4], index) for index, arg in indexed_args if arg[4] != None])
+
+        # The fast checks run required, then optional, then schema arguments. When one fails,
+        # these are the arguments before it in arg_list order that haven't been checked yet.
+        # Only they can hold an earlier error.
+        self.unchecked_before = []
+        for index, arg in indexed_args:
+            if arg[4] != None:
+                unchecked = ()
+            elif arg[2]:
+                unchecked = tuple([earlier for earlier in self.arg_list[:index] if not earlier[2] or earlier[4] != None])
+            else:
+                unchecked = tuple([earlier for earlier in self.arg_list[:index] if earlier[4] != None])
+            self.unchecked_before.append(unchecked)
+
+    def validate(self, json_args):
+        """Validates the decoded request body.
+
+        Arguments:
+
+            json_args (dict) - Decoded request body.
+
+        Returns:
+
+            None if json_args is valid, otherwise an (arg_name, error_message) tuple for the
+            first invalid argument in arg_list order."""
+        try:
+            for name, arg_type, index in self.required_checks:
+                if not isinstance(json_args[name], arg_type):
+                    return self._firstError(json_args, index)
+        except KeyError:
+            return self._firstError(json_args, index)
+
+        for name, arg_type, index in self.optional_checks:
+            if name in json_args and not isinstance(json_args[name], arg_type):
+                return self._firstError(json_args, index)
+
+        for name, required, check, index in self.schema_checks:
+            if name in json_args:
+                error = check(json_args[name])
+                if error != None:
+                    return self._schemaError(name, error)
+            elif required:
+                return (name, self.missing_message)
+
+        return None
+
+    def _firstError(self, json_args, failed_index):
+        """Picks the error to report once the fast checks fail at arg_list[failed_index]. Only
+           the earlier arguments the fast checks hadn't reached are checked (then the failed one
+           itself), so missing argument and type mismatch errors are reported in arg_list order
+           exactly as before."""
+        for name, arg_type, required, message, schema_check in \
+                self.unchecked_before[failed_index] + (self.arg_list[failed_index],):
+            if not name in json_args:
+                if required:
+                    return (name, self.missing_message)
+            elif schema_check != None:
+                error = schema_check(json_args[name])
+                if error != None:
+                    return self._schemaError(name, error)
+            elif not isinstance(json_args[name], arg_type):
+                return (name, message or self._lateTypeMessage(arg_type))
+        return None
+
+    def _schemaError(self, name, error):
+        """Converts a schema check error for argument name into a (JSON pointer, message) tuple."""
+        path = error[0] + [name]
+        path.reverse()
+        return (json_pointer(path), error[1])
+
+    def _lateTypeMessage(self, arg_type):
+        return "Must be of type %s" % arg_type().__class__.__name__
+
+## Shiji JSON Argument Parsing Decorators
+def json_arguments(arg_list, content_type="application/json", max_body_size=None):
+    """Wraps a Twisted Web render_POST function, parses the body as JSON arguments, and stores them as a dictionary
+       in request.jsonArgs. If the request's Content-Type is not the same as content_type, or the request body is
+       not valid JSON we'll throw  an error on-behalf of our wrapped function. Also, we'll validate to ensure the
+       expected request arguments & types are present.
+
+    Arguments:
+
+        arg_list (list of tuples) - List of tuples where each tuple represents a request argument in the format:
+                                    (arg_name, arg_type) for example an argument 'port' of type 'int':
+                                        ("port", int)
+                                    arg_type may also be a Schema node (e.g. ArraySchema(StringSchema())) to
+                                    validate nested values. Errors name the JSON pointer of the invalid value.
+        content_type (string) - Expected request Content-Type. Default: application/json
+        max_body_size (int) - Largest request body in bytes to accept. 0 disables the limit.
+                              Default: the limit set with set_max_body_size() (shijid.conf max_body_size)
+
+    Returns:
+
+        A function object wrapping the original function."""
+
+    # Validate arg_list
+    validate_arg_list(arg_list)
+
+    validator = ArgumentValidator(arg_list)
+
     def jsonValidateArgWrap(render_func):
         def jsonWrappedFilet(self, request):
             """Our super-JSON argument validating wrapper that calls the original
                render_POST func when done."""
 
             # Only accept requests with Content-Type equal to content_type that are UTF-8 encoded
-            if request.getHeader("Content-Type") == None:
-                return str(ContentTypeError(request))
+            content_error = content_type_error(request, content_type)
+            if content_error != None:
+                return content_error
 
-            try:
-                sent_content_type, sent_charset = "".join(request.getHeader("Content-Type").lower().split(" ")).split(";")
-            except exceptions.ValueError:
-                return str(CharsetNotUTF8Error(request))
-
-            if sent_charset != "charset=utf-8":
-                return str(CharsetNotUTF8Error(request))
-
-            if sent_content_type != content_type:
-                return str(ContentTypeError(request))
+            # Reject oversized bodies before reading any of them
+            if max_body_size != None:
+                body_limit = max_body_size
+            else:
+                body_limit = default_max_body_size
+            body_size = request_body_size(request)
+            if body_limit and body_size > body_limit:
+                return str(RequestTooLargeError(request, body_limit))
 
-            # Convert JSON body into an argument dictionary stored in the request
+            # Convert JSON body into an argument dictionary stored in the request. The body is
+            # read with one exactly-sized read and the codec parses the UTF-8 bytes directly.
             try:
-                request.jsonArgs = json.loads(request.content.read().decode("utf-8"))
+                request.jsonArgs = json_codec.decode(request.content.read(body_size))
             except Exception, e:
-                print "Request Error: Could not JSON decode request body - %s %s" % (str(type(e)), str(e))
+                log.logger.msg("JSONDecodeError", "Request Error: Could not JSON decode request body - %s %s", type(e), e)
                 return str(JSONDecodeError(request))
 
             # Make sure what we shoved into jsonArgs was a hash/dictionary
@@ -86,16 +589,9 @@ def json_arguments(arg_list, content_type="application/json"):
                 return str(RequestNotHashError(request))
 
             # Validate individual arguments & types match what the API call expects
-            for arg_pair in arg_list:
-                try:
-                    if len(arg_pair) < 3 or arg_pair[2] == False or request.jsonArgs.has_key(arg_pair[0]):                        
-                        if not isinstance(request.jsonArgs[arg_pair[0]], arg_pair[1]):
-                            raise exceptions.ValueError()
-                except KeyError:
-                    return str(ValueError(request, arg_pair[0], "Argument is missing."))
-                except exceptions.ValueError:
-                    return str(ValueError(request, arg_pair[0], "Must be of type %s" % \
-                                                                arg_pair[1]().__class__.__name__))
+            arg_error = validator.validate(request.jsonArgs)
+            if arg_error != None:
+                return str(ValueError(request, arg_error[0], arg_error[1]))
 
             # As you were...
             return render_func(self, request)
@@ -104,12 +600,92 @@ def json_arguments(arg_list, content_type="application/json"):
 
     return jsonValidateArgWrap
 
-def paged_results(default_page=0,default_page_len=50,max_page_len=100):
+## Keyset Pagination Cursors
+# Signed message prefix. "|" never appears in a secure cookie's signed parts (base64 value
+# & timestamp), so a cookie signature can't be replayed as a cursor signature.
+CURSOR_SIGNATURE_PREFIX = "shiji.cursor|"
+# Default number of seconds a cursor stays valid after it's minted
+CURSOR_MAX_AGE = 86400
+# Returned by read_cursor for cursors that don't validate
+INVALID_CURSOR = object()
+
+def cursor_scope(resource):
+    """Returns the scope cursors for resource's call are bound to (its module & class name)."""
+    return "%s.%s" % (resource.__class__.__module__, resource.__class__.__name__)
+
+def make_cursor(request, position):
+    """Mints an opaque, signed continuation token for paged_results(cursor=True).
+    
+    Arguments:
+    
+        request (Twisted.web.http.Request) - Request being answered by a paged_results(cursor=True)
+                                             call. The cursor is only accepted by that call.
+        position (JSON-serializable) - Keyset position the next page starts after
+                                       (e.g. [last_created_at, last_id]).
+    
+    Returns:
+    
+        URL-safe cursor string carrying position and the time it was minted. Signed
+        (together with the call's scope) with the first secret passed to
+        shiji.auth.install_secure_cookies."""
+    if not signing.installed():
+        raise Exception("make_cursor: Cursors are signed with the secure cookie secrets. Call auth.install_secure_cookies first.")
+    
+    scope = getattr(request, "cursor_scope", None)
+    if scope == None:
+        raise Exception("make_cursor: Cursors can only be minted by calls wrapped with paged_results(cursor=True).")
+    
+    payload = base64.urlsafe_b64encode(json_codec.encode([int(time.time()), position])).rstrip("=")
+    return "%s.%s" % (payload, signing.sign(CURSOR_SIGNATURE_PREFIX, scope, "|", payload))
+
+def read_cursor(cursor, scope, max_age=CURSOR_MAX_AGE):
+    """Verifies and decodes a cursor minted by make_cursor.
+    
+    Arguments:
+    
+        cursor (string) - Cursor string sent by the client.
+        scope (string) - Scope of the call reading the cursor (see cursor_scope).
+        max_age (int) - Seconds a cursor is valid for after it's minted. 0 disables expiry.
+    
+    Returns:
+    
+        The decoded position, or INVALID_CURSOR if the cursor is malformed, expired,
+        was minted by a different call or its signature doesn't match any of the secure
+        cookie secrets."""
+    if not signing.installed():
+        raise Exception("read_cursor: Cursors are signed with the secure cookie secrets. Call auth.install_secure_cookies first.")
+    
+    payload, sep, signature = cursor.rpartition(".")
+    if sep == "":
+        return INVALID_CURSOR
+    
+    # Check the signature before decoding anything the client sent
+    if not signing.valid_signature(signature, CURSOR_SIGNATURE_PREFIX, scope, "|", payload):
+        return INVALID_CURSOR
+    
+    try:
+        issued, position = json_codec.decode(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except (TypeError, exceptions.ValueError):
+        return INVALID_CURSOR
+    
+    if max_age and issued < time.time() - max_age:
+        return INVALID_CURSOR
+    
+    return position
+
+def paged_results(default_page=0,default_page_len=50,max_page_len=100,cursor=False,cursor_max_age=CURSOR_MAX_AGE):
     """Wraps a Twisted Web render_* function. Checks for the URL query string for
        presence of 'page' and 'page_len' arguments:
                 * Validates page and page_len are valid integers.
                 * Validates page is > -1.
                 * Validates page_len is > 0 and < max_page_len.
+       
+       In cursor mode the 'cursor' argument replaces 'page'. The handler receives
+       request.cursor (decoded position or None for the first page) and request.page_len (int),
+       and mints the next page's cursor with make_cursor(request, position). Cursors are only
+       accepted by the call that minted them, and expire. Handlers should query with
+       WHERE key > position rather than OFFSET, so deep pages cost the same as the first.
+    
     Arguments:
     
           default_page (int) - page argument is set to this value if
@@ -118,7 +694,10 @@ def paged_results(default_page=0,default_page_len=50,max_page_len=100):
                                    page_len wasn't specified in the URL query string.
           max_page_len (int) - Maximum allowed size of result set. Any
                                page_len setting > max_page_len will trigger
-                               a ValueError."""
+                               a ValueError.
+          cursor (bool) - Use signed keyset cursors instead of page offsets.
+          cursor_max_age (int) - Seconds a cursor is accepted for after it's minted.
+                                 0 disables expiry."""
     
     if default_page_len > max_page_len:
         raise Exception("paged_results: Default page length (%d) cannot be greater than maximum page length (%d)." % (default_page_len, max_page_len))
@@ -132,6 +711,9 @@ def paged_results(default_page=0,default_page_len=50,max_page_len=100):
     if max_page_len < 0:
         raise Exception("paged_results: Max page length (%d) cannot be < 0." % default_page)
     
+    if cursor_max_age < 0:
+        raise Exception("paged_results: Cursor max age (%d) cannot be < 0." % cursor_max_age)
+    
     def pageValidateWrap(render_func):
         def wrappedFunction(self, request):
             """Wrapped render_* function. Validates result paging arguments."""
@@ -146,9 +728,19 @@ def paged_results(default_page=0,default_page_len=50,max_page_len=100):
                 if page_len > max_page_len:
                     return str(ValueError(request, "page_len", "Argument must be %d or less." % max_page_len))
             else:
+                page_len = default_page_len
                 request.args["page_len"] = [str(default_page_len)]
             
-            if request.args.has_key("page"):
+            if cursor:
+                request.page_len = page_len
+                request.cursor_scope = cursor_scope(self)
+                if request.args.has_key("cursor"):
+                    request.cursor = read_cursor(request.args["cursor"][0], request.cursor_scope, cursor_max_age)
+                    if request.cursor is INVALID_CURSOR:
+                        return str(ValueError(request, "cursor", "Argument must be a cursor returned by this API."))
+                else:
+                    request.cursor = None
+            elif request.args.has_key("page"):
                 try:
                     page = int(request.args["page"][0])
                 except exceptions.ValueError:
@@ -196,19 +788,9 @@ def url_arguments(arg_list, content_type=""):
                render_GET func when done."""
             # Only accept requests with Content-Type equal to content_type that are UTF-8 encoded
             if content_type != "":
-                if request.getHeader("Content-Type") == None:
-                    return str(ContentTypeError(request))
-                
-                try:
-                    sent_content_type, sent_charset = "".join(request.getHeader("Content-Type").lower().split(" ")).split(";")
-                except exceptions.ValueError:
-                    return str(CharsetNotUTF8Error(request))
-                
-                if sent_charset != "charset=utf-8":
-                    return str(CharsetNotUTF8Error(request))
-                
-                if sent_content_type != content_type:
-                    return str(ContentTypeError(request))
+                content_error = content_type_error(request, content_type)
+                if content_error != None:
+                    return content_error
             
             # Validate individual arguments & types match what the API call expects
             for arg in arg_list:
@@ -252,26 +834,423 @@ def auth_http_basic(auth_func, realm="Shiji"):
     return authValidateCallerWrap
 
 ## Shiji Output Utility Functions
-def write_json(request, obj):
+## Conditional Requests
+RE_ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+RE_ETAG_TOKEN = re.compile(r'^[\x21\x23-\x7e]+$')
+
+def make_etag(version=None, body=None):
+    """Builds a strong ETag.
+    
+    Arguments:
+    
+        version (string) - Cheap version token for the representation (e.g. a row's
+                           revision or last modified timestamp). Used as-is when it's a
+                           valid ETag token, otherwise hashed.
+        body (string) - Encoded response body to hash. Only used if version is None.
+    
+    Returns:
+    
+        Quoted ETag string."""
+    if version != None:
+        version = str(version)
+        if RE_ETAG_TOKEN.match(version):
+            return '"%s"' % version
+        body = version
+    
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+def etag_matches(request, etag):
+    """Returns True if request's If-None-Match header lists etag (or is "*").
+       If-None-Match uses weak comparison, so W/ prefixes are ignored."""
+    if_none_match = request.getHeader("If-None-Match")
+    if if_none_match == None:
+        return False
+    
+    if if_none_match.strip() == "*":
+        return True
+    
+    for client_etag in RE_ENTITY_TAG.findall(if_none_match):
+        if client_etag == etag:
+            return True
+    
+    return False
+
+def check_etag(request, etag):
+    """Sets the response's ETag header. If the client already holds this representation
+       (matching If-None-Match on a GET or HEAD), also sets the response code to 304.
+       
+       Strong ETags must differ between content-codings, so if the response is
+       compressed (request.content_coding, see CompressionEncoderFactory) the coding is
+       appended to the tag. The 200, the 304 and HEAD responses all get the same tag.
+    
+    Arguments:
+    
+        request (Twisted.web.http.Request) - HTTP request object
+        etag (string) - Quoted ETag from make_etag.
+    
+    Returns:
+    
+        True if the response is a 304 and no body should be written, otherwise False."""
+    content_coding = getattr(request, "content_coding", None)
+    if content_coding != None and etag.endswith('"'):
+        etag = '%s-%s"' % (etag[:-1], content_coding)
+    
+    request.setHeader("ETag", etag)
+    if request.method in ("GET", "HEAD") and etag_matches(request, etag):
+        request.setResponseCode(304)
+        return True
+    
+    return False
+
+def not_modified(request):
+    """Finishes a request check_etag answered with a 304.
+    
+    Returns:
+    
+        NOT_DONE_YET, to return from the render function."""
+    request.finish()
+    return NOT_DONE_YET
+
+def conditional_get(version=None):
+    """Wraps a URLMatchJSONResource render_GET function to support ETag/If-None-Match.
+       Matching requests get a 304 with no body. Can be stacked with auth.access in
+       either order.
+       
+       Arguments:
+       
+            version (function) - Optional. Called as version(self, request) before the
+                                 render function and returns a version token (or a Deferred
+                                 firing with one) for the representation. A matching request
+                                 is answered without calling the render function at all.
+                                 If not specified, the ETag is a hash of the rendered body
+                                 (the string returned, or the output of write_json)."""
+    
+    def etag_body(body, request):
+        "Hashes a successfully rendered body into the ETag."
+        if not isinstance(body, str) or request.code != 200:
+            return body
+        
+        if check_etag(request, make_etag(body=body)):
+            return not_modified(request)
+        
+        return body
+    
+    def conditionalWrap(render_func):
+        def wrappedFunction(self, request):
+            """Wrapped render_* function. Answers conditional GETs."""
+            if version != None:
+                def cb_version(version_token):
+                    if check_etag(request, make_etag(version=version_token)):
+                        return not_modified(request)
+                    return render_func(self, request)
+                
+                version_token = version(self, request)
+                if isinstance(version_token, defer.Deferred):
+                    return version_token.addCallback(cb_version)
+                
+                return cb_version(version_token)
+            
+            # Bodies written with write_json are hashed there
+            request.etag_body = True
+            result = render_func(self, request)
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(etag_body, request)
+            
+            return etag_body(result, request)
+        wrappedFunction.__doc__ = render_func.__doc__
+        return wrappedFunction
+    return conditionalWrap
+
+def write_json(request, obj, etag=None):
     """Writes the spec'd object out the HTTP request in JSON notation. Handles setting Content-Length header.
     
     Arguments:
     
         request (Twisted.web.http.Request) - HTTP request object
         obj - Object/data to JSON encode and write to the client.
+        etag (string or bool) - Optional. ETag from make_etag, or True to hash the encoded
+                                output. If it matches the request's If-None-Match a 304 is
+                                set and nothing is written. Calls wrapped with
+                                conditional_get() hash successful responses by default.
     
     Returns:
     
         Success: Nothing
         Failure: Raises exception"""
     
-    json_output = json.dumps(obj, ensure_ascii=False)
+    json_output = json_codec.encode(obj)
+    if etag == None and getattr(request, "etag_body", False) and request.code == 200:
+        etag = True
+    
+    if etag:
+        if etag == True:
+            etag = make_etag(body=json_output)
+        if check_etag(request, etag):
+            return
+    
     request.setHeader("Content-Length", len(json_output))
-    request.write(json_output.encode("utf-8"))
+    request.write(json_output)
     
     return
 
+@implementer(IPullProducer)
+class JSONArrayProducer(object):
+    """Pull producer that streams the items of an iterable out the HTTP request as a
+       JSON array. Items are only encoded when the transport asks for more data, so memory
+       use stays flat no matter how large the response is.
+
+       Output is identical to write_json(request, list(items)) except no Content-Length
+       is set (HTTP/1.1 responses are sent with chunked transfer encoding)."""
+
+    def __init__(self, request, items, batch_size=100):
+        """Sets up the producer. Call start() to begin streaming.
+
+        Arguments:
+
+            request (Twisted.web.http.Request) - HTTP request object
+            items (iterable) - Items to JSON encode. Generators are consumed lazily.
+            batch_size (int) - Items encoded and written per transport write.
+        """
+        self.request = request
+        self.items = iter(items)
+        self.batch_size = batch_size
+        self.started = False
+        self.finished = False
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        """Registers with the request so the transport pulls data as it drains.
+
+        Returns:
+
+            A deferred that fires with None once the closing bracket is written. The
+            request itself is not finished. The deferred doesn't fire if the client
+            disconnects or the iterable fails mid-stream."""
+        self.request.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        """Writes the next batch of items."""
+        if self.finished:
+            return
+
+        if self.started:
+            json_parts = []
+        else:
+            json_parts = ["["]
+
+        count = 0
+        try:
+            for item in self.items:
+                if self.started or count > 0:
+                    json_parts.append(", ")
+                json_parts.append(json_codec.encode(item))
+                count = count + 1
+                if count == self.batch_size:
+                    break
+        except Exception:
+            self._fail(Failure())
+            return
+
+        if count < self.batch_size:
+            json_parts.append("]")
+            self.finished = True
+
+        self.started = True
+        self.request.write("".join(json_parts))
+
+        if self.finished:
+            self.request.unregisterProducer()
+            self.deferred.callback(None)
+
+    def stopProducing(self):
+        """Client went away. Stop consuming the iterable."""
+        self.finished = True
+        self._closeItems()
+
+    def _closeItems(self):
+        if hasattr(self.items, "close"):
+            self.items.close()
+
+    def _fail(self, failure):
+        """Handles the iterable raising. Before anything is written the failure is passed
+           down the deferred so a normal error response can be sent. After that the
+           connection is dropped so the client can't mistake the partial array for a
+           complete response."""
+        self.finished = True
+        self.request.unregisterProducer()
+        self._closeItems()
+
+        if not self.started:
+            self.deferred.errback(failure)
+            return
+
+        log.logger.failure("JSONStreamError", failure, "Aborting JSON stream:")
+        transport = getattr(self.request, "transport", None)
+        if transport != None:
+            transport.loseConnection()
+
+def write_json_stream(request, items, batch_size=100):
+    """Streams the items of an iterable out the HTTP request as a JSON array, respecting
+       transport backpressure. Use instead of write_json for large result sets.
+
+    Arguments:
+
+        request (Twisted.web.http.Request) - HTTP request object
+        items (iterable) - Items to JSON encode (e.g. a generator over a DB cursor).
+        batch_size (int) - Items encoded and written per transport write. Default: 100
+
+    Returns:
+
+        A deferred that fires once the whole array is written. Return it from your
+        render_* function and the request will be finished for you."""
+
+    return JSONArrayProducer(request, items, batch_size).start()
+
+## Response Compression
+# Content-codings in order of preference when the client accepts several equally.
+# zlib window bits: gzip framing (+16) for gzip, zlib framing for HTTP "deflate".
+COMPRESSION_WBITS = (("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS))
+NO_BODY_CODES = (204, 304)
+
+class CompressionEncoderFactory(object):
+    """Picks a gzip/deflate encoder for responses whose client sends a matching
+       Accept-Encoding. Used by APIRouter(compress_responses=True) through
+       URLMatchJSONResource.getEncoder."""
+    
+    def __init__(self, min_size=1024, level=6):
+        """Sets up the factory.
+        
+        Arguments:
+        
+            min_size (int) - Responses with a Content-Length below this many bytes are
+                             sent uncompressed. Streamed responses (no Content-Length)
+                             are always compressed.
+            level (int) - zlib compression level (1 fastest - 9 smallest)."""
+        if min_size < 0:
+            raise Exception("CompressionEncoderFactory: Minimum size (%d) cannot be < 0." % min_size)
+        
+        if level < 1 or level > 9:
+            raise Exception("CompressionEncoderFactory: Compression level (%d) must be between 1 and 9." % level)
+        
+        self.min_size = min_size
+        self.level = level
+    
+    def encoderForRequest(self, request):
+        """Returns a CompressionEncoder for request, or None if the client doesn't accept
+           gzip or deflate. Always adds Accept-Encoding to Vary since the response
+           depends on it either way. The chosen coding is recorded as
+           request.content_coding so check_etag can tag the response with it."""
+        vary = request.responseHeaders.getRawHeaders("vary", [])
+        if "accept-encoding" not in ",".join(vary).lower():
+            request.responseHeaders.setRawHeaders("vary", vary + ["Accept-Encoding"])
+        
+        accepted = {}
+        for coding in ",".join(request.requestHeaders.getRawHeaders("accept-encoding", [])).split(","):
+            coding, sep, params = coding.partition(";")
+            qvalue = 1.0
+            params = params.replace(" ", "")
+            if params.startswith("q="):
+                try:
+                    qvalue = float(params[2:])
+                except exceptions.ValueError:
+                    qvalue = 0.0
+            accepted[coding.strip().lower()] = qvalue
+        
+        best_encoding, best_wbits, best_qvalue = None, None, 0.0
+        for encoding, wbits in COMPRESSION_WBITS:
+            qvalue = accepted.get(encoding, accepted.get("*", 0.0))
+            if qvalue > best_qvalue:
+                best_encoding, best_wbits, best_qvalue = encoding, wbits, qvalue
+        
+        if best_encoding == None:
+            return None
+        
+        request.content_coding = best_encoding
+        return CompressionEncoder(request, best_encoding, best_wbits, self.level, self.min_size)
+
+class CompressionEncoder(object):
+    """Compresses a single response on the fly. The decision to compress is made on the
+       first write, once the response code and headers are known. HEAD responses get
+       the same headers as the GET would, without compressing anything."""
+    
+    def __init__(self, request, encoding, wbits, level, min_size):
+        self.request = request
+        self.encoding = encoding
+        self.wbits = wbits
+        self.level = level
+        self.min_size = min_size
+        self.compressor = None
+        self.content_length = None
+        self.decided = False
+    
+    def _startCompressing(self):
+        "Fixes up the response headers for compression. Returns True if the body should be compressed."
+        request = self.request
+        if request.code in NO_BODY_CODES:
+            return False
+        
+        headers = request.responseHeaders
+        if headers.hasHeader("content-encoding"):
+            return False
+        
+        self.content_length = headers.getRawHeaders("content-length")
+        if self.content_length != None and int(self.content_length[0]) < self.min_size:
+            return False
+        
+        headers.removeHeader("content-length")
+        headers.setRawHeaders("content-encoding", [self.encoding])
+        if request.method == "HEAD":
+            return False
+        
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+        return True
+    
+    def encode(self, data):
+        """Compresses data. Streamed responses are flushed on every write so pull
+           producers always see output and clients get data as it's produced."""
+        if not self.decided:
+            self.decided = True
+            self._startCompressing()
+        
+        if self.compressor == None:
+            return data
+        
+        if self.content_length == None:
+            return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        
+        return self.compressor.compress(data)
+    
+    def finish(self):
+        "Returns the remaining compressed data."
+        if self.compressor == None:
+            return ""
+        
+        remaining = self.compressor.flush()
+        self.compressor = None
+        return remaining
+
 ## Shiji API Errors
+# Serialized bodies of errors whose payload is fixed by their class, keyed on the class.
+error_body_cache = {}
+
+# statsd metric names keyed on (api_name, exception_class). Bounded since api_name can come
+# from unrouted requests.
+ERROR_METRIC_CACHE_SIZE = 1024
+error_metric_names = {}
+
+def error_metric_name(api_name, exception_class):
+    """Returns the statsd metric name counting exception_class errors for api_name."""
+    try:
+        return error_metric_names[(api_name, exception_class)]
+    except KeyError:
+        pass
+    
+    metric_name = "%s.error.%s" % (api_name, exception_class)
+    if len(error_metric_names) < ERROR_METRIC_CACHE_SIZE:
+        error_metric_names[(api_name, exception_class)] = metric_name
+    return metric_name
+
 class APIError(BaseException):
     """Generic stub for API errors. Generates JSON-encoded error dictionaries 
        for Shiji API calls.
@@ -319,11 +1298,8 @@ class APIError(BaseException):
         
         # If StatsD in place, log a metric point.
         if request_object.metrics:
-            if hasattr(request_object, "api_name"):
-                api_name = request_object.api_name
-            else:
-                api_name = "unknown_api"
-            request_object.metrics.increment("%s.error.%s" % (api_name, exception_class))
+            api_name = getattr(request_object, "api_name", "unknown_api")
+            request_object.metrics.increment(error_metric_name(api_name, self.exception_class))
     
     def obj_err(self):
         """Returns the Shiji API error dictionary."""
@@ -334,6 +1310,16 @@ class APIError(BaseException):
     
     def json_err(self):
         """Returns a JSON-encoded string containing a Shiji API error dictionary."""
+        # Errors that didn't override any field (e.g. ContentTypeError) have a payload
+        # fixed by their class, so it's only serialized once.
+        if not self.__dict__:
+            try:
+                return error_body_cache[self.__class__]
+            except KeyError:
+                json_body = json.dumps(self.obj_err(), ensure_ascii=False)
+                error_body_cache[self.__class__] = json_body
+                return json_body
+        
         return json.dumps(self.obj_err(),
                           ensure_ascii=False)
     
@@ -392,6 +1378,17 @@ class RequestNotHashError(APIError):
     exception_class= "RequestNotHashError"
     exception_text = "Request body must be a JSON-encoded hash table/dictionary."
 
+class RequestTooLargeError(APIError):
+    """API Error: Request body exceeds the maximum allowed size."""
+    error_code = 209
+    exception_class = "RequestTooLargeError"
+    exception_text = "Request body exceeds the maximum allowed size of %d bytes."
+    def __init__(self, request_object, max_body_size):
+        self.exception_text = self.exception_text % max_body_size
+        APIError.__init__(self, request_object)
+        # One of the few errors we don't use HTTP Response code 409 for...use 413
+        request_object.setResponseCode(413)
+
 class AccessDeniedError(APIError):
     """API Error: Insufficient permission to perform the requested action."""
     error_code = 501